@@ -0,0 +1,18 @@
+""" Benchmarks of bw2preagg
+
+Benchmarks follow the conventions of airspeed velocity (asv) and can be run
+with ``asv run`` (see asv.conf.json at the root of the repository) or,
+without asv, with ``python -m benchmarks.run``, which appends results to a
+machine-readable history and reports regressions.
+
+Brightway2 projects and result directories used by the benchmarks are
+created in a temporary directory, unless BRIGHTWAY2_DIR and
+BW2PREAGG_BENCHMARK_DIR are set.
+"""
+import os
+import tempfile
+
+BENCHMARK_DIR = os.environ.setdefault(
+    "BW2PREAGG_BENCHMARK_DIR", os.path.join(tempfile.gettempdir(), "bw2preagg_benchmarks"))
+os.environ.setdefault("BRIGHTWAY2_DIR", os.path.join(BENCHMARK_DIR, "brightway2"))
+os.makedirs(os.environ["BRIGHTWAY2_DIR"], exist_ok=True)
@@ -0,0 +1,283 @@
+""" Timing and peak memory benchmarks of bw2preagg
+
+Written for asv (``asv run``, see ``asv.conf.json``), but also run without it
+by ``python -m benchmarks.run``, which keeps a history of results in a JSON
+Lines file.
+
+Each case is parameterized by the number of activities of the synthetic
+benchmark database (see ``bw2preagg.synthetic``) and the number of iterations, and dispatch cases also by the
+number of parallel jobs. Databases, common files and base presamples are
+created once and reused (see ``common``), so that only the benchmarked call
+is timed.
+"""
+import json
+import os
+import time
+import numpy as np
+from pathlib import Path
+from bw2preagg.setup_project import setup_project
+from bw2preagg.base_presamples import generate_base_presamples
+from bw2preagg.lci import calculate_lci_array, set_up_lci_calculations, dispatch_lci_calculators
+from bw2preagg.lcia import save_all_lcia_score_arrays
+from bw2preagg.concat_batches import concat_samples_arrays_in_result_type_dir
+from bw2preagg.utils import _get_campaign, get_ref_bio_dict_from_common_files, load_LCI_array
+from bw2preagg.compression import CODECS, available_codecs, get_codec, save_compressed_array, \
+    load_compressed_array
+from . import BENCHMARK_DIR
+from .common import prepare_database, prepare_result_dir, write_sampled_lci_arrays, remove, BENCHMARK_METHOD
+
+DATABASE_SIZES = [100, 1000]
+ITERATIONS = [10, 100]
+PARALLEL_JOBS = [1, 2]
+# Number of activities calculated by worker-level benchmarks
+WORKER_ACTIVITIES = 10
+# Number of LCI arrays written and read by compression benchmarks
+COMPRESSION_ACTIVITIES = 50
+
+
+def _reset_lci_batch(result_dir, samples_batch):
+    """Remove LCI arrays and metadata of a samples batch, so that nothing is resumed"""
+    remove(Path(result_dir) / "probabilistic" / "LCI" / str(samples_batch))
+    remove(Path(result_dir) / "probabilistic" / "LCI_metadata" / str(samples_batch))
+
+
+def _activity_codes(result_dir):
+    with open(Path(result_dir) / "common_files" / "ordered_activity_codes.json") as f:
+        return json.load(f)
+
+
+class SetupProject:
+    params = (DATABASE_SIZES,)
+    param_names = ["number_of_activities"]
+    timeout = 1800
+
+    def setup(self, number_of_activities):
+        self.project_name = prepare_database(number_of_activities)
+        self.result_dir = Path(BENCHMARK_DIR) / "results" / "setup_{}".format(number_of_activities)
+        remove(self.result_dir)
+
+    def _run(self, number_of_activities):
+        setup_project(self.project_name, "bench", self.result_dir, default_bw2setup=False)
+
+    def time_setup_project(self, *params):
+        self._run(*params)
+
+    def peakmem_setup_project(self, *params):
+        self._run(*params)
+
+
+class GenerateBasePresamples:
+    params = (DATABASE_SIZES, ITERATIONS)
+    param_names = ["number_of_activities", "iterations"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+
+    def _run(self, number_of_activities, iterations):
+        generate_base_presamples(self.project_name, "bench", self.result_dir, iterations, samples_batch=1)
+
+    def time_generate_base_presamples(self, *params):
+        self._run(*params)
+
+    def peakmem_generate_base_presamples(self, *params):
+        self._run(*params)
+
+
+class CalculateLciArray:
+    params = (DATABASE_SIZES, ITERATIONS)
+    param_names = ["number_of_activities", "iterations"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        _reset_lci_batch(self.result_dir, 0)
+        self.g_samples_dir = Path(self.result_dir) / "probabilistic" / "LCI" / "0"
+        (self.g_samples_dir / "temp").mkdir(parents=True)
+        self.presamples_paths = [p for p in _get_campaign("0", expect_base_presamples=True)]
+        self.g_dimensions = len(get_ref_bio_dict_from_common_files(Path(self.result_dir) / "common_files"))
+        self.act_code = _activity_codes(self.result_dir)[0]
+
+    def _run(self, number_of_activities, iterations):
+        calculate_lci_array(
+            "bench", self.act_code, self.presamples_paths, self.g_dimensions, iterations, self.g_samples_dir)
+
+    def time_calculate_lci_array(self, *params):
+        self._run(*params)
+
+    def peakmem_calculate_lci_array(self, *params):
+        self._run(*params)
+
+
+class SetUpLciCalculations:
+    params = (DATABASE_SIZES, ITERATIONS)
+    param_names = ["number_of_activities", "iterations"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        _reset_lci_batch(self.result_dir, 0)
+        self.activity_list = _activity_codes(self.result_dir)[:WORKER_ACTIVITIES]
+
+    def _run(self, number_of_activities, iterations):
+        set_up_lci_calculations(self.activity_list, self.result_dir, 0, "bench", 0, self.project_name)
+
+    def time_set_up_lci_calculations(self, *params):
+        self._run(*params)
+
+    def peakmem_set_up_lci_calculations(self, *params):
+        self._run(*params)
+
+
+class DispatchLciCalculators:
+    params = (DATABASE_SIZES, ITERATIONS, PARALLEL_JOBS, ["activity", "iteration"])
+    param_names = ["number_of_activities", "iterations", "parallel_jobs", "engine"]
+    timeout = 3600
+
+    def setup(self, number_of_activities, iterations, parallel_jobs, engine):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        _reset_lci_batch(self.result_dir, 0)
+
+    def _run(self, number_of_activities, iterations, parallel_jobs, engine):
+        dispatch_lci_calculators(
+            self.project_name, "bench", self.result_dir, samples_batch=0,
+            parallel_jobs=parallel_jobs, engine=engine)
+
+    def time_dispatch_lci_calculators(self, *params):
+        self._run(*params)
+
+    def peakmem_dispatch_lci_calculators(self, *params):
+        self._run(*params)
+
+
+class SaveAllLciaScoreArrays:
+    params = (DATABASE_SIZES, ITERATIONS)
+    param_names = ["number_of_activities", "iterations"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        _reset_lci_batch(self.result_dir, 0)
+        write_sampled_lci_arrays(self.result_dir, 0, iterations)
+        for dirname in ["LCIA", "LCIA_per_exchange"]:
+            remove(Path(self.result_dir) / "probabilistic" / dirname)
+
+    def _run(self, number_of_activities, iterations):
+        save_all_lcia_score_arrays(self.result_dir, BENCHMARK_METHOD, samples_batch=0,
+                                   project_name=self.project_name)
+
+    def time_save_all_lcia_score_arrays(self, *params):
+        self._run(*params)
+
+    def peakmem_save_all_lcia_score_arrays(self, *params):
+        self._run(*params)
+
+
+class ConcatSamplesArrays:
+    params = (DATABASE_SIZES, ITERATIONS)
+    param_names = ["number_of_activities", "iterations"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        for samples_batch in [0, 1]:
+            _reset_lci_batch(self.result_dir, samples_batch)
+            write_sampled_lci_arrays(self.result_dir, samples_batch, iterations)
+        self.dest = Path(self.result_dir) / "concatenated"
+        remove(self.dest)
+
+    def _run(self, number_of_activities, iterations):
+        concat_samples_arrays_in_result_type_dir(
+            self.result_dir, sb_id_list=["0", "1"], result_type_dirname="LCI", sim_name="bench", dest=self.dest)
+
+    def time_concat_samples_arrays_in_result_type_dir(self, *params):
+        self._run(*params)
+
+    def peakmem_concat_samples_arrays_in_result_type_dir(self, *params):
+        self._run(*params)
+
+
+class LazyConcatenation:
+    """Reading one elementary flow, or whole arrays, of LCI arrays of two samples batches without concatenating them"""
+    params = (DATABASE_SIZES, ITERATIONS)
+    param_names = ["number_of_activities", "iterations"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations):
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        for samples_batch in [0, 1]:
+            _reset_lci_batch(self.result_dir, samples_batch)
+            write_sampled_lci_arrays(self.result_dir, samples_batch, iterations)
+        self.codes = _activity_codes(self.result_dir)[:COMPRESSION_ACTIVITIES]
+
+    def time_read_flow(self, *params):
+        for code in self.codes:
+            load_LCI_array(self.result_dir, code, [0, 1])[0]
+
+    def time_read_arrays(self, *params):
+        for code in self.codes:
+            np.asarray(load_LCI_array(self.result_dir, code, [0, 1]))
+
+
+class Compression:
+    """Compression ratio and write and read throughput of LCI arrays, per codec ("npy": uncompressed)"""
+    params = (DATABASE_SIZES, ITERATIONS, ["npy"] + sorted(CODECS))
+    param_names = ["number_of_activities", "iterations", "codec"]
+    timeout = 1800
+
+    def setup(self, number_of_activities, iterations, codec):
+        if codec != "npy" and codec not in available_codecs():
+            raise NotImplementedError("Codec {} not installed".format(codec))
+        self.project_name, self.result_dir = prepare_result_dir(number_of_activities, iterations)
+        write_sampled_lci_arrays(self.result_dir, 0, iterations)
+        lci_dir = Path(self.result_dir) / "probabilistic" / "LCI" / "0"
+        codes = _activity_codes(self.result_dir)[:COMPRESSION_ACTIVITIES]
+        self.arrays = {code: np.load(str(lci_dir / "{}.npy".format(code))) for code in codes}
+        self.codec = None if codec == "npy" else get_codec(codec)
+        self.dirpath = Path(self.result_dir) / "compression" / codec
+        remove(self.dirpath)
+        self.dirpath.mkdir(parents=True)
+        self._write()
+
+    def _fp(self, code):
+        return self.dirpath / "{}.{}".format(code, "npy" if self.codec is None else "npc")
+
+    def _write(self):
+        for code, arr in self.arrays.items():
+            if self.codec is None:
+                np.save(str(self._fp(code)), arr)
+            else:
+                save_compressed_array(self._fp(code), arr, self.codec)
+
+    def _read(self):
+        for code in self.arrays:
+            if self.codec is None:
+                np.load(str(self._fp(code)))
+            else:
+                load_compressed_array(self._fp(code))
+
+    def _megabytes(self):
+        return sum(arr.nbytes for arr in self.arrays.values()) / 2 ** 20
+
+    def time_write(self, *params):
+        self._write()
+
+    def time_read(self, *params):
+        self._read()
+
+    def track_compression_ratio(self, *params):
+        return sum(arr.nbytes for arr in self.arrays.values()) / sum(
+            os.path.getsize(str(self._fp(code))) for code in self.arrays)
+    track_compression_ratio.unit = "ratio"
+
+    def track_write_throughput(self, *params):
+        t0 = time.perf_counter()
+        self._write()
+        return self._megabytes() / (time.perf_counter() - t0)
+    track_write_throughput.unit = "MB/s"
+
+    def track_read_throughput(self, *params):
+        t0 = time.perf_counter()
+        self._read()
+        return self._megabytes() / (time.perf_counter() - t0)
+    track_read_throughput.unit = "MB/s"
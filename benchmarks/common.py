@@ -0,0 +1,79 @@
+""" Databases and result directories used by the benchmarks
+
+Everything is created once per database size and number of iterations, and
+reused by later benchmark processes.
+"""
+from pathlib import Path
+import json
+import shutil
+import numpy as np
+from . import BENCHMARK_DIR
+from brightway2 import projects, databases
+from bw2preagg.setup_project import setup_project
+from bw2preagg.base_presamples import generate_base_presamples
+from bw2preagg.synthetic import write_synthetic_database, SYNTHETIC_METHOD
+
+BENCHMARK_METHOD = SYNTHETIC_METHOD
+
+
+def project_name(number_of_activities):
+    return "bw2preagg_benchmark_{}".format(number_of_activities)
+
+
+def prepare_database(number_of_activities):
+    """Return the name of the project with the synthetic "bench" database, writing it if needed"""
+    name = project_name(number_of_activities)
+    projects.set_current(name)
+    if "bench" not in databases:
+        write_synthetic_database(name, "bench", number_of_activities, seed=1)
+    return name
+
+
+def prepare_result_dir(number_of_activities, iterations):
+    """Return project name and result_dir with common files, deterministic LCI and base presamples of batch 0
+
+    Base presamples are registered in the project, so every number of
+    iterations has its own copy of the project of the database.
+    """
+    name = "{}_{}".format(project_name(number_of_activities), iterations)
+    result_dir = Path(BENCHMARK_DIR) / "results" / "{}_{}".format(number_of_activities, iterations)
+    marker = result_dir / "prepared.json"
+    if marker.is_file():
+        projects.set_current(name)
+        return name, result_dir
+    if name in projects:
+        projects.delete_project(name, delete_dir=True)
+    prepare_database(number_of_activities)
+    projects.copy_project(name, switch=True)
+    remove(result_dir)
+    setup_project(name, "bench", result_dir, default_bw2setup=False)
+    generate_base_presamples(name, "bench", result_dir, iterations, samples_batch=0)
+    with open(marker, "w") as f:
+        json.dump({'number_of_activities': number_of_activities, 'iterations': iterations}, f)
+    return name, result_dir
+
+
+def write_sampled_lci_arrays(result_dir, samples_batch, iterations, seed=None):
+    """Save LCI-like arrays for all activities in a samples batch, replacing existing ones
+
+    Arrays are the deterministic LCI of the activity multiplied by lognormal
+    noise, so that they have the rows of zeros and the magnitudes of real
+    LCI arrays.
+    """
+    rng = np.random.RandomState(samples_batch if seed is None else seed)
+    with open(Path(result_dir) / "common_files" / "ordered_activity_codes.json") as f:
+        codes = json.load(f)
+    det_lci_dir = Path(result_dir) / "deterministic" / "LCI"
+    lci_dir = Path(result_dir) / "probabilistic" / "LCI" / str(samples_batch)
+    remove(lci_dir)
+    lci_dir.mkdir(parents=True)
+    for code in codes:
+        det_lci = np.asarray(np.load(str(det_lci_dir / "{}.npy".format(code)))).ravel()
+        noise = rng.lognormal(0, 0.2, size=(len(det_lci), iterations))
+        np.save(str(lci_dir / "{}.npy".format(code)), (det_lci[:, None] * noise).astype("float32"))
+
+
+def remove(path):
+    """Remove a directory tree if it exists"""
+    if Path(path).exists():
+        shutil.rmtree(str(path))
@@ -0,0 +1,218 @@
+""" Run the benchmarks without asv and keep a history of results
+
+Every case (benchmark method and combination of parameters) is run in a new
+process, ``--repeat`` times. The minimum time and peak resident memory, and
+the maximum value returned by ``track_`` methods (e.g. compression ratio or
+throughput), are appended to a JSON Lines history, one record per case,
+with the commit, machine and Python version. A case is reported as a
+regression if it is worse than the best previous result of the same case on
+the same machine by more than ``--threshold``, in which case the exit code
+is 1. Cases whose setup raises NotImplementedError (e.g. a codec that is
+not installed) are skipped.
+
+    python -m benchmarks.run --quick --filter Concat
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import datetime
+import inspect
+import itertools
+import json
+import multiprocessing as mp
+import platform
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+HISTORY_FP = Path(__file__).parent / "history.jsonl"
+
+
+def _get_benchmark_classes():
+    from . import benchmarks
+    return {
+        name: cls for name, cls in inspect.getmembers(benchmarks, inspect.isclass)
+        if cls.__module__ == benchmarks.__name__ and hasattr(cls, "params")
+    }
+
+
+def list_cases(quick=False, name_filter=None):
+    """Return (class name, method name, params) of all benchmark cases
+
+    If quick, only the first value of every parameter is used.
+    """
+    cases = []
+    for class_name, cls in sorted(_get_benchmark_classes().items()):
+        params = [values[:1] if quick else values for values in cls.params]
+        for method_name in sorted(dir(cls)):
+            if not method_name.startswith(("time_", "peakmem_", "track_")):
+                continue
+            for combination in itertools.product(*params):
+                case = (class_name, method_name, dict(zip(cls.param_names, combination)))
+                if name_filter is None or name_filter in case_name(*case):
+                    cases.append(case)
+    return cases
+
+
+def case_name(class_name, method_name, params):
+    return "{}.{}({})".format(class_name, method_name, ", ".join(
+        "{}={}".format(k, v) for k, v in params.items()))
+
+
+def _run_case(class_name, method_name, params):
+    """Run one case in the current process
+
+    Returns (seconds, peak memory in bytes, value returned by the method), or
+    None if the case is skipped (setup raised NotImplementedError, as in asv).
+    """
+    instance = _get_benchmark_classes()[class_name]()
+    args = list(params.values())
+    try:
+        instance.setup(*args)
+    except NotImplementedError:
+        return None
+    t0 = time.perf_counter()
+    result = getattr(instance, method_name)(*args)
+    seconds = time.perf_counter() - t0
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return seconds, peak if sys.platform == "darwin" else peak * 1024, result
+
+
+def run_case(class_name, method_name, params, repeat=3):
+    """Run a case ``repeat`` times, each in a new process, and return its record
+
+    The best of the repeats is kept: the lowest time or peak memory, or the
+    highest value of ``track_`` methods (e.g. throughput).
+    """
+    kind = method_name.split("_")[0]
+    unit = {"time": "seconds", "peakmem": "bytes"}.get(
+        kind, getattr(getattr(_get_benchmark_classes()[class_name], method_name), "unit", None))
+    values, error, skipped = [], None, False
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as executor:
+            try:
+                outcome = executor.submit(_run_case, class_name, method_name, params).result()
+            except Exception:
+                error = traceback.format_exc(limit=-3)
+                break
+        if outcome is None:
+            skipped = True
+            break
+        seconds, peak, result = outcome
+        values.append({"time": seconds, "peakmem": peak}.get(kind, result))
+    value = None
+    if values and error is None:
+        value = max(values) if kind == "track" else min(values)
+    return {
+        'case': case_name(class_name, method_name, params),
+        'benchmark': "{}.{}".format(class_name, method_name),
+        'params': params,
+        'kind': kind,
+        'unit': unit,
+        'value': value,
+        'repeat': repeat,
+        'skipped': skipped,
+        'error': error,
+    }
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=str(Path(__file__).parent), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(history_fp=HISTORY_FP):
+    """Return all records of the history, oldest first"""
+    history_fp = Path(history_fp)
+    if not history_fp.is_file():
+        return []
+    with open(history_fp) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(records, history, threshold=0.1):
+    """Return (record, best previous value) of records worse than the best previous result by more than threshold
+
+    Only successful results of the same case on the same machine are
+    compared. Lower is better for times and peak memory, higher for
+    ``track_`` values (ratios and throughputs).
+    """
+    regressions = []
+    for record in records:
+        if record['value'] is None:
+            continue
+        previous = [
+            r['value'] for r in history
+            if r['case'] == record['case'] and r['machine'] == record['machine'] and r['value'] is not None
+        ]
+        if not previous:
+            continue
+        if record['kind'] == "track":
+            if record['value'] < max(previous) * (1 - threshold):
+                regressions.append((record, max(previous)))
+        elif record['value'] > min(previous) * (1 + threshold):
+            regressions.append((record, min(previous)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--filter", default=None, help="Only run cases whose name contains this string")
+    parser.add_argument("--quick", action="store_true", help="Only run the smallest case of every benchmark, once")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per case, the best is kept")
+    parser.add_argument("--history", default=str(HISTORY_FP), help="JSON Lines file to which results are appended")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown or memory increase reported as a regression")
+    parser.add_argument("--list", action="store_true", help="List cases and exit")
+    args = parser.parse_args(argv)
+
+    cases = list_cases(args.quick, args.filter)
+    if args.list:
+        for case in cases:
+            print(case_name(*case))
+        return 0
+    repeat = 1 if args.quick else args.repeat
+    history = read_history(args.history)
+    context = {
+        'commit': _get_commit(),
+        'machine': platform.node(),
+        'python': platform.python_version(),
+        'date': datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    records = []
+    with open(args.history, "a") as f:
+        for case in cases:
+            record = dict(run_case(*case, repeat=repeat), **context)
+            records.append(record)
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            if record['skipped']:
+                print("{:<90} skipped".format(record['case']))
+            elif record['error'] is not None:
+                print("{:<90} failed: {}".format(record['case'], record['error'].strip().splitlines()[-1]))
+            elif record['kind'] == "time":
+                print("{:<90}{:>12.3f} s".format(record['case'], record['value']))
+            elif record['kind'] == "peakmem":
+                print("{:<90}{:>12.1f} MB".format(record['case'], record['value'] / 2 ** 20))
+            else:
+                print("{:<90}{:>12.2f} {}".format(record['case'], record['value'], record['unit'] or ""))
+
+    regressions = find_regressions(records, history, args.threshold)
+    for record, best in regressions:
+        print("Regression: {} {} against best {} ({:+.0%})".format(
+            record['case'], record['value'], best, record['value'] / best - 1))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,54 @@
 __all__ = [
     'setup_project',
+    'save_technosphere_block_ordering',
+    'write_synthetic_database',
     'generate_base_presamples',
     'generate_balancing_presamples',
     'dispatch_lci_calculators',
     'set_up_lci_calculations',
+    'set_up_iteration_major_lci_calculations',
+    'select_solver_backend',
+    'save_lci_cost_model',
     'save_all_lcia_score_arrays',
     'calculate_lcia_array_from_activity_code',
     'load_LCI_array',
     'load_LCIA_array',
+    'create_catalog',
+    'audit_arrays',
+    'repair_arrays',
 ]
 
-from .setup_project import setup_project
-from .base_presamples import generate_base_presamples
-from .balancing_presamples import generate_balancing_presamples
-from .lci import dispatch_lci_calculators, set_up_lci_calculations
-from .lcia import save_all_lcia_score_arrays, calculate_lcia_array_from_activity_code
-from .utils import load_LCI_array, load_LCIA_array
\ No newline at end of file
+# Submodule defining each name. Names are imported on first access, so that
+# e.g. the status command does not import brightway2 (see cli).
+_SUBMODULES = {
+    'setup_project': 'setup_project',
+    'save_technosphere_block_ordering': 'setup_project',
+    'write_synthetic_database': 'synthetic',
+    'generate_base_presamples': 'base_presamples',
+    'generate_balancing_presamples': 'balancing_presamples',
+    'dispatch_lci_calculators': 'lci',
+    'set_up_lci_calculations': 'lci',
+    'set_up_iteration_major_lci_calculations': 'lci',
+    'select_solver_backend': 'lci',
+    'save_lci_cost_model': 'cost_model',
+    'save_all_lcia_score_arrays': 'lcia',
+    'calculate_lcia_array_from_activity_code': 'lcia',
+    'load_LCI_array': 'utils',
+    'load_LCIA_array': 'utils',
+    'create_catalog': 'catalog',
+    'audit_arrays': 'audit',
+    'repair_arrays': 'audit',
+}
+
+
+def __getattr__(name):
+    if name not in _SUBMODULES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    from importlib import import_module
+    value = getattr(import_module("." + _SUBMODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
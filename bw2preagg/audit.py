@@ -0,0 +1,452 @@
+""" Column-level audit and repair of LCI and LCIA arrays
+
+When an iteration fails, the LCI calculators fill its column with NaN, and
+iterations that were never calculated are left to 0. Such arrays are
+nevertheless saved, and resuming calculations only re-queues arrays with
+columns left to 0, as a whole. ``audit_arrays`` scans all LCI and LCIA arrays
+of a samples batch, memory-mapped when saved as ``.npy`` files, and reports
+the columns with NaN, infinite values or only zeros of every array. The
+resulting repair plan lists the (activity, iteration) pairs to recalculate,
+and is saved in ``LCI_metadata/<samples_batch>/repair_plan.json``.
+
+``repair_arrays`` then recalculates only these columns: for each iteration
+of the plan, the sampled matrices are rebuilt with the presamples index set
+to that iteration (see ``CampaignMatrixBuilder``) and factorized once for all
+activities with a failed column in that iteration. The columns are patched
+in the saved arrays, whatever their format (``.npy``, ``.npc``, ``.npz`` or
+LCI store), and the columns of the LCIA arrays of the same activities and
+iterations are recalculated from the repaired LCI arrays.
+"""
+from collections import defaultdict
+from pathlib import Path
+import json
+import multiprocessing as mp
+import os
+import pickle
+import numpy as np
+from brightway2 import projects, get_activity
+from .utils import _check_result_dir, _check_project, _get_campaign, _get_lci_dir, _get_lci_metadata_dir, \
+    get_ref_bio_dict_from_common_files
+from .lci_store import LCIStore, get_saved_lci_codes, load_saved_lci_array
+from .compression import COMPRESSED_SUFFIX, get_codec, read_compressed_header, save_compressed_array
+from .compact import COMPACT_SUFFIX, load_compact_array, save_compact_array
+from .matrix_builder import CampaignMatrixBuilder
+from .solvers import get_solver
+from .ledger import record_lci_array
+from .catalog import ResultCatalog
+
+REPAIR_PLAN_FILENAME = "repair_plan.json"
+COLUMN_FLAGS = ["nan", "infinite", "zero"]
+
+
+def _as_rows(arr):
+    """Return a 2-D view of arr, a 1-D array (e.g. legacy per exchange LCIA array) being one row"""
+    return arr.reshape(1, -1) if arr.ndim == 1 else arr
+
+
+def audit_columns(arr, rows_per_block=1024):
+    """Return indices of the columns with NaN, infinite values or only zeros of a 2-D array
+
+    The array is read ``rows_per_block`` rows at a time, so that memory-mapped
+    arrays are never loaded in memory as a whole. A 1-D array is audited as
+    one row, its columns being iterations.
+
+    Returns
+    --------
+    flags : dict
+        Lists of column indices, by flag ("nan", "infinite" and "zero")
+    """
+    arr = _as_rows(arr)
+    nan = np.zeros(arr.shape[1], dtype=bool)
+    infinite = np.zeros(arr.shape[1], dtype=bool)
+    nonzero = np.zeros(arr.shape[1], dtype=bool)
+    for first in range(0, arr.shape[0], rows_per_block):
+        block = np.asarray(arr[first:first + rows_per_block])
+        nan |= np.isnan(block).any(axis=0)
+        infinite |= np.isinf(block).any(axis=0)
+        nonzero |= (block != 0).any(axis=0)
+    return {
+        'nan': np.flatnonzero(nan).tolist(),
+        'infinite': np.flatnonzero(infinite).tolist(),
+        'zero': np.flatnonzero(~nonzero).tolist(),
+    }
+
+
+def _open_saved_array(dirpath, act_code, store=None):
+    """Return a saved LCI or LCIA array, memory-mapped if saved as .npy file
+
+    Compact arrays are returned as their stored rows: rows that are not
+    stored are zero in all columns, and do not change the audit.
+    """
+    fp = Path(dirpath) / "{}.npy".format(act_code)
+    compact_fp = Path(dirpath) / "{}{}".format(act_code, COMPACT_SUFFIX)
+    if compact_fp.is_file():
+        return load_compact_array(compact_fp).values
+    if fp.is_file():
+        return np.load(str(fp), mmap_mode='r')
+    return load_saved_lci_array(dirpath, act_code, store)
+
+
+def _audit_directory(dirpath, act_codes, partial_zero_only=False):
+    """Return flags of the arrays of act_codes in dirpath that have at least one flagged column
+
+    If partial_zero_only, zero columns are only flagged in arrays with at
+    least one non-zero column: e.g. the total scores of an activity without
+    any characterized elementary flow are zero in all iterations.
+    """
+    store = LCIStore.open(dirpath)
+    flagged = {}
+    for act_code in act_codes:
+        arr = _open_saved_array(dirpath, act_code, store)
+        flags = audit_columns(arr)
+        if partial_zero_only and len(flags['zero']) == arr.shape[-1]:
+            flags['zero'] = []
+        del arr
+        if any(flags[flag] for flag in COLUMN_FLAGS):
+            flagged[act_code] = flags
+    return flagged
+
+
+def _get_lcia_dirs(result_dir, samples_batch):
+    """Return directories of the probabilistic LCIA arrays of a samples batch, by (abbr, totals_or_per_exchange)"""
+    probabilistic_dir = Path(result_dir) / "probabilistic"
+    lcia_dirs = {}
+    for abbr in sorted(os.listdir(probabilistic_dir)) if probabilistic_dir.is_dir() else []:
+        if abbr in ["LCI", "LCI_metadata"]:
+            continue
+        for totals_or_per_exchange in ["totals", "per_exchange"]:
+            dirpath = probabilistic_dir / abbr / totals_or_per_exchange / str(samples_batch)
+            if dirpath.is_dir():
+                lcia_dirs[(abbr, totals_or_per_exchange)] = dirpath
+    return lcia_dirs
+
+
+def get_repair_plan_fp(result_dir, samples_batch):
+    """Return the path to the repair plan of a samples batch"""
+    return _get_lci_metadata_dir(result_dir, samples_batch) / REPAIR_PLAN_FILENAME
+
+
+def load_repair_plan(result_dir, samples_batch=0):
+    """Return the repair plan saved by audit_arrays, or None if there is none"""
+    fp = get_repair_plan_fp(result_dir, samples_batch)
+    if not fp.is_file():
+        return None
+    with open(fp, "r") as f:
+        return json.load(f)
+
+
+def _save_repair_plan(result_dir, samples_batch, plan):
+    fp = get_repair_plan_fp(result_dir, samples_batch)
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, os.getpid()))
+    with open(temp_fp, "w") as f:
+        json.dump(plan, f, indent=1)
+    os.replace(str(temp_fp), str(fp))
+
+
+def audit_arrays(result_dir, samples_batch=0, parallel_jobs=1, include_lcia=True, act_codes=None,
+                 activities_per_task=100):
+    """Find columns with NaN, infinite values or only zeros in the LCI and LCIA arrays of a samples batch
+
+    Arrays are audited in tasks of ``activities_per_task`` arrays by
+    ``parallel_jobs`` processes. Zero columns are only reported in LCIA
+    arrays with at least one non-zero column, and likewise in LCI arrays
+    calculated for a subset of elementary flows (``flow_indices.json`` in
+    the LCI metadata), which may all be zero. The repair plan is saved in
+    ``LCI_metadata/<samples_batch>/repair_plan.json``, see ``repair_arrays``.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    samples_batch : int, default=0
+        Integer id for sample batch
+    parallel_jobs : int, default=1
+        Number of processes auditing arrays
+    include_lcia : bool, default=True
+        If True, the LCIA arrays of all methods are also audited
+    act_codes : list, default=None
+        If specified, only the arrays of these activities are audited
+    activities_per_task : int, default=100
+        Number of arrays audited per task
+
+    Returns
+    --------
+    plan : dict
+        "LCI": flags (see ``audit_columns``) of the LCI arrays with flagged
+        columns, by activity code; "LCIA": same for LCIA arrays, by method
+        abbreviation, "totals" or "per_exchange" and activity code;
+        "lci_repairs": sorted [act_code, iteration] pairs of LCI columns to
+        recalculate; "lcia_repairs": sorted [abbr, totals_or_per_exchange,
+        act_code, iteration] of LCIA columns to recalculate whose LCI column
+        is not recalculated
+    """
+    result_dir = Path(_check_result_dir(result_dir))
+    directories = {("LCI", None): _get_lci_dir(result_dir, 'probabilistic', samples_batch)}
+    if include_lcia:
+        directories.update(_get_lcia_dirs(result_dir, samples_batch))
+    flow_subset = (_get_lci_metadata_dir(result_dir, samples_batch) / "flow_indices.json").is_file()
+    if act_codes is not None:
+        act_codes = set(act_codes)
+    tasks, task_keys = [], []
+    for key, dirpath in directories.items():
+        codes = sorted(get_saved_lci_codes(dirpath))
+        if act_codes is not None:
+            codes = [code for code in codes if code in act_codes]
+        partial_zero_only = key[0] != "LCI" or flow_subset
+        for first in range(0, len(codes), activities_per_task):
+            tasks.append((dirpath, codes[first:first + activities_per_task], partial_zero_only))
+            task_keys.append(key)
+    if parallel_jobs > 1 and len(tasks) > 1:
+        with mp.Pool(min(parallel_jobs, len(tasks))) as pool:
+            results = pool.starmap(_audit_directory, tasks)
+    else:
+        results = [_audit_directory(*task) for task in tasks]
+
+    plan = {'samples_batch': int(samples_batch), 'LCI': {}, 'LCIA': {}}
+    for (abbr, totals_or_per_exchange), flagged in zip(task_keys, results):
+        if abbr == "LCI":
+            plan['LCI'].update(flagged)
+        elif flagged:
+            plan['LCIA'].setdefault(abbr, {}).setdefault(totals_or_per_exchange, {}).update(flagged)
+    lci_repairs = {
+        (act_code, i) for act_code, flags in plan['LCI'].items() for flag in COLUMN_FLAGS for i in flags[flag]
+    }
+    lcia_repairs = {
+        (abbr, totals_or_per_exchange, act_code, i)
+        for abbr, arrays in plan['LCIA'].items()
+        for totals_or_per_exchange, flagged in arrays.items()
+        for act_code, flags in flagged.items()
+        for flag in COLUMN_FLAGS for i in flags[flag]
+        if (act_code, i) not in lci_repairs
+    }
+    plan['lci_repairs'] = [list(pair) for pair in sorted(lci_repairs)]
+    plan['lcia_repairs'] = [list(column) for column in sorted(lcia_repairs)]
+    _save_repair_plan(result_dir, samples_batch, plan)
+    print("Samples batch {}: {} LCI columns of {} activities and {} other LCIA columns to repair".format(
+        samples_batch, len(lci_repairs), len(plan['LCI']), len(lcia_repairs)))
+    return plan
+
+
+def _calculate_lci_columns(result_dir, database_name, samples_batch, project_name, repairs,
+                           flow_indices=None, solver="direct", solver_options=None):
+    """Recalculate LCI columns, given as lists of activity codes by iteration
+
+    For each iteration, the sampled matrices are rebuilt for that
+    iteration and A is factorized once for all its activities. Iterations
+    that fail again are skipped. If flow_indices is specified, rows of the
+    other elementary flows are set to 0.
+
+    Returns
+    --------
+    columns : dict
+        LCI columns, by (act_code, iteration)
+    """
+    projects.set_current(_check_project(project_name))
+    campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+    matrix_builder = CampaignMatrixBuilder([p for p in campaign], Path(result_dir) / "common_files")
+    solver = get_solver(solver, matrix_builder.common_files_dir, **(solver_options or {}))
+    # Matrices of the builder hold deterministic values until the first update
+    solver.analyze(matrix_builder.technosphere_matrix)
+    n_products = len(matrix_builder.product_dict)
+    columns = {}
+    for iteration, act_codes in sorted(repairs.items()):
+        try:
+            acts = [get_activity((database_name, act_code)) for act_code in act_codes]
+            A, B = matrix_builder.update(iteration)
+            solver.factorize(A)
+            demand = np.zeros((n_products, len(acts)))
+            demand[[matrix_builder.product_dict[act.key] for act in acts], np.arange(len(acts))] = [
+                act.get('production amount', 1) for act in acts]
+            lci = np.asarray(B @ solver.solve(demand), dtype=np.float32)
+            if flow_indices is not None:
+                calculated = np.zeros(lci.shape[0], dtype=bool)
+                calculated[flow_indices] = True
+                lci[~calculated] = 0
+        except Exception as err:
+            print("***********************\niteration {} problem for {} activities:{}".format(
+                iteration, len(act_codes), err)
+            )
+            continue
+        for act_code, column in zip(act_codes, lci.T):
+            columns[(act_code, iteration)] = column
+    return columns
+
+
+def _patch_saved_array(dirpath, act_code, columns, store=None):
+    """Write columns, given by iteration, in a saved LCI or LCIA array
+
+    ``.npy`` files are patched in place through a memory map, arrays in
+    other formats are read, patched and saved again in the same format.
+    Columns of a 1-D array (one row) are scalars or arrays of one value.
+
+    Returns
+    --------
+    arr, path : numpy.ndarray, Path
+        The patched array and the path of its file, or of the LCI store
+    """
+    dirpath = Path(dirpath)
+    iterations = sorted(columns)
+    values = np.stack([np.atleast_1d(columns[i]) for i in iterations], axis=1)
+    fp = dirpath / "{}.npy".format(act_code)
+    compressed_fp = dirpath / "{}{}".format(act_code, COMPRESSED_SUFFIX)
+    compact_fp = dirpath / "{}{}".format(act_code, COMPACT_SUFFIX)
+    if compact_fp.is_file():
+        arr = load_compact_array(compact_fp).to_dense()
+        _as_rows(arr)[:, iterations] = values
+        save_compact_array(compact_fp, arr)
+        return arr, compact_fp
+    if fp.is_file():
+        arr = np.load(str(fp), mmap_mode='r+')
+        _as_rows(arr)[:, iterations] = values
+        arr.flush()
+        return arr, fp
+    if compressed_fp.is_file():
+        with open(compressed_fp, "rb") as f:
+            header = read_compressed_header(f)
+        arr = load_saved_lci_array(dirpath, act_code)
+        _as_rows(arr)[:, iterations] = values
+        save_compressed_array(compressed_fp, arr, get_codec(header['codec'], **header['options']),
+                              header['rows_per_chunk'])
+        return arr, compressed_fp
+    store = store or LCIStore.open(dirpath)
+    if store is None or act_code not in store:
+        raise ValueError("File {} does not exist".format(fp))
+    arr = store.read(act_code)
+    _as_rows(arr)[:, iterations] = values
+    store.write(act_code, arr)
+    return arr, store.store_dir
+
+
+def repair_arrays(project_name, database_name, result_dir, samples_batch=0, plan=None, parallel_jobs=1,
+                  solver="direct", solver_options=None):
+    """Recalculate the columns of LCI and LCIA arrays listed in a repair plan, and patch them in place
+
+    LCI columns are recalculated with the iteration-major engine, the
+    iterations of the plan being shared among ``parallel_jobs`` processes.
+    The LCIA columns of the same activities and iterations, for all methods,
+    are then recalculated from the repaired LCI arrays, as well as the other
+    LCIA columns of the plan. Repaired LCI arrays are recorded again in the
+    ledger, and all repaired arrays in the catalog if there is one. The
+    repaired activities are finally audited again, which replaces the
+    saved repair plan.
+
+    If ``flow_indices`` were recorded for the samples batch, rows of the
+    other elementary flows are left to 0, as in the calculated arrays.
+
+    Parameters
+    -----------
+    project_name : str
+        Name of the brightway2 project where the database is imported
+    database_name : str
+        Name of the LCI database
+    result_dir : str
+        Path to directory where results are stored
+    samples_batch : int, default=0
+        Integer id for sample batch
+    plan : dict, default=None
+        Repair plan returned by ``audit_arrays``. If None, the saved plan is
+        used, or else the arrays are audited first.
+    parallel_jobs : int, default=1
+        Number of processes recalculating LCI columns
+    solver : str, default="direct"
+        Solver used for the recalculated iterations, see
+        ``calculate_lci_arrays_per_iteration``
+    solver_options : dict, default=None
+        Keyword arguments passed to the solver
+
+    Returns
+    --------
+    plan : dict
+        The repair plan of the repaired activities after the repair, with
+        the columns that could not be repaired
+    """
+    result_dir = Path(_check_result_dir(result_dir))
+    projects.set_current(_check_project(project_name))
+    if plan is None:
+        plan = load_repair_plan(result_dir, samples_batch)
+    if plan is None:
+        plan = audit_arrays(result_dir, samples_batch, parallel_jobs)
+    if not plan['lci_repairs'] and not plan['lcia_repairs']:
+        print("Nothing to repair for samples batch {}".format(samples_batch))
+        return plan
+    g_samples_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch)
+    catalog = ResultCatalog.open(result_dir)
+
+    def record(result_type, method, act_code, path, arr, summary=None):
+        if catalog is None:
+            return
+        # Keep the calculation time of the array
+        previous = catalog.query(result_type, method, samples_batch, act_code)
+        in_store = path.is_dir()
+        catalog.record(result_type, act_code, path, samples_batch, method, arr=arr, summary=summary,
+                       seconds=previous[0]['seconds'] if previous else None,
+                       fmt="store" if in_store else None, nbytes=arr.nbytes if in_store else None)
+
+    # LCI columns, with iterations shared among processes
+    repairs = defaultdict(list)
+    for act_code, iteration in plan['lci_repairs']:
+        repairs[iteration].append(act_code)
+    iterations = sorted(repairs)
+    flow_indices_fp = _get_lci_metadata_dir(result_dir, samples_batch) / "flow_indices.json"
+    flow_indices = None
+    if flow_indices_fp.is_file():
+        with open(flow_indices_fp, "r") as f:
+            flow_indices = json.load(f)
+    jobs = [
+        (result_dir, database_name, samples_batch, project_name,
+         {i: repairs[i] for i in iterations[job::parallel_jobs]}, flow_indices, solver, solver_options)
+        for job in range(min(parallel_jobs, len(iterations)))
+    ]
+    if len(jobs) > 1:
+        with mp.Pool(len(jobs)) as pool:
+            results = pool.starmap(_calculate_lci_columns, jobs)
+    else:
+        results = [_calculate_lci_columns(*job) for job in jobs]
+    lci_columns = defaultdict(dict)
+    for columns in results:
+        for (act_code, iteration), column in columns.items():
+            lci_columns[act_code][iteration] = column
+    store = LCIStore.open(g_samples_dir)
+    for act_code, columns in sorted(lci_columns.items()):
+        arr, path = _patch_saved_array(g_samples_dir, act_code, columns, store)
+        summary = record_lci_array(g_samples_dir, act_code, arr)
+        record("LCI", "", act_code, path, arr, summary)
+        del arr
+
+    # LCIA columns of the repaired LCI columns, for all methods, and other LCIA columns of the plan
+    lcia_dirs = _get_lcia_dirs(result_dir, samples_batch)
+    lcia_repairs = defaultdict(set)
+    for key, dirpath in lcia_dirs.items():
+        saved = get_saved_lci_codes(dirpath)
+        for act_code, columns in lci_columns.items():
+            if act_code in saved:
+                lcia_repairs[key + (act_code,)].update(columns)
+    for abbr, totals_or_per_exchange, act_code, iteration in plan['lcia_repairs']:
+        lcia_repairs[(abbr, totals_or_per_exchange, act_code)].add(iteration)
+    ref_bio_dict = get_ref_bio_dict_from_common_files(result_dir / "common_files")
+    characterization = {}
+    for abbr in {key[0] for key in lcia_repairs}:
+        method_common_files = result_dir / "probabilistic" / abbr / "method_common_files"
+        with open(method_common_files / "exchange_keys.pickle", "rb") as f:
+            exchange_keys = pickle.load(f)
+        with open(method_common_files / "cfs.pickle", "rb") as f:
+            cfs = pickle.load(f)
+        characterization[abbr] = (
+            [ref_bio_dict[k] for k in exchange_keys], np.reshape(np.asarray(cfs, dtype=np.float64), (-1, 1)))
+    for (abbr, totals_or_per_exchange, act_code), iterations in sorted(lcia_repairs.items()):
+        iterations = sorted(iterations)
+        B_row_indices, cf_array = characterization[abbr]
+        lci = load_saved_lci_array(g_samples_dir, act_code, store)
+        # Same calculation as save_all_lcia_score_arrays, which saves total scores in both directories
+        per_exchange = (lci[B_row_indices][:, iterations] * cf_array).astype(np.float32)
+        values = per_exchange.sum(axis=0).reshape(1, -1)
+        arr, path = _patch_saved_array(
+            lcia_dirs[(abbr, totals_or_per_exchange)], act_code, dict(zip(iterations, values.T)))
+        record("LCIA_{}".format(totals_or_per_exchange), abbr, act_code, path, arr)
+        del arr
+    print("Samples batch {}: repaired {} LCI columns and {} LCIA columns".format(
+        samples_batch, sum(len(columns) for columns in lci_columns.values()),
+        sum(len(iterations) for iterations in lcia_repairs.values())))
+
+    touched = {act_code for act_code, _ in plan['lci_repairs']} | {key[2] for key in lcia_repairs}
+    return audit_arrays(result_dir, samples_batch, parallel_jobs, act_codes=touched)
@@ -6,6 +6,7 @@ from bw2waterbalancer import DatabaseWaterBalancer
 from bw2landbalancer import DatabaseLandBalancer
 from bw2preagg.utils import _check_project, _check_database,  _check_result_dir, \
     _get_campaign, generate_seed_from_pi
+from bw2preagg.catalog import record_artifact
 
 
 def generate_balancing_presamples(
@@ -78,6 +79,7 @@ def generate_balancing_presamples(
         )
         if not water_ps_ress in list(campaign.packages):
             campaign.add_presample_resource(water_ps_ress)
+        record_artifact(result_dir, "presamples", water_ress_id, water_ps_path, samples_batch, fmt="presamples")
 
     if balance_land:
         print("Generating land transformation balancing samples")
@@ -98,3 +100,4 @@ def generate_balancing_presamples(
         )
         if not land_ps_ress in list(campaign.packages):
             campaign.add_presample_resource(land_ps_ress)
+        record_artifact(result_dir, "presamples", land_ress_id, land_ps_path, samples_batch, fmt="presamples")
@@ -6,6 +6,7 @@ from bw2data.utils import TYPE_DICTIONARY
 import numpy as np
 from bw2preagg.utils import _check_project, _check_database,  _check_result_dir, \
     _get_campaign, generate_seed_from_pi
+from bw2preagg.catalog import record_artifact
 
 
 def generate_base_presamples(project_name, database_name, result_dir, iterations,
@@ -77,6 +78,7 @@ def generate_base_presamples(project_name, database_name, result_dir, iterations
     campaign = _get_campaign(samples_batch)
     if not ps_ress in list(campaign.packages):
         campaign.add_presample_resource(ps_ress)
+    record_artifact(result_dir, "presamples", ress_id, ps_path, samples_batch, fmt="presamples")
 
 def indices_and_samples_from_params(params, iterations, seed=None):
     """Format heterogeneous parameter array for presamples"""
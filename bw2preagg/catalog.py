@@ -0,0 +1,317 @@
+""" Catalog of the arrays and presamples packages of a result_dir
+
+Finding which LCI or LCIA arrays exist otherwise requires listing the
+directories of every samples batch, which is slow for tens of thousands of
+files on shared cluster filesystems. The catalog is an SQLite database,
+``<result_dir>/catalog.sqlite``, with one row per artifact, keyed by result
+type (see ``RESULT_TYPES``), method abbreviation ("" for LCI arrays and
+presamples), samples batch and activity code (presamples package id for
+presamples), and recording its path relative to the result_dir, format,
+shape, dtype, size in bytes, checksum, number of NaN and zero columns,
+calculation time and time of recording.
+
+The catalog is optional. Once created with ``create_catalog``, it is
+updated by all writers of bw2preagg (LCI calculators, LCIA and presamples
+generation), and the lists of saved arrays used to plan LCI calculations,
+LCIA and concatenation are read from it rather than from the filesystem.
+Arrays written or deleted by other means are only seen after
+``rebuild_catalog``.
+"""
+from contextlib import closing
+from pathlib import Path
+import json
+import os
+import sqlite3
+import time
+
+CATALOG_FILENAME = "catalog.sqlite"
+RESULT_TYPES = ["LCI", "LCIA_totals", "LCIA_per_exchange", "presamples"]
+_COLUMNS = [
+    "result_type", "method", "samples_batch", "act_code", "path", "format", "shape", "dtype",
+    "nbytes", "checksum", "nan_columns", "zero_columns", "seconds", "recorded_at",
+]
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    result_type TEXT NOT NULL,
+    method TEXT NOT NULL,
+    samples_batch INTEGER NOT NULL,
+    act_code TEXT NOT NULL,
+    path TEXT NOT NULL,
+    format TEXT,
+    shape TEXT,
+    dtype TEXT,
+    nbytes INTEGER,
+    checksum INTEGER,
+    nan_columns INTEGER,
+    zero_columns INTEGER,
+    seconds REAL,
+    recorded_at REAL,
+    PRIMARY KEY (result_type, method, samples_batch, act_code)
+);
+CREATE INDEX IF NOT EXISTS artifacts_act_code ON artifacts (act_code);
+"""
+_INSERT = "INSERT OR REPLACE INTO artifacts VALUES ({})".format(", ".join("?" * len(_COLUMNS)))
+_FORMATS = {".npy": "npy", ".npc": "npc", ".npz": "npz"}
+
+
+def get_catalog_fp(result_dir):
+    return Path(result_dir) / CATALOG_FILENAME
+
+
+class ResultCatalog(object):
+    """Catalog of the artifacts of a result_dir, see module docstring
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    """
+    def __init__(self, result_dir):
+        self.result_dir = Path(result_dir)
+        self.fp = get_catalog_fp(result_dir)
+
+    @classmethod
+    def open(cls, result_dir):
+        """Return the catalog of a result_dir, or None if there is none"""
+        if not get_catalog_fp(result_dir).is_file():
+            return None
+        return cls(result_dir)
+
+    @classmethod
+    def for_directory(cls, dirpath):
+        """Return (catalog, result_type, method, samples_batch) of a samples batch directory
+
+        Returns None if dirpath is not the directory of a samples batch of
+        probabilistic LCI or LCIA arrays, or if its result_dir has no
+        catalog.
+        """
+        dirpath = Path(dirpath)
+        if not dirpath.name.isdigit():
+            return None
+        if dirpath.parent.name == "LCI" and dirpath.parent.parent.name == "probabilistic":
+            result_dir, result_type, method = dirpath.parents[2], "LCI", ""
+        elif dirpath.parent.name in ["totals", "per_exchange"] and dirpath.parents[2].name == "probabilistic":
+            result_dir, result_type = dirpath.parents[3], "LCIA_{}".format(dirpath.parent.name)
+            method = dirpath.parents[1].name
+        else:
+            return None
+        catalog = cls.open(result_dir)
+        if catalog is None:
+            return None
+        return catalog, result_type, method, int(dirpath.name)
+
+    def _connect(self):
+        # Writers of many processes share the database: wait for locks rather than fail
+        conn = sqlite3.connect(str(self.fp), timeout=60)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self):
+        """Create the database and its tables if they do not exist"""
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+            conn.commit()
+
+    def record(self, result_type, act_code, path, samples_batch, method="", arr=None, summary=None,
+               seconds=None, fmt=None, nbytes=None):
+        """Record an artifact, replacing any previous record with the same key
+
+        Parameters
+        -----------
+        result_type : str
+            One of RESULT_TYPES
+        act_code : str
+            Code of the activity, or id of the presamples package
+        path : str
+            Path of the file or directory of the artifact
+        samples_batch : int
+            Integer id for sample batch
+        method : str, default=""
+            Abbreviation of the LCIA method, "" for LCI arrays and presamples
+        arr : numpy.ndarray, default=None
+            The array, from which the summary is calculated if not given
+        summary : dict, default=None
+            Summary of the array, see ``ledger.summarize_lci_array``
+        seconds : float, default=None
+            Calculation time
+        fmt : str, default=None
+            Format of the artifact, guessed from the suffix of path if None
+        nbytes : int, default=None
+            Size in bytes, that of the file or directory at path if None
+        """
+        row = self._row(result_type, act_code, path, samples_batch, method, arr, summary, seconds, fmt, nbytes)
+        with closing(self._connect()) as conn:
+            conn.execute(_INSERT, row)
+            conn.commit()
+
+    def _row(self, result_type, act_code, path, samples_batch, method="", arr=None, summary=None,
+             seconds=None, fmt=None, nbytes=None):
+        """Return the values of the record of an artifact, see ``record``"""
+        if result_type not in RESULT_TYPES:
+            raise ValueError("Result type {} not valid, choose from {}".format(result_type, RESULT_TYPES))
+        if summary is None and arr is not None:
+            from .ledger import summarize_lci_array
+            summary = summarize_lci_array(arr)
+        summary = summary or {}
+        path = Path(path)
+        if nbytes is None and path.is_dir():
+            nbytes = sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+        elif nbytes is None and path.is_file():
+            nbytes = path.stat().st_size
+        try:
+            relative_path = path.resolve().relative_to(self.result_dir.resolve()).as_posix()
+        except ValueError:
+            relative_path = str(path)
+        return [
+            result_type, method, int(samples_batch), act_code, relative_path,
+            fmt or _FORMATS.get(path.suffix, path.suffix.lstrip(".") or None),
+            json.dumps(summary['shape']) if 'shape' in summary else None, summary.get('dtype'),
+            nbytes, summary.get('checksum'), summary.get('nan_columns'), summary.get('zero_columns'),
+            seconds, time.time(),
+        ]
+
+    def query(self, result_type=None, method=None, samples_batch=None, act_code=None):
+        """Return records matching all given criteria, as dicts
+
+        Every criterion can be a single value or a list of values. Shapes are
+        returned as lists and paths as absolute paths.
+        """
+        clauses, values = [], []
+        for column, value in [("result_type", result_type), ("method", method),
+                              ("samples_batch", samples_batch), ("act_code", act_code)]:
+            if value is None:
+                continue
+            value = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            clauses.append("{} IN ({})".format(column, ", ".join("?" * len(value))))
+            values.extend(value)
+        sql = "SELECT * FROM artifacts"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql + " ORDER BY result_type, method, samples_batch, act_code", values).fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(_COLUMNS, row))
+            record['shape'] = json.loads(record['shape']) if record['shape'] else None
+            record['path'] = self.result_dir / record['path']
+            records.append(record)
+        return records
+
+    def act_codes(self, result_type, samples_batch, method=""):
+        """Return the set of activity codes recorded for a result type, samples batch and method"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT act_code FROM artifacts WHERE result_type = ? AND method = ? AND samples_batch = ?",
+                [result_type, method, int(samples_batch)]
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def summary(self):
+        """Return number of artifacts, bytes and arrays with NaN columns per result type, method and batch"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT result_type, method, samples_batch, COUNT(*), SUM(nbytes), "
+                "SUM(CASE WHEN nan_columns > 0 THEN 1 ELSE 0 END) FROM artifacts "
+                "GROUP BY result_type, method, samples_batch ORDER BY result_type, method, samples_batch"
+            ).fetchall()
+        return [dict(zip(["result_type", "method", "samples_batch", "count", "nbytes", "with_nan"], row))
+                for row in rows]
+
+
+def record_artifact(result_dir, *args, **kwargs):
+    """Record an artifact in the catalog of result_dir if there is one, see ``ResultCatalog.record``"""
+    catalog = ResultCatalog.open(result_dir)
+    if catalog is not None:
+        catalog.record(*args, **kwargs)
+
+
+def create_catalog(result_dir):
+    """Create the catalog of a result_dir, recording all existing artifacts
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+
+    Returns
+    --------
+    catalog : ResultCatalog
+    """
+    catalog = ResultCatalog(result_dir)
+    catalog.create()
+    rebuild_catalog(result_dir)
+    return catalog
+
+
+def rebuild_catalog(result_dir):
+    """Replace all records of the catalog by the artifacts found on disk
+
+    LCI arrays (.npy, .npc, .npz files and the LCI store), LCIA arrays and
+    presamples packages are scanned. Calculation times, which can not be
+    recovered, are kept for arrays that were already recorded. Records are
+    only replaced once the scan is over, in a single transaction, so that
+    readers never see a partial catalog.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+
+    Returns
+    --------
+    catalog : ResultCatalog
+    """
+    from .lci_store import LCIStore, load_saved_lci_array
+    from .ledger import summarize_lci_array
+    result_dir = Path(result_dir)
+    catalog = ResultCatalog(result_dir)
+    catalog.create()
+    seconds = {
+        (r['result_type'], r['method'], r['samples_batch'], r['act_code']): r['seconds'] for r in catalog.query()
+    }
+    rows = []
+
+    def record(*args, **kwargs):
+        rows.append(catalog._row(*args, **kwargs))
+
+    def record_dir(dirpath, result_type, method, samples_batch):
+        for filename in sorted(os.listdir(dirpath)):
+            suffix = filename[-4:]
+            if suffix not in _FORMATS:
+                continue
+            act_code = filename[:-4]
+            record(result_type, act_code, dirpath / filename, samples_batch, method,
+                   arr=load_saved_lci_array(dirpath, act_code),
+                   seconds=seconds.get((result_type, method, samples_batch, act_code)))
+
+    probabilistic_dir = result_dir / "probabilistic"
+    lci_dir = probabilistic_dir / "LCI"
+    for batch in sorted(os.listdir(lci_dir)) if lci_dir.is_dir() else []:
+        if not batch.isdigit():
+            continue
+        record_dir(lci_dir / batch, "LCI", "", int(batch))
+        store = LCIStore.open(lci_dir / batch)
+        if store is not None:
+            for act_code in sorted(store.written_codes()):
+                lci = store.read(act_code)
+                record("LCI", act_code, store.store_dir, int(batch),
+                       summary=summarize_lci_array(lci), fmt="store", nbytes=lci.nbytes,
+                       seconds=seconds.get(("LCI", "", int(batch), act_code)))
+    for abbr in sorted(os.listdir(probabilistic_dir)) if probabilistic_dir.is_dir() else []:
+        for totals_or_per_exchange in ["totals", "per_exchange"]:
+            dirpath = probabilistic_dir / abbr / totals_or_per_exchange
+            if abbr in ["LCI", "LCI_metadata"] or not dirpath.is_dir():
+                continue
+            for batch in sorted(os.listdir(dirpath)):
+                if batch.isdigit():
+                    record_dir(dirpath / batch, "LCIA_{}".format(totals_or_per_exchange), abbr, int(batch))
+    ps_dir = result_dir / "presamples"
+    for ps_id in sorted(os.listdir(ps_dir)) if ps_dir.is_dir() else []:
+        batch = ps_id.rsplit("_", 1)[-1]
+        if (ps_dir / ps_id).is_dir() and batch.isdigit():
+            record("presamples", ps_id, ps_dir / ps_id, int(batch), fmt="presamples")
+    with closing(catalog._connect()) as conn:
+        with conn:
+            conn.execute("DELETE FROM artifacts")
+            conn.executemany(_INSERT, rows)
+    return catalog
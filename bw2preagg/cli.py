@@ -0,0 +1,129 @@
+""" Command line interface of bw2preagg
+
+Installed as the ``bw2preagg`` command, e.g.:
+
+    bw2preagg status --result_dir=/scratch/preagg --number_of_slices=24
+"""
+import click
+# Commands needing brightway2 import it when they run, so that e.g. the
+# status command starts in a fraction of a second
+from .ledger import rebuild_lci_ledger, is_lci_record_complete
+from .catalog import ResultCatalog, create_catalog, rebuild_catalog
+from .status import get_lci_status, print_lci_status
+from .synthetic import write_synthetic_database, UNCERTAINTY_TYPES
+from .profiling import summarize_phase_timings, print_phase_summary, write_folded_stacks, \
+    PHASE_TIMINGS_DIRNAME
+from pathlib import Path
+
+
+@click.group()
+def cli():
+    """Tools to manage the results of bw2preagg"""
+
+
+@cli.command("rebuild-ledger")
+@click.option('--result_dir', required=True, help='Path to directory where results are stored')
+@click.option('--samples_batch', default=0, type=int, help='Integer id for sample batch')
+def rebuild_ledger(result_dir, samples_batch):
+    """Rebuild the completion ledger of a samples batch from the LCI arrays on disk"""
+    records = rebuild_lci_ledger(result_dir, samples_batch)
+    incomplete = sorted(code for code, record in records.items() if not is_lci_record_complete(record))
+    with_nan = sorted(code for code, record in records.items() if record['nan_columns'])
+    click.echo("Ledger rebuilt with {} LCI arrays: {} incomplete, {} with failed iterations".format(
+        len(records), len(incomplete), len(with_nan)))
+    for code in incomplete:
+        click.echo("\tIncomplete: {}".format(code))
+
+
+@cli.command()
+@click.option('--result_dir', required=True, help='Path to directory where results are stored')
+@click.option('--rebuild', is_flag=True, help='Create the catalog, or replace its records by the artifacts on disk')
+def catalog(result_dir, rebuild):
+    """Report the arrays and presamples packages recorded in the catalog of a result_dir"""
+    result_catalog = ResultCatalog.open(result_dir)
+    if result_catalog is None and not rebuild:
+        raise click.ClickException("No catalog in {}, create it with --rebuild".format(result_dir))
+    if result_catalog is None:
+        result_catalog = create_catalog(result_dir)
+    elif rebuild:
+        result_catalog = rebuild_catalog(result_dir)
+    for row in result_catalog.summary():
+        click.echo("{result_type} {method} batch {samples_batch}: {count} artifacts, {megabytes:.1f} MB, "
+                   "{with_nan} with failed iterations".format(megabytes=(row['nbytes'] or 0) / 2 ** 20, **row))
+
+
+@cli.command()
+@click.option('--result_dir', required=True, help='Path to directory where results are stored')
+@click.option('--samples_batch', default=0, type=int, help='Integer id for sample batch')
+@click.option('--parallel_jobs', default=1, type=int, help='Number of processes')
+@click.option('--lci_only', is_flag=True, help='Only audit LCI arrays')
+@click.option('--repair', is_flag=True, help='Recalculate the flagged columns and patch the arrays in place')
+@click.option('--project_name', default=None, help='Name of the brightway2 project, required with --repair')
+@click.option('--database_name', default=None, help='Name of the LCI database, required with --repair')
+def audit(result_dir, samples_batch, parallel_jobs, lci_only, repair, project_name, database_name):
+    """Find (and repair) columns with NaN, infinite values or only zeros in LCI and LCIA arrays"""
+    if repair and (project_name is None or database_name is None):
+        raise click.ClickException("--repair requires --project_name and --database_name")
+    from .audit import audit_arrays, repair_arrays
+    plan = audit_arrays(result_dir, samples_batch, parallel_jobs, include_lcia=not lci_only)
+    if repair and (plan['lci_repairs'] or plan['lcia_repairs']):
+        plan = repair_arrays(project_name, database_name, result_dir, samples_batch, plan, parallel_jobs)
+    for act_code, iteration in plan['lci_repairs']:
+        click.echo("\tLCI {} iteration {}".format(act_code, iteration))
+    for abbr, totals_or_per_exchange, act_code, iteration in plan['lcia_repairs']:
+        click.echo("\t{} {} {} iteration {}".format(abbr, totals_or_per_exchange, act_code, iteration))
+
+
+@cli.command()
+@click.option('--result_dir', required=True, help='Path to directory where results are stored')
+@click.option('--samples_batch', type=int, multiple=True,
+              help='Integer id for sample batch, can be repeated. Default: all batches')
+@click.option('--number_of_slices', type=int, default=None, help='Also report progress per slice')
+@click.option('--balanced_slices', is_flag=True,
+              help='Slices are balanced by expected calculation time (dispatched with balance_slices=True)')
+def status(result_dir, samples_batch, number_of_slices, balanced_slices):
+    """Report LCI arrays done, partial, failed and remaining, per samples batch and slice"""
+    print_lci_status(get_lci_status(
+        result_dir, list(samples_batch) or None, number_of_slices, balance_slices=balanced_slices))
+
+
+@cli.command()
+@click.option('--result_dir', required=True, help='Path to directory where results are stored')
+@click.option('--samples_batch', default=0, type=int, help='Integer id for sample batch')
+@click.option('--folded', default=None, help='Also write folded stacks to this file, for flame graph tools')
+def profile(result_dir, samples_batch, folded):
+    """Summarize the per-phase timings recorded with dispatch_lci_calculators(profile=True)"""
+    profile_dir = Path(result_dir) / "probabilistic" / "LCI_metadata" / str(samples_batch) / PHASE_TIMINGS_DIRNAME
+    if not profile_dir.is_dir():
+        raise click.ClickException("No phase timings in {}".format(profile_dir))
+    summary = summarize_phase_timings(profile_dir)
+    print_phase_summary(summary)
+    if folded:
+        write_folded_stacks(summary, folded)
+
+
+@cli.command("synthetic-database")
+@click.option('--project_name', required=True, help='Name of the brightway2 project, created if needed')
+@click.option('--database_name', default="synthetic", help='Name of the LCI database')
+@click.option('--number_of_activities', default=1000, type=int, help='Number of activities')
+@click.option('--number_of_flows', default=500, type=int, help='Number of elementary flows')
+@click.option('--technosphere_inputs', default=5., type=float, help='Average number of technosphere inputs')
+@click.option('--biosphere_outputs', default=10., type=float, help='Average number of elementary flows')
+@click.option('--cycle_share', default=0.05, type=float, help='Share of inputs from downstream activities')
+@click.option('--cycle_length', default=None, type=int, help='Maximum length of cycles')
+@click.option('--uncertain_share', default=1., type=float, help='Share of exchanges with uncertainty')
+@click.option('--uncertainty_type', type=click.Choice(sorted(UNCERTAINTY_TYPES)), multiple=True,
+              help='Uncertainty type of uncertain exchanges, can be repeated. Default: lognormal')
+@click.option('--seed', default=0, type=int, help='Seed of the random number generator')
+@click.option('--overwrite', is_flag=True, help='Replace the LCI database if it exists')
+def synthetic_database(uncertainty_type, **kwargs):
+    """Write a random LCI database, its biosphere and an LCIA method for load testing"""
+    uncertainty_types = {t: 1. for t in uncertainty_type} or None
+    try:
+        write_synthetic_database(uncertainty_types=uncertainty_types, **kwargs)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,132 @@
+""" Compact storage of LCI arrays, without the rows that are always zero
+
+An LCI array has one row per elementary flow of the biosphere matrix, i.e.
+several thousand rows, but the LCI of most activities only has non-zero
+values for a fraction of these flows, in any iteration. The compact form
+of an LCI array only keeps the rows with at least one non-zero (or NaN)
+value, with their row indices in the ``bio_dict``.
+
+Compact LCI arrays are saved in ``<act_code>.npz`` files, next to where
+``<act_code>.npy`` files would be, with the arrays ``rows`` (sorted row
+indices), ``values`` (rows x iterations) and ``shape`` (shape of the dense
+array). They are written by the LCI calculators if compact storage is
+recorded for the samples batch (see ``save_lci_compact``), and read by
+``load_LCI_array``, which returns the compact form or the dense array.
+"""
+from pathlib import Path
+import json
+import os
+import numpy as np
+
+COMPACT_SUFFIX = ".npz"
+LCI_COMPACT_FILENAME = "lci_compact.json"
+
+
+class CompactArray(object):
+    """2-D array stored as its rows with at least one non-zero value
+
+    Parameters
+    -----------
+    rows : array-like
+        Sorted indices of the stored rows in the dense array
+    values : numpy.ndarray
+        Values of the stored rows, one row per index in rows
+    shape : tuple
+        Shape of the dense array
+    """
+    def __init__(self, rows, values, shape):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.shape = tuple(int(i) for i in shape)
+        if self.values.shape != (len(self.rows), self.shape[1]):
+            raise ValueError("Values of shape {} do not match {} rows of an array of shape {}".format(
+                self.values.shape, len(self.rows), self.shape))
+
+    @classmethod
+    def from_dense(cls, arr):
+        """Return the compact form of a dense 2-D array"""
+        arr = np.asarray(arr)
+        rows = np.flatnonzero((arr != 0).any(axis=1))
+        return cls(rows, arr[rows], arr.shape)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def to_dense(self):
+        """Return the dense array"""
+        arr = np.zeros(self.shape, dtype=self.dtype)
+        arr[self.rows] = self.values
+        return arr
+
+    def locate(self, indices):
+        """Return positions in ``values`` of row indices of the dense array, -1 for rows not stored"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if not len(self.rows):
+            return np.full(len(indices), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.rows, indices), len(self.rows) - 1)
+        return np.where(self.rows[positions] == indices, positions, -1)
+
+    def take(self, indices):
+        """Return rows of the dense array at given indices, as a dense array"""
+        positions = self.locate(indices)
+        arr = np.zeros((len(positions), self.shape[1]), dtype=self.dtype)
+        arr[positions >= 0] = self.values[positions[positions >= 0]]
+        return arr
+
+
+def save_compact_array(fp, arr):
+    """Save a dense array or CompactArray in compact form
+
+    The file is written under a temporary name and renamed, so that it is
+    never read incomplete.
+
+    Parameters
+    -----------
+    fp : str
+        Path of the file, usually with the ``.npz`` suffix
+    arr : numpy.ndarray or CompactArray
+        Array to save
+    """
+    fp = Path(fp)
+    if not isinstance(arr, CompactArray):
+        arr = CompactArray.from_dense(arr)
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, os.getpid()))
+    with open(temp_fp, "wb") as f:
+        np.savez(f, rows=arr.rows, values=arr.values, shape=np.array(arr.shape))
+    os.replace(str(temp_fp), str(fp))
+
+
+def load_compact_array(fp):
+    """Return the CompactArray saved in a file by save_compact_array"""
+    with np.load(str(fp)) as data:
+        return CompactArray(data['rows'], data['values'], data['shape'])
+
+
+def _get_lci_compact_fp(g_samples_dir):
+    g_samples_dir = Path(g_samples_dir)
+    return g_samples_dir.parent.parent / "LCI_metadata" / g_samples_dir.name / LCI_COMPACT_FILENAME
+
+
+def save_lci_compact(g_samples_dir, compact=True):
+    """Record whether LCI arrays of a samples batch are saved in compact form
+
+    Records ``LCI_metadata/<samples_batch>/lci_compact.json``. LCI
+    calculators of the samples batch, on any node, then save compact
+    ``.npz`` files. If compact is False, the record is removed.
+    """
+    fp = _get_lci_compact_fp(g_samples_dir)
+    if not compact:
+        if fp.is_file():
+            fp.unlink()
+        return
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, os.getpid()))
+    with open(temp_fp, "w") as f:
+        json.dump({'compact': True}, f)
+    os.replace(str(temp_fp), str(fp))
+
+
+def load_lci_compact(g_samples_dir):
+    """Return True if LCI arrays of a samples batch are saved in compact form"""
+    return _get_lci_compact_fp(g_samples_dir).is_file()
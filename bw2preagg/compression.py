@@ -0,0 +1,309 @@
+""" Compressed storage of LCI and LCIA arrays
+
+Most rows of LCI arrays, i.e. elementary flows, are exactly zero, and dense
+arrays of full databases add up to terabytes. Arrays can instead be saved
+compressed in ``<act_code>.npc`` files, next to where ``<act_code>.npy``
+files would be. Arrays are split in chunks of rows, each compressed
+separately, so that a subset of rows (e.g. the elementary flows with a
+characterization factor) can be read without decompressing the others.
+The bytes of each chunk are shuffled (bytes of same significance grouped
+together) before compression, which greatly improves the compression of
+floats.
+
+An ``.npc`` file starts with ``MAGIC``, followed by the length of a JSON
+header (4 bytes, little-endian) and the header, which gives the codec, its
+options, the dtype, shape, number of rows per chunk and compressed size of
+each chunk, then the compressed chunks.
+
+Codecs other than "zlib" (standard library) require optional dependencies:
+``blosc``, ``zstandard`` or ``lz4``.
+"""
+from pathlib import Path
+import json
+import os
+import struct
+import zlib
+import numpy as np
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+MAGIC = b"BW2PANPC"
+COMPRESSED_SUFFIX = ".npc"
+LCI_CODEC_FILENAME = "lci_codec.json"
+
+
+def _shuffle(data, itemsize):
+    """Group bytes of same significance of all items together"""
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(data, itemsize):
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+class Codec(object):
+    """Compression codec with byte-shuffle
+
+    Parameters
+    -----------
+    level : int, default=None
+        Compression level, codec default if None
+    shuffle : bool, default=True
+        If True, bytes are shuffled before compression
+    """
+    name = None
+    available = False
+    default_level = None
+
+    def __init__(self, level=None, shuffle=True):
+        if not self.available:
+            raise ValueError("Codec {} is not installed".format(self.name))
+        self.level = self.default_level if level is None else level
+        self.shuffle = shuffle
+
+    @property
+    def options(self):
+        """Options recorded in file headers"""
+        return {'level': self.level, 'shuffle': self.shuffle}
+
+    def compress(self, data, itemsize):
+        if self.shuffle and itemsize > 1:
+            data = _shuffle(data, itemsize)
+        return self._compress(data)
+
+    def decompress(self, data, itemsize):
+        data = self._decompress(data)
+        if self.shuffle and itemsize > 1:
+            data = _unshuffle(data, itemsize)
+        return data
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    available = True
+    default_level = 6
+
+    def _compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def _decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    available = zstandard is not None
+    default_level = 3
+
+    def _compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def _decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    available = lz4_frame is not None
+    default_level = 0
+
+    def _compress(self, data):
+        return lz4_frame.compress(data, compression_level=self.level)
+
+    def _decompress(self, data):
+        return lz4_frame.decompress(data)
+
+
+class BloscCodec(Codec):
+    """Blosc, which shuffles bytes itself, with compressor ``cname`` (e.g. "lz4", "zstd")"""
+    name = "blosc"
+    available = blosc is not None
+    default_level = 5
+
+    def __init__(self, level=None, shuffle=True, cname="lz4"):
+        super(BloscCodec, self).__init__(level, shuffle)
+        self.cname = cname
+
+    @property
+    def options(self):
+        return dict(super(BloscCodec, self).options, cname=self.cname)
+
+    def compress(self, data, itemsize):
+        return blosc.compress(
+            data, typesize=itemsize, clevel=self.level, cname=self.cname,
+            shuffle=blosc.SHUFFLE if self.shuffle else blosc.NOSHUFFLE)
+
+    def decompress(self, data, itemsize):
+        return blosc.decompress(data)
+
+
+CODECS = {codec.name: codec for codec in [ZlibCodec, ZstdCodec, Lz4Codec, BloscCodec]}
+
+
+def available_codecs():
+    """Return names of the codecs installed"""
+    return [name for name, codec in CODECS.items() if codec.available]
+
+
+def get_codec(name, **options):
+    """Return an instance of codec ``name`` created with ``options``"""
+    if name not in CODECS:
+        raise ValueError("Codec {} not valid, choose from {}".format(name, list(CODECS)))
+    return CODECS[name](**options)
+
+
+def save_compressed_array(fp, arr, codec, rows_per_chunk=256):
+    """Save an array compressed with codec, chunked along its first axis
+
+    The file is written under a temporary name and renamed, so that it is
+    never read incomplete.
+
+    Parameters
+    -----------
+    fp : str
+        Path of the file, usually with the ``.npc`` suffix
+    arr : numpy.ndarray
+        Array to save
+    codec : Codec
+        Codec, see ``get_codec``
+    rows_per_chunk : int, default=256
+        Number of rows (elements of the first axis) per compressed chunk
+    """
+    fp = Path(fp)
+    arr = np.ascontiguousarray(arr)
+    chunks = [
+        codec.compress(arr[first:first + rows_per_chunk].tobytes(), arr.dtype.itemsize)
+        for first in range(0, max(arr.shape[0], 1), rows_per_chunk)
+    ]
+    header = json.dumps({
+        'codec': codec.name,
+        'options': codec.options,
+        'dtype': arr.dtype.str,
+        'shape': list(arr.shape),
+        'rows_per_chunk': rows_per_chunk,
+        'chunk_sizes': [len(chunk) for chunk in chunks],
+    }).encode()
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, os.getpid()))
+    with open(temp_fp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(str(temp_fp), str(fp))
+
+
+def read_compressed_header(f):
+    """Return the header of an open .npc file, leaving the file at the first chunk"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("{} is not a compressed array file".format(f.name))
+    length, = struct.unpack("<I", f.read(4))
+    return json.loads(f.read(length).decode())
+
+
+def load_compressed_array(fp, rows=None):
+    """Load an array saved with save_compressed_array
+
+    Parameters
+    -----------
+    fp : str
+        Path of the file
+    rows : array-like, default=None
+        Indices along the first axis to return. Only the chunks with these
+        rows are decompressed, and only the returned rows are allocated.
+        If None, the whole array is returned.
+
+    Returns
+    --------
+    arr : numpy.ndarray
+    """
+    with open(fp, "rb") as f:
+        header = read_compressed_header(f)
+        options = dict(header['options'])
+        codec = get_codec(header['codec'], **options)
+        dtype = np.dtype(header['dtype'])
+        shape = tuple(header['shape'])
+        rows_per_chunk = header['rows_per_chunk']
+        offsets = np.concatenate([[f.tell()], f.tell() + np.cumsum(header['chunk_sizes'])])
+        if rows is None:
+            arr = np.empty(shape, dtype=dtype)
+            for chunk_id, size in enumerate(header['chunk_sizes']):
+                f.seek(int(offsets[chunk_id]))
+                first = chunk_id * rows_per_chunk
+                arr[first:first + rows_per_chunk] = _read_chunk(f, codec, size, dtype, shape)
+            return arr
+        rows = np.asarray(rows, dtype=np.int64)
+        n_rows = shape[0] if shape else 1
+        flat_rows = rows.ravel()
+        if flat_rows.size and (flat_rows.min() < -n_rows or flat_rows.max() >= n_rows):
+            raise IndexError("Row index out of bounds for array with {} rows".format(n_rows))
+        flat_rows = np.where(flat_rows < 0, flat_rows + n_rows, flat_rows)
+        # Only the selected rows are allocated, and only their chunks decompressed
+        arr = np.empty((flat_rows.size,) + shape[1:], dtype=dtype)
+        chunk_ids = flat_rows // rows_per_chunk
+        for chunk_id in np.unique(chunk_ids):
+            f.seek(int(offsets[chunk_id]))
+            block = _read_chunk(f, codec, header['chunk_sizes'][chunk_id], dtype, shape)
+            selected = np.flatnonzero(chunk_ids == chunk_id)
+            arr[selected] = block[flat_rows[selected] - chunk_id * rows_per_chunk]
+    return arr.reshape(rows.shape + shape[1:])
+
+
+def _read_chunk(f, codec, size, dtype, shape):
+    """Read and decompress the chunk at the current position of f"""
+    data = codec.decompress(f.read(size), dtype.itemsize)
+    return np.frombuffer(data, dtype=dtype).reshape((-1,) + shape[1:])
+
+
+def _get_lci_codec_fp(g_samples_dir):
+    g_samples_dir = Path(g_samples_dir)
+    return g_samples_dir.parent.parent / "LCI_metadata" / g_samples_dir.name / LCI_CODEC_FILENAME
+
+
+def save_lci_codec(g_samples_dir, codec=None, codec_options=None):
+    """Record the codec used to save the LCI arrays of a samples batch
+
+    Records ``LCI_metadata/<samples_batch>/lci_codec.json``. LCI calculators
+    of the samples batch, on any node, then save LCI arrays compressed. If
+    codec is None, the record is removed and arrays are saved as .npy
+    files.
+    """
+    fp = _get_lci_codec_fp(g_samples_dir)
+    if codec is None:
+        if fp.is_file():
+            fp.unlink()
+        return
+    get_codec(codec, **(codec_options or {}))
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, os.getpid()))
+    with open(temp_fp, "w") as f:
+        json.dump({'codec': codec, 'options': codec_options or {}}, f)
+    os.replace(str(temp_fp), str(fp))
+
+
+def load_lci_codec_record(g_samples_dir):
+    """Return the codec record ``{'codec', 'options'}`` of a samples batch, or None"""
+    fp = _get_lci_codec_fp(g_samples_dir)
+    if not fp.is_file():
+        return None
+    with open(fp, "r") as f:
+        return json.load(f)
+
+
+def load_lci_codec(g_samples_dir):
+    """Return the codec recorded for the LCI arrays of a samples batch, or None"""
+    record = load_lci_codec_record(g_samples_dir)
+    if record is None:
+        return None
+    return get_codec(record['codec'], **record['options'])
@@ -3,23 +3,108 @@ import os
 from brightway2 import projects, methods, Method
 import pyprind
 from .utils import _check_project, _check_result_dir, _check_method
+from .lci_store import get_saved_lci_codes, load_saved_lci_array, open_saved_lci_array
 from pathlib import Path
 import json
 
 
+class ConcatenatedArray(object):
+    """Arrays of several samples batches presented as a single array, concatenated along columns
+
+    Unlike ``concat_arrays``, nothing is copied: the arrays of the samples
+    batches (parts), typically memory-mapped ``.npy`` files, are only read
+    when the concatenated array is indexed, and then only the requested rows
+    and columns. Rows (elementary flows) and columns (iterations of all
+    batches, in batch order) are indexed as with numpy arrays, e.g.
+    ``arr[5, 1000:2000]``, except that lists of rows and columns select all
+    their combinations (as ``numpy.ix_``). ``numpy.asarray(arr)`` reads the
+    whole array.
+
+    Parameters
+    -----------
+    parts : list
+        2-D arrays, e.g. memmaps, with the same number of rows, in batch order.
+        1-D arrays (e.g. per exchange LCIA arrays) are taken as one row.
+    """
+    ndim = 2
+
+    def __init__(self, parts):
+        if not parts:
+            raise ValueError("No arrays to concatenate")
+        parts = [part.reshape(1, -1) if part.ndim == 1 else part for part in parts]
+        if len(set(part.shape[0] for part in parts)) > 1:
+            raise ValueError("Arrays don't all have the same number of rows: {}".format(
+                [part.shape for part in parts]))
+        self.parts = list(parts)
+        self.offsets = np.concatenate([[0], np.cumsum([part.shape[1] for part in parts])]).astype(np.int64)
+        self.shape = (parts[0].shape[0], int(self.offsets[-1]))
+        self.dtype = np.result_type(*[part.dtype for part in parts])
+
+    @classmethod
+    def from_directories(cls, sb_dirpaths, act_code):
+        """Return the concatenated arrays of an activity in samples_batch directories
+
+        Arrays are memory-mapped if possible, see ``open_saved_lci_array``.
+        """
+        return cls([open_saved_lci_array(dirpath, act_code) for dirpath in sb_dirpaths])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:, :]
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def _read_part(self, part_id, rows, cols):
+        """Return requested rows and columns of a part, reading only these values if it is memory-mapped"""
+        part = self.parts[part_id]
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            return np.asarray(part[rows, cols], dtype=self.dtype)
+        return np.asarray(part[np.ix_(np.asarray(rows), cols)], dtype=self.dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError("Too many indices for a 2-D array: {}".format(key))
+        rows, cols = key
+        single_row = isinstance(rows, (int, np.integer))
+        single_col = isinstance(cols, (int, np.integer))
+        if single_row:
+            rows = [rows]
+        col_indices = np.arange(self.shape[1])[[cols] if single_col else cols]
+        # Requested columns, in order, split in runs within the same part
+        part_ids = np.searchsorted(self.offsets, col_indices, side='right') - 1
+        runs = np.split(np.arange(len(col_indices)), np.flatnonzero(np.diff(part_ids)) + 1)
+        pieces = []
+        for run in runs if len(col_indices) else []:
+            part_id = part_ids[run[0]]
+            local = col_indices[run] - self.offsets[part_id]
+            if len(local) == 1 or np.all(np.diff(local) == 1):
+                local = slice(int(local[0]), int(local[-1]) + 1)
+            pieces.append(self._read_part(part_id, rows, local))
+        if not pieces:
+            pieces.append(self._read_part(0, rows, slice(0, 0)))
+        arr = np.concatenate(pieces, axis=1)
+        if single_col:
+            arr = arr[:, 0]
+        return arr[0] if single_row else arr
+
+
 def concat_arrays(l):
     """Concatenate column-wise arrays in list
 
     Parameters
     ----------
     l : list
-        List of paths to ndarray
+        List of paths to ndarray. LCI arrays without file are read from the
+        LCI store of their directory.
 
     Returns
     -------
     Single concatenated array
     """
-    arrs = [np.load(str(arr)) for arr in l]
+    arrs = [load_saved_lci_array(Path(arr).parent, Path(arr).name[:-4]) for arr in l]
     if not len(set([arr.shape[0] for arr in arrs])):
         raise ValueError(
             "Arrays don't all have the same number of rows for act {}".format(
@@ -41,10 +126,7 @@ def find_common_act_codes(sb_dirpaths):
     -------
     common_act_codes, all_sb_dirs_equal
     """
-    available_act_codes = [
-        set([f[0:-4] for f in os.listdir(fp) if f[-4:] == '.npy'])
-        for fp in sb_dirpaths
-    ]
+    available_act_codes = [get_saved_lci_codes(fp) for fp in sb_dirpaths]
 
     common_act_codes = set.intersection(*available_act_codes)
     all_same = all([common_act_codes==avail_sb for avail_sb in available_act_codes])
@@ -0,0 +1,330 @@
+""" Expected cost of LCI calculations, used to schedule and balance work
+
+The time needed to calculate the LCI of an activity grows with the size of
+its supply chain, i.e. the number of activities it depends on directly or
+indirectly. Supply chain sizes are obtained from the sparsity pattern of the
+technosphere matrix saved in the common files.
+
+The cost model converts supply chain sizes to expected calculation times,
+using timings measured when calculating previous batches (see
+``lci_timings.jsonl`` in the LCI_metadata directories). It is saved in the
+common files so that all array tasks of a cluster job, which each select
+their slice of activities independently, compute the same partition.
+"""
+from pathlib import Path
+from math import ceil
+import heapq
+import json
+import os
+import numpy as np
+
+COST_MODEL_FILENAME = "lci_cost_model.json"
+
+
+def supply_chain_sizes(A, chunk_size=1000):
+    """Return the number of activities in the supply chain of every activity
+
+    The supply chain of an activity includes the activity itself and all
+    activities it depends on, directly or indirectly. Activities of a
+    strongly connected component share the same supply chain. Supply chains
+    are built one topological level at a time (see
+    ``get_block_triangular_ordering``) as bitsets, so that memory use is
+    (number of components) * (number of activities) / 8 bytes.
+
+    Parameters
+    -----------
+    A : scipy.sparse matrix
+        Technosphere matrix (products x activities)
+    chunk_size : int, default=1000
+        Number of components for which bitsets are counted at once
+
+    Returns
+    --------
+    sizes : numpy.ndarray
+        Supply chain size, per column of A
+    """
+    # Imported here so that reading the saved model does not import SciPy and bw2data
+    from .solvers import get_block_triangular_ordering
+    ordering = get_block_triangular_ordering(A)
+    order, block_ptr = ordering['order'], ordering['block_ptr']
+    n = len(order)
+    labels = np.empty(n, dtype=np.int64)
+    labels[order] = np.repeat(np.arange(len(block_ptr) - 1), np.diff(block_ptr))
+    # Activity of column k uses the product matched to activity of row j if M[j, k] != 0
+    M = A.tocsr()[ordering['row_for_col']].tocoo()
+    between = labels[M.row] != labels[M.col]
+    dependent, dependency = labels[M.col][between], labels[M.row][between]
+    sort = np.lexsort((dependency, dependent))
+    dependent, dependency = dependent[sort], dependency[sort]
+    dependency_ptr = np.searchsorted(dependent, np.arange(len(block_ptr)))
+
+    # Components are numbered in topological order of the substitution: the
+    # suppliers of a component always come after it
+    reach = np.zeros((len(block_ptr) - 1, (n + 7) // 8), dtype=np.uint8)
+    for block in reversed(range(len(block_ptr) - 1)):
+        members = np.zeros(n, dtype=bool)
+        members[order[block_ptr[block]:block_ptr[block + 1]]] = True
+        reach[block] = np.packbits(members)
+        dependencies = dependency[dependency_ptr[block]:dependency_ptr[block + 1]]
+        if len(dependencies):
+            reach[block] |= np.bitwise_or.reduce(reach[np.unique(dependencies)], axis=0)
+    block_sizes = np.zeros(len(block_ptr) - 1, dtype=np.int64)
+    for start in range(0, len(block_sizes), chunk_size):
+        block_sizes[start:start + chunk_size] = np.unpackbits(
+            reach[start:start + chunk_size], axis=1, count=n).sum(axis=1)
+    return block_sizes[labels]
+
+
+def expected_lci_costs(result_dir, activity_codes):
+    """Return expected relative cost of the LCI calculation of activities
+
+    The saved cost model is used if there is one (see save_lci_cost_model),
+    otherwise costs are supply chain sizes.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    activity_codes : list
+        Codes of the activities
+
+    Returns
+    --------
+    costs : dict
+        Expected cost per activity code
+    """
+    model = load_lci_cost_model(result_dir)
+    if model is None:
+        model = build_lci_cost_model(result_dir, use_timings=False)
+    return _get_costs(model, activity_codes)
+
+
+def _get_costs(model, activity_codes):
+    """Return the cost of activity_codes in model, the mean cost for activities missing from it"""
+    costs = model['costs']
+    mean_cost = sum(costs.values()) / len(costs) if costs else 1.
+    return {code: costs.get(code, mean_cost) for code in activity_codes}
+
+
+def _supply_chain_sizes_per_code(result_dir):
+    """Return supply chain size per activity code"""
+    from .matrix_builder import _load_common_file
+    common_files_dir = Path(result_dir) / "common_files"
+    activity_dict = _load_common_file(common_files_dir, "activity_dict.pickle")
+    A = _load_common_file(common_files_dir, "A_as_coo_scipy.pickle")
+    sizes = supply_chain_sizes(A)
+    return {key[1]: float(sizes[col]) for key, col in activity_dict.items()}
+
+
+def _load_lci_timings(result_dir, engine):
+    """Return timings of previous LCI calculations with the given engine
+
+    Returns
+    --------
+    timings : list of tuples
+        (activity codes, seconds per activity), one per task
+    """
+    timings = []
+    metadata_dir = Path(result_dir) / "probabilistic" / "LCI_metadata"
+    for fp in sorted(metadata_dir.glob("*/lci_timings.jsonl")):
+        with open(fp) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line of a file being written
+                    continue
+                if record['engine'] == engine:
+                    timings.append((record['activities'], record['seconds_per_activity']))
+    return timings
+
+
+def build_lci_cost_model(result_dir, engine="activity", use_timings=True):
+    """Return the expected calculation time of LCI arrays, for all activities
+
+    Without timings, costs are supply chain sizes (relative units). With
+    timings of previous batches, the time of a task of activities is modelled
+    as intercept * (number of activities) + slope * (sum of their supply chain
+    sizes), fitted by least squares, and activities calculated alone in a
+    task are given their mean measured time.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    engine : str, default="activity"
+        LCI engine whose timings are used
+    use_timings : bool, default=True
+        If False, timings of previous batches are ignored
+
+    Returns
+    --------
+    model : dict
+        "costs": expected cost per activity code, "units": "seconds" or
+        "relative", "engine", "intercept", "slope" and "number_of_timings"
+    """
+    sizes = _supply_chain_sizes_per_code(result_dir)
+    timings = _load_lci_timings(result_dir, engine) if use_timings else []
+    timings = [(codes, seconds) for codes, seconds in timings if all(c in sizes for c in codes)]
+    model = {
+        'engine': engine, 'units': "relative", 'intercept': 0., 'slope': 1.,
+        'number_of_timings': len(timings),
+    }
+    if timings:
+        X = np.array([[len(codes), sum(sizes[c] for c in codes)] for codes, _ in timings])
+        y = np.array([seconds * len(codes) for codes, seconds in timings])
+        intercept, slope = np.linalg.lstsq(X, y, rcond=None)[0]
+        if np.linalg.matrix_rank(X) < 2 or intercept < 0 or slope <= 0:
+            # Not enough variation to fit both terms: time proportional to size
+            intercept, slope = 0., y.sum() / X[:, 1].sum()
+        model.update(units="seconds", intercept=float(intercept), slope=float(slope))
+    costs = {code: model['intercept'] + model['slope'] * size for code, size in sizes.items()}
+    measured = {}
+    for codes, seconds in timings:
+        if len(codes) == 1:
+            measured.setdefault(codes[0], []).append(seconds)
+    costs.update({code: float(np.mean(values)) for code, values in measured.items()})
+    model['costs'] = costs
+    return model
+
+
+def save_lci_cost_model(result_dir, engine="activity", use_timings=True):
+    """Build the LCI cost model and save it in the common files
+
+    Should be run before submitting array jobs with number_of_slices, and
+    after a batch is completed to refine the model with its timings. The
+    file is replaced atomically.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    engine : str, default="activity"
+        LCI engine whose timings are used
+    use_timings : bool, default=True
+        If False, timings of previous batches are ignored
+
+    Returns
+    --------
+    model : dict
+        See build_lci_cost_model
+    """
+    model = build_lci_cost_model(result_dir, engine, use_timings)
+    fp = Path(result_dir) / "common_files" / COST_MODEL_FILENAME
+    temp_fp = fp.with_name("{}.{}".format(fp.name, os.getpid()))
+    with open(temp_fp, "w") as f:
+        json.dump(model, f, indent=2)
+    os.replace(str(temp_fp), str(fp))
+    if model['units'] == "seconds":
+        print("LCI cost model fitted on {} timings: {:.3g} s + {:.3g} s per activity in supply chain".format(
+            model['number_of_timings'], model['intercept'], model['slope']))
+    return model
+
+
+def load_lci_cost_model(result_dir):
+    """Return the saved LCI cost model, or None if there is none"""
+    fp = Path(result_dir) / "common_files" / COST_MODEL_FILENAME
+    if not fp.is_file():
+        return None
+    with open(fp) as f:
+        return json.load(f)
+
+
+def cost_balanced_slices(activity_codes, costs, number_of_slices):
+    """Split activities in slices of roughly equal total cost
+
+    Activities are assigned from most to least expensive, each to the slice
+    with the lowest total cost so far (longest processing time first). Ties
+    are broken by position in activity_codes, so that the partition only
+    depends on the arguments.
+
+    Parameters
+    -----------
+    activity_codes : list
+        Codes of the activities
+    costs : dict
+        Expected cost per activity code
+    number_of_slices : int
+        Number of slices
+
+    Returns
+    --------
+    slices : list of lists
+        Activity codes of each slice, in the order of activity_codes
+    """
+    position = {code: i for i, code in enumerate(activity_codes)}
+    loads = [(0., slice_id) for slice_id in range(number_of_slices)]
+    assigned = [[] for _ in range(number_of_slices)]
+    for code in sorted(activity_codes, key=lambda code: (-costs[code], position[code])):
+        load, slice_id = heapq.heappop(loads)
+        assigned[slice_id].append(code)
+        heapq.heappush(loads, (load + costs[code], slice_id))
+    return [sorted(codes, key=position.get) for codes in assigned]
+
+
+def get_slices(result_dir, number_of_slices, balance_slices=False, save_model=True):
+    """Return the codes of activities in every slice
+
+    By default, ordered_activity_codes.json is split in contiguous slices of
+    equal number of activities. With balance_slices, slices have roughly
+    equal expected calculation time according to the saved cost model,
+    activities missing from the model being given its mean cost. If there is
+    no saved model, one is built from supply chain sizes, and saved if
+    save_model is True.
+
+    All workers of a samples batch must use the same balance_slices, and the
+    cost model must not change while they run, or slices overlap or miss
+    activities.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    number_of_slices : int
+        Number of slices
+    balance_slices : bool, default=False
+        If True, slices have roughly equal expected calculation time
+    save_model : bool, default=True
+        If False, a missing cost model is not saved
+
+    Returns
+    --------
+    slices : list of lists
+    """
+    with open(Path(result_dir) / "common_files" / "ordered_activity_codes.json", 'r') as f:
+        all_activity_codes = json.load(f)
+    if not balance_slices:
+        size = ceil(len(all_activity_codes) / number_of_slices)
+        return [all_activity_codes[i * size:(i + 1) * size] for i in range(number_of_slices)]
+    model = load_lci_cost_model(result_dir)
+    if model is None and save_model:
+        # Deterministic, so identical in all array tasks doing this concurrently
+        model = save_lci_cost_model(result_dir, use_timings=False)
+    elif model is None:
+        model = build_lci_cost_model(result_dir, use_timings=False)
+    return cost_balanced_slices(all_activity_codes, _get_costs(model, all_activity_codes), number_of_slices)
+
+
+def get_slice_activity_codes(result_dir, slice_id, number_of_slices, balance_slices=False):
+    """Return the codes of activities in a slice
+
+    See get_slices.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    slice_id : int
+        Id of the slice, from 0 to number_of_slices - 1
+    number_of_slices : int
+        Number of slices
+    balance_slices : bool, default=False
+        If True, slices have roughly equal expected calculation time
+
+    Returns
+    --------
+    activity_codes : list
+    """
+    if not 0 <= slice_id < number_of_slices:
+        raise ValueError("slice_id should be between 0 and {}, got {}".format(number_of_slices - 1, slice_id))
+    return get_slices(result_dir, number_of_slices, balance_slices)[slice_id]
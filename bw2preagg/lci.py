@@ -1,6 +1,20 @@
 from brightway2 import *
 from .utils import _check_project, _check_database, _check_result_dir, \
-    missing_useful_files, _get_campaign, get_ref_bio_dict_from_common_files, _get_lci_dir
+    missing_useful_files, _get_campaign, get_ref_bio_dict_from_common_files, _get_lci_dir, \
+    _get_lci_metadata_dir, _get_memory_usage
+from .lcia import get_flow_indices_for_methods
+from .matrix_builder import CampaignMatrixBuilder
+from .solvers import get_solver, available_direct_solvers, SOLVER_BACKEND_FILENAME
+from .scheduler import order_activities, run_work_queue, print_work_queue_report
+from .cost_model import expected_lci_costs, get_slice_activity_codes
+from .leases import get_lease_dir, try_claim, is_block_done, mark_block_done, LeaseLost
+from .ledger import record_lci_array, get_completed_lci_codes, record_unverified_lci_arrays
+from .lci_store import LCIStore, create_lci_store, get_saved_lci_codes
+from .compression import save_lci_codec, load_lci_codec, load_lci_codec_record, save_compressed_array, \
+    COMPRESSED_SUFFIX
+from .compact import save_lci_compact, load_lci_compact, save_compact_array, COMPACT_SUFFIX
+from .catalog import record_artifact
+from .profiling import PhaseTimer, PHASE_TIMINGS_DIRNAME
 
 import numpy as np
 import os
@@ -9,15 +23,28 @@ import multiprocessing as mp
 from pathlib import Path
 from math import ceil
 import json
+import platform
 import presamples
+from scipy import sparse
 
 
 def calculate_lci_array(database_name, act_code, presamples_paths, g_dimensions,
-                        total_iterations, g_samples_dir):
+                        total_iterations, g_samples_dir, checkpoint_every=50, timer=None, lease=None):
     """Return LCI array using specified presamples for given activity
 
     Typically invoked from generate_LCI_samples.set_up_lci_calculations
 
+    Results are written in a temporary memmap in ``g_samples_dir/temp``,
+    a .npy file with its header, renamed to its final location once all
+    iterations are calculated (see ``_finalize_lci_array``).
+    Every ``checkpoint_every`` iterations, the memmap is flushed and a
+    progress record (``<act_code>.progress.json``) is saved next to it. If
+    the calculation is interrupted (e.g. a job reaching its walltime), the
+    next call reopens the partial memmap and continues from the first
+    unfinished iteration. The presamples indices are advanced as they would
+    have been in an uninterrupted run, so that iteration ``i`` still uses
+    the samples of column ``i``.
+
     Parameters
     --------------
     database_name : str
@@ -32,41 +59,467 @@ def calculate_lci_array(database_name, act_code, presamples_paths, g_dimensions,
         Number of iterations (i.e. number of columns in presample arrays)
     g_samples_dir : str
         Path to directory where LCI arrays will be saved
+    checkpoint_every : int, default=50
+        Number of iterations between progress records
+    timer : PhaseTimer, default=None
+        If specified, time spent in each phase is recorded (see ``profiling``)
+    lease : Lease, default=None
+        Lease on the block of work being calculated (see ``leases``). If it
+        is lost, the calculation is abandoned, raising LeaseLost, before
+        writing any further result.
 
     Returns
     ---------
     None
     """
-
-    lci = np.memmap(
-        filename=str(g_samples_dir / "temp" / "{}.npy".format(act_code)),
-        dtype="float32",
-        mode='w+',
-        shape=(g_dimensions, total_iterations)
-    )
+    timer = timer or PhaseTimer()
+    t0 = time.time()
+    g_samples_dir = Path(g_samples_dir)
+    first_iteration = _read_lci_progress(g_samples_dir, act_code, g_dimensions, total_iterations)
+    temp_fp = g_samples_dir / "temp" / "{}.npy".format(act_code)
+    if not first_iteration:
+        _create_lci_temp_file(temp_fp, g_dimensions, total_iterations, overwrite=True)
+    lci = np.load(str(temp_fp), mmap_mode='r+')
     act = get_activity((database_name, act_code))
-    mc = MonteCarloLCA({act: act['production amount']}, presamples=presamples_paths)
-    for i in range(total_iterations):
+    with timer.phase("presamples_loading"):
+        mc = MonteCarloLCA({act: act['production amount']}, presamples=presamples_paths)
+        if first_iteration:
+            print("Resuming {} at iteration {}".format(act_code, first_iteration))
+            mc.load_data()
+            for _ in range(first_iteration):
+                mc.presamples.update_package_indices()
+    for i in range(first_iteration, total_iterations):
         try:
-            next(mc)
-            this_g = np.squeeze(np.array(mc.inventory.sum(axis=1)))
+            if timer.enabled:
+                _next_lci_timed(mc, timer)
+            else:
+                next(mc)
+            with timer.phase("inventory"):
+                this_g = np.squeeze(np.array(mc.inventory.sum(axis=1)))
             assert this_g.size == g_dimensions
-            lci[:, i] = this_g
+            if lease is not None:
+                lease.check()
+            with timer.phase("memmap_write"):
+                lci[:, i] = this_g
+        except LeaseLost:
+            raise
         except Exception as err:
             print("***********************\nactivity {} problem with iteration {}:{}".format(
                 act_code, i, err)
             )
             lci[:, i] = np.full(g_dimensions, np.nan).ravel()
-    lci_as_arr = np.array(lci)
-    assert lci_as_arr.shape == (g_dimensions, total_iterations), "Dimension not ok: {}".format(lci_as_arr.shape)
+        if (i + 1) % checkpoint_every == 0 and i + 1 < total_iterations:
+            with timer.phase("memmap_write"):
+                lci.flush()
+                _write_lci_progress(g_samples_dir, act_code, i + 1, g_dimensions, total_iterations)
+        timer.iteration_done(activity=act_code, iteration=i)
+    del lci
+    if lease is not None:
+        lease.check()
+    with timer.phase("final_save"):
+        _finalize_lci_array(g_samples_dir, act_code, g_dimensions, total_iterations, time.time() - t0)
+    timer.flush(activity=act_code)
+
+
+def _next_lci_timed(mc, timer):
+    """Same as next(mc) for a MonteCarloLCA without LCIA, timing each step"""
+    if not hasattr(mc, "tech_rng"):
+        with timer.phase("presamples_loading"):
+            mc.load_data()
+    with timer.phase("matrix_rebuild"):
+        mc.rebuild_technosphere_matrix(mc.tech_rng.next())
+        mc.rebuild_biosphere_matrix(mc.bio_rng.next())
+        if mc.presamples:
+            mc.presamples.update_matrices()
+        if not hasattr(mc, "demand_array"):
+            mc.build_demand_array()
+    with timer.phase("factorize_and_solve"):
+        mc.supply_array = mc.solve_linear_system()
+    with timer.phase("inventory"):
+        count = len(mc.activity_dict)
+        mc.inventory = mc.biosphere_matrix * sparse.spdiags([mc.supply_array], [0], count, count)
+
+
+def _read_lci_progress(g_samples_dir, act_code, g_dimensions, total_iterations):
+    """Return number of iterations already in the temporary LCI memmap of an activity
+
+    Returns 0 if there is no progress record, or if the record or the
+    header of the temporary memmap do not match the expected array
+    dimensions.
+    """
+    temp_dir = Path(g_samples_dir) / "temp"
+    progress_fp = temp_dir / "{}.progress.json".format(act_code)
+    temp_fp = temp_dir / "{}.npy".format(act_code)
+    if not progress_fp.is_file() or not temp_fp.is_file():
+        return 0
+    try:
+        with open(progress_fp, "r") as f:
+            progress = json.load(f)
+    except ValueError:
+        return 0
+    if progress['shape'] != [g_dimensions, total_iterations]:
+        return 0
+    try:
+        lci = np.load(str(temp_fp), mmap_mode='r')
+    except (ValueError, OSError):
+        return 0
+    if lci.shape != (g_dimensions, total_iterations) or lci.dtype != np.float32:
+        return 0
+    return progress['completed_iterations']
+
+
+def _write_lci_progress(g_samples_dir, act_code, completed_iterations, g_dimensions, total_iterations):
+    """Record that the first completed_iterations columns of the temporary LCI memmap are done"""
+    temp_dir = Path(g_samples_dir) / "temp"
+    progress_fp = temp_dir / "{}.progress.json".format(act_code)
+    partial_fp = temp_dir / "{}.progress.json.part".format(act_code)
+    with open(partial_fp, "w") as f:
+        json.dump({
+            'completed_iterations': int(completed_iterations),
+            'shape': [g_dimensions, total_iterations],
+        }, f)
+    os.replace(str(partial_fp), str(progress_fp))
+
+
+def _finalize_lci_array(g_samples_dir, act_code, g_dimensions, total_iterations, seconds=None):
+    """Move a completed temporary LCI memmap to its final location and record it
+
+    The array is recorded in the ledger, and in the catalog of the
+    result_dir if there is one (see ``catalog``), with the calculation time
+    in seconds if given.
+
+    The final location is the LCI store of the samples batch if there is
+    one (see ``lci_store``), else a compact ``<act_code>.npz`` file if
+    compact storage is recorded for the samples batch (see ``compact``),
+    else a compressed ``<act_code>.npc`` file if a codec is recorded (see
+    ``compression``), else a ``<act_code>.npy`` file.
+
+    The temporary memmap already is a .npy file, so that in the latter case
+    it is renamed, atomically, rather than copied: readers never see a
+    partially written array, and the array is never loaded in memory.
+    """
+    g_samples_dir = Path(g_samples_dir)
+    temp_fp = g_samples_dir / "temp" / "{}.npy".format(act_code)
+    lci = np.load(str(temp_fp), mmap_mode='r')
+    assert lci.shape == (g_dimensions, total_iterations), "Dimension not ok: {}".format(lci.shape)
+    store = LCIStore.open(g_samples_dir)
+    codec = load_lci_codec(g_samples_dir)
+    if store is not None:
+        store.write(act_code, lci)
+        final_fp = store.store_dir
+    elif load_lci_compact(g_samples_dir):
+        final_fp = g_samples_dir / "{}{}".format(act_code, COMPACT_SUFFIX)
+        save_compact_array(final_fp, lci)
+    elif codec is not None:
+        final_fp = g_samples_dir / "{}{}".format(act_code, COMPRESSED_SUFFIX)
+        save_compressed_array(final_fp, lci, codec)
+    else:
+        del lci
+        final_fp = g_samples_dir / "{}.npy".format(act_code)
+        os.replace(str(temp_fp), str(final_fp))
+        lci = np.load(str(final_fp), mmap_mode='r')
+    record = record_lci_array(g_samples_dir, act_code, lci)
+    del lci
+    record_artifact(g_samples_dir.parents[2], "LCI", act_code, final_fp, int(g_samples_dir.name),
+                    summary=record, seconds=seconds, fmt="store" if store is not None else None,
+                    nbytes=g_dimensions * total_iterations * 4 if store is not None else None)
+    if temp_fp.is_file():
+        temp_fp.unlink()
+    progress_fp = temp_fp.parent / "{}.progress.json".format(act_code)
+    if progress_fp.is_file():
+        progress_fp.unlink()
+
+
+def _write_lci_columns(g_samples_dir, act_code, values, first_column, g_dimensions, total_iterations,
+                       rows=None):
+    """Write a block of consecutive columns in the temporary LCI memmap of an activity
+
+    If rows is not None, values only contains the given rows of the LCI array.
+    """
+    temp_fp = Path(g_samples_dir) / "temp" / "{}.npy".format(act_code)
+    if not temp_fp.is_file():
+        _create_lci_temp_file(temp_fp, g_dimensions, total_iterations)
+    lci = np.load(str(temp_fp), mmap_mode='r+')
+    if rows is None:
+        lci[:, first_column:first_column + values.shape[1]] = values
+    else:
+        lci[rows, first_column:first_column + values.shape[1]] = values
+    lci.flush()
+    del lci
+
+
+def _create_lci_temp_file(temp_fp, g_dimensions, total_iterations, overwrite=False):
+    """Create a zero-filled temporary LCI memmap, a float32 .npy file
+
+    The file is created under a unique name and linked to temp_fp, so that
+    processes calculating different iterations of the same activity never
+    truncate each other's results. If overwrite, an existing temp_fp is
+    replaced instead.
+    """
+    partial_fp = temp_fp.with_name("{}.{}.part".format(temp_fp.name, os.getpid()))
+    lci = np.lib.format.open_memmap(
+        str(partial_fp), mode='w+', dtype=np.float32, shape=(g_dimensions, total_iterations))
     del lci
-    (Path(g_samples_dir) / "temp" / "{}.npy".format(act_code)).unlink()
-    np.save(str(g_samples_dir / "{}.npy".format(act_code)), lci_as_arr)
-    lci_as_arr = None  # Explicitly free up memory
+    if overwrite:
+        os.replace(str(partial_fp), str(temp_fp))
+        return
+    try:
+        os.link(str(partial_fp), str(temp_fp))
+    except FileExistsError:
+        pass
+    partial_fp.unlink()
+
+
+def _write_lci_residuals(g_samples_dir, act_code, values, first_column, total_iterations):
+    """Write residuals of consecutive iterations of an activity
+
+    Residuals are saved in ``residuals/<act_code>.npy`` next to the LCI
+    arrays, with one value per iteration (NaN if not calculated).
+    """
+    fp = Path(g_samples_dir) / "residuals" / "{}.npy".format(act_code)
+    if not fp.is_file():
+        fp.parent.mkdir(exist_ok=True)
+        partial_fp = fp.with_name("{}.{}.part".format(fp.name, os.getpid()))
+        residuals = np.lib.format.open_memmap(
+            str(partial_fp), mode='w+', dtype="float32", shape=(total_iterations,))
+        residuals[:] = np.nan
+        residuals.flush()
+        del residuals
+        try:
+            os.link(str(partial_fp), str(fp))
+        except FileExistsError:
+            pass
+        partial_fp.unlink()
+    residuals = np.load(str(fp), mmap_mode='r+')
+    residuals[first_column:first_column + len(values)] = values
+    residuals.flush()
+    del residuals
+
+
+def calculate_lci_arrays_per_iteration(database_name, activity_list, matrix_builder,
+                                       g_dimensions, total_iterations, g_samples_dir,
+                                       flow_indices=None, mode="auto", iteration_range=None,
+                                       rhs_block_size=256, iterations_per_flush=50,
+                                       solver="direct", solver_options=None, finalize=True,
+                                       timer=None, lease=None):
+    """Calculate LCI arrays for many activities, iterating over iterations
+
+    Rather than solving one ``MonteCarloLCA`` per activity, the sampled
+    technosphere (A) and biosphere (B) matrices are updated once per iteration
+    directly from the presamples arrays (see ``CampaignMatrixBuilder``),
+    A is factorized once and the LCI of all activities in ``activity_list``
+    are obtained from that single factorization. Since the sparsity pattern
+    of A is the same for all iterations, the fill-reducing ordering is
+    computed only once, before the first iteration, and each iteration only
+    does the numeric factorization (see ``SuperLUSolver``).
+    Column ``i`` of each activity's LCI array is then filled with the results
+    of iteration ``i``.
+
+    Two solving modes are available. LCI arrays are columns of G = B.A^-1:
+
+    * "forward": A.s = f is solved for the demand vector f of every activity
+      (one solve per activity), and the LCI is B.s;
+    * "adjoint": A^T.x = b is solved for every requested elementary flow, with
+      b the corresponding row of B (one solve per elementary flow). x then
+      contains the value of that elementary flow for all activities.
+
+    With mode="auto", the mode requiring the fewest solves is used.
+
+    With solver="krylov", A is not factorized at every iteration: the LU
+    factorization of the deterministic A is used as a preconditioner for an
+    iterative solver, warm-started from the deterministic solution (see
+    ``PreconditionedKrylovSolver``). Iterations for which the iterative
+    solver did not converge are solved directly and reported in the summary.
+    With solver="block", only the cyclic blocks of A are factorized and the
+    rest is solved by substitution, using the block-triangular ordering
+    saved in the common files (see ``BlockTriangularSolver``).
+    With solver="series", LCI are approximated by a truncated power series
+    (see ``PowerSeriesSolver``), only in forward mode. The relative residual
+    achieved for each activity and iteration is then saved in
+    ``residuals/<act_code>.npy``, next to the LCI arrays.
+
+    Results are buffered in memory and written to the temporary LCI memmaps
+    every ``iterations_per_flush`` iterations. The resulting
+    ``<act_code>.npy`` files are identical in layout to those produced by
+    ``calculate_lci_array``. If ``flow_indices`` is specified, rows of
+    elementary flows that are not requested are left to 0.
+
+    Typically invoked from set_up_iteration_major_lci_calculations
+
+    Parameters
+    --------------
+    database_name : str
+        Name of the LCI database
+    activity_list : list
+        List of codes of activities for which LCI arrays should be calculated
+    matrix_builder : CampaignMatrixBuilder
+        Builder of sampled matrices for the presamples packages of the campaign
+    g_dimensions : int
+        Number of rows in biosphere matrix
+    total_iterations : int
+        Number of iterations (i.e. number of columns in presample arrays)
+    g_samples_dir : str
+        Path to directory where LCI arrays will be saved
+    flow_indices : list, default=None
+        Row indices (in bio_dict) of the elementary flows to calculate.
+        If None, all elementary flows are calculated.
+    mode : str, default="auto"
+        One of "forward", "adjoint" or "auto"
+    iteration_range : tuple, default=None
+        (first, last) iterations to calculate, last excluded. If None, all
+        iterations are calculated, and a progress record is saved next to
+        each temporary LCI memmap every time results are written: an
+        interrupted run then resumes from the first iteration not written
+        for all activities. LCI arrays are only moved from the temp
+        directory to their final location once the last iteration of the
+        batch has been calculated.
+    rhs_block_size : int, default=256
+        Maximum number of right-hand sides solved at once. Larger blocks are
+        faster but require n_products * rhs_block_size * 8 bytes of memory.
+    iterations_per_flush : int, default=50
+        Number of iterations held in memory before being written to the
+        temporary LCI memmaps. The buffer requires
+        len(activity_list) * len(flow_indices) * iterations_per_flush * 4 bytes.
+    solver : str, default="direct"
+        "direct" (sparse LU of every sampled A with the backend recorded by
+        ``select_solver_backend``), "superlu", "umfpack", "pardiso", "krylov"
+        "block" or "series"
+    solver_options : dict, default=None
+        Keyword arguments passed to the solver, e.g. {"method": "bicgstab",
+        "rtol": 1e-10, "warm_start": "previous"} for the "krylov" solver
+    finalize : bool, default=True
+        If False, LCI arrays are left in the temp directory even if the last
+        iteration was calculated, e.g. when other processes calculate other
+        iteration ranges of the same activities.
+    timer : PhaseTimer, default=None
+        If specified, time spent in each phase is recorded (see ``profiling``)
+    lease : Lease, default=None
+        Lease on the block of work being calculated (see ``leases``). If it
+        is lost, the calculation is abandoned, raising LeaseLost, before
+        writing the temporary LCI memmaps or saving the final arrays.
+
+    Returns
+    ---------
+    summary : dict
+        Run summary, with the time spent analyzing the sparsity pattern of A
+        ("analysis_time") and the time saved per iteration by reusing this
+        analysis ("time_saved_per_iteration"), in seconds, and the list
+        of iterations for which the "krylov" solver fell back to a direct
+        solve ("fallback_iterations"), as well as the name of the solver
+        used ("solver")
+    """
+    timer = timer or PhaseTimer()
+    g_samples_dir = Path(g_samples_dir)
+    acts = [get_activity((database_name, act_code)) for act_code in activity_list]
+    product_indices = np.array([matrix_builder.product_dict[act.key] for act in acts])
+    production_amounts = np.array([act.get('production amount', 1) for act in acts])
+    n_products = len(matrix_builder.product_dict)
+    flows = np.arange(g_dimensions) if flow_indices is None else np.asarray(flow_indices)
+    solver = get_solver(solver, matrix_builder.common_files_dir, **(solver_options or {}))
+    forward_only = getattr(solver, 'forward_only', False)
+    if mode == "auto":
+        mode = "adjoint" if len(flows) < len(acts) and not forward_only else "forward"
+    if mode not in ("forward", "adjoint"):
+        raise ValueError("LCI solving mode {} not valid".format(mode))
+    if mode == "adjoint" and forward_only:
+        raise ValueError("Solver {} can only be used in forward mode".format(solver.name))
+    if iteration_range is None:
+        # Resume from the progress records of an interrupted run, if any
+        first = min(
+            _read_lci_progress(g_samples_dir, act_code, g_dimensions, total_iterations)
+            for act_code in activity_list
+        )
+        last = total_iterations
+    else:
+        first, last = iteration_range
+    if not 0 <= first < last <= total_iterations:
+        raise ValueError("Iteration range {} not valid".format(iteration_range))
+
+    # Matrices of the builder hold deterministic values until the first update
+    with timer.phase("analysis"):
+        solver.analyze(matrix_builder.technosphere_matrix)
+    fallback_iterations = []
+
+    flush_size = max(1, min(iterations_per_flush, last - first))
+    buffer = np.zeros((len(acts), len(flows), flush_size), dtype="float32")
+    records_residuals = hasattr(solver, 'residuals')
+    if records_residuals:
+        residual_buffer = np.full((len(acts), flush_size), np.nan, dtype="float32")
+    first_column = first
+    for i in range(first, last):
+        col = i - first_column
+        try:
+            with timer.phase("matrix_rebuild"):
+                A, B = matrix_builder.update(i)
+                assert B.shape[0] == g_dimensions
+                if flow_indices is not None:
+                    B = B[flows]
+            with timer.phase("factorize"):
+                solver.factorize(A)
+            if mode == "forward":
+                for start in range(0, len(acts), rhs_block_size):
+                    stop = min(start + rhs_block_size, len(acts))
+                    demand = np.zeros((n_products, stop - start))
+                    demand[product_indices[start:stop], np.arange(stop - start)] = production_amounts[start:stop]
+                    with timer.phase("solve"):
+                        supply = solver.solve(demand)
+                    with timer.phase("inventory"):
+                        buffer[start:stop, :, col] = np.asarray(B @ supply).T
+                    if records_residuals:
+                        residual_buffer[start:stop, col] = solver.residuals
+            else:
+                for start in range(0, len(flows), rhs_block_size):
+                    stop = min(start + rhs_block_size, len(flows))
+                    with timer.phase("solve"):
+                        x = solver.solve(B[start:stop].T.toarray(), trans='T')
+                    with timer.phase("inventory"):
+                        buffer[:, start:stop, col] = x[product_indices] * production_amounts.reshape(-1, 1)
+            if getattr(solver, 'fell_back', False):
+                fallback_iterations.append(i)
+        except Exception as err:
+            print("***********************\niteration {} problem for {} activities:{}".format(
+                i, len(acts), err)
+            )
+            buffer[:, :, col] = np.nan
+            if records_residuals:
+                residual_buffer[:, col] = np.nan
+        if col == flush_size - 1 or i == last - 1:
+            if lease is not None:
+                lease.check()
+            with timer.phase("memmap_write"):
+                for act_i, act_code in enumerate(activity_list):
+                    _write_lci_columns(
+                        g_samples_dir, act_code, buffer[act_i, :, :col + 1],
+                        first_column, g_dimensions, total_iterations,
+                        rows=None if flow_indices is None else flows
+                    )
+                    if records_residuals:
+                        _write_lci_residuals(
+                            g_samples_dir, act_code, residual_buffer[act_i, :col + 1],
+                            first_column, total_iterations
+                        )
+                    if iteration_range is None and i + 1 < total_iterations:
+                        _write_lci_progress(g_samples_dir, act_code, i + 1, g_dimensions, total_iterations)
+            first_column = i + 1
+        timer.iteration_done(activities=len(activity_list), iteration=i)
+    buffer = None  # Explicitly free up memory
+    if finalize and last == total_iterations:
+        if lease is not None:
+            lease.check()
+        with timer.phase("final_save"):
+            for act_code in activity_list:
+                _finalize_lci_array(g_samples_dir, act_code, g_dimensions, total_iterations)
+    timer.flush(activities=len(activity_list), iterations=[first, last])
+    return {
+        'analysis_time': solver.analysis_time,
+        'time_saved_per_iteration': solver.time_saved_per_factorization,
+        'fallback_iterations': fallback_iterations,
+        'solver': solver.name,
+    }
 
 
 def set_up_lci_calculations(activity_list, result_dir, worker_id, database_name,
-                            samples_batch, project_name):
+                            samples_batch, project_name, profile_dir=None, profile_per_iteration=False):
     """Dispatch LCI calculation for a list of activities
 
     Parameters
@@ -85,40 +538,502 @@ def set_up_lci_calculations(activity_list, result_dir, worker_id, database_name,
         generating a seed for the RNG. The maximum value is 14.
     project_name : str
         Name of the brightway2 project where the database is imported
+    profile_dir : str, default=None
+        If specified, wall and CPU time per phase are appended to a JSON Lines
+        file of this directory, one record per phase and activity (see
+        ``profiling``)
+    profile_per_iteration : bool, default=False
+        If True, one record per phase and iteration is written instead
 
     Returns
     ---------
     None
+
+    Raises ValueError, after treating all activities, if the LCI array of
+    some activities could not be calculated.
     """
-    projects.set_current(_check_project(project_name))
+    timer = PhaseTimer.for_worker(profile_dir, worker_id, profile_per_iteration)
+    with timer.phase("project_switch"):
+        projects.set_current(_check_project(project_name))
     g_samples_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch, must_exist=False)
     g_samples_dir_temp = g_samples_dir / "temp"
     g_samples_dir_temp.mkdir(exist_ok=True, parents=True)
 
     ref_bio_dict = get_ref_bio_dict_from_common_files(Path(result_dir) / "common_files")
-    campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
-    presample_paths = [p for p in campaign]
-    assert presample_paths
-    pps = [presamples.PresamplesPackage(p) for p in presample_paths]
-    iterations = list(set([pp.ncols for pp in pps]))
+    with timer.phase("presamples_loading"):
+        campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+        presample_paths = [p for p in campaign]
+        assert presample_paths
+        pps = [presamples.PresamplesPackage(p) for p in presample_paths]
+        iterations = list(set([pp.ncols for pp in pps]))
+    timer.flush(worker=worker_id)
     assert len(iterations) == 1
     total_iterations = iterations[0]
     print("Worker ID {}, requested iterations: {}".format(worker_id, total_iterations))
 
     g_dimensions = len(ref_bio_dict)
-    times = []
+    times, failed = [], []
     for act_i, act_code in enumerate(activity_list):
         t0 = time.time()
         try:
             calculate_lci_array(
-                database_name, act_code, presample_paths, g_dimensions, total_iterations, g_samples_dir)
+                database_name, act_code, presample_paths, g_dimensions, total_iterations, g_samples_dir,
+                timer=timer)
             times.append(time.time() - t0)
         except Exception as err:
             print("************Failure for {} by {}: {}************".format(act_code, worker_id, err))
+            failed.append(act_code)
     print("Worker ID: {}\n\tTotal of {} LCIs of {} iterations"
           "\n\tTotal time: {} minutes\n\tAverage time: {} minutes per LCI".format(
-        worker_id, len(activity_list), total_iterations, sum(times) / 60, (sum(times) / len(times)) / 60
+        worker_id, len(times), total_iterations, sum(times) / 60,
+        (sum(times) / len(times)) / 60 if times else None
+    ))
+    if failed:
+        # The task is then reported as failed, and not used to fit the cost model
+        raise ValueError("LCI calculation failed for {} of {} activities: {}".format(
+            len(failed), len(activity_list), failed))
+
+
+def set_up_iteration_major_lci_calculations(activity_list, result_dir, worker_id, database_name,
+                                            samples_batch, project_name, flow_indices=None,
+                                            mode="auto", iteration_range=None,
+                                            solver="direct", solver_options=None,
+                                            shared_samples_dir=None, profile_dir=None,
+                                            profile_per_iteration=False):
+    """Calculate LCI arrays for a list of activities, one iteration at a time
+
+    Same as ``set_up_lci_calculations``, but uses
+    ``calculate_lci_arrays_per_iteration``, which factorizes the sampled
+    technosphere matrix once per iteration for all activities in
+    ``activity_list`` instead of once per iteration per activity.
+
+    Parameters
+    --------------
+    activity_list : list
+        List of codes to activities for which LCI arrays should be calculated
+    result_dir : str
+        Path to directory where results are stored
+    worker_id : int
+        Identification of the worker if using MultiProcessing, used only for
+        error messages.
+    database_name : str
+        Name of the LCI database
+    samples_batch : int
+        Integer id for sample batch. Used for campaigns names and for
+        generating a seed for the RNG. The maximum value is 14.
+    project_name : str
+        Name of the brightway2 project where the database is imported
+    flow_indices : list, default=None
+        Row indices (in bio_dict) of the elementary flows to calculate.
+        If None, all elementary flows are calculated.
+    mode : str, default="auto"
+        Solving mode, one of "forward", "adjoint" or "auto", see
+        ``calculate_lci_arrays_per_iteration``
+    iteration_range : tuple, default=None
+        (first, last) iterations to calculate, last excluded. If None, all
+        iterations are calculated.
+    solver : str, default="direct"
+        "direct", "superlu", "umfpack", "pardiso", "krylov", "block" or
+        "series", see ``calculate_lci_arrays_per_iteration``
+    solver_options : dict, default=None
+        Keyword arguments passed to the solver
+    shared_samples_dir : str, default=None
+        Directory with the samples of the campaign saved by
+        ``CampaignMatrixBuilder.save_shared_samples``. If specified, the
+        worker attaches to these memory-mapped samples instead of reading
+        the presamples packages, and reports its memory savings.
+    profile_dir : str, default=None
+        If specified, wall and CPU time per phase are appended to a JSON Lines
+        file of this directory (see ``profiling``)
+    profile_per_iteration : bool, default=False
+        If True, one record per phase and iteration is written, otherwise one
+        per phase for all iterations
+
+    Returns
+    ---------
+    None
+
+    Errors of the calculation are raised again after being printed, so that
+    the task is reported as failed by ``run_work_queue``.
+    """
+    timer = PhaseTimer.for_worker(profile_dir, worker_id, profile_per_iteration)
+    with timer.phase("project_switch"):
+        projects.set_current(_check_project(project_name))
+    g_samples_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch, must_exist=False)
+    g_samples_dir_temp = g_samples_dir / "temp"
+    g_samples_dir_temp.mkdir(exist_ok=True, parents=True)
+
+    with timer.phase("presamples_loading"):
+        if shared_samples_dir is None:
+            campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+            presample_paths = [p for p in campaign]
+            assert presample_paths
+            matrix_builder = CampaignMatrixBuilder(presample_paths, Path(result_dir) / "common_files")
+        else:
+            matrix_builder = CampaignMatrixBuilder.from_shared_samples(
+                shared_samples_dir, Path(result_dir) / "common_files")
+    timer.flush(worker=worker_id)
+    total_iterations = matrix_builder.ncols
+    print("Worker ID {}, requested iterations: {}".format(worker_id, total_iterations))
+
+    g_dimensions = len(matrix_builder.bio_dict)
+    t0 = time.time()
+    try:
+        summary = calculate_lci_arrays_per_iteration(
+            database_name, activity_list, matrix_builder, g_dimensions, total_iterations, g_samples_dir,
+            flow_indices=flow_indices, mode=mode, iteration_range=iteration_range,
+            solver=solver, solver_options=solver_options, timer=timer)
+    except Exception as err:
+        print("************Failure for worker {}: {}************".format(worker_id, err))
+        raise
+    total_time = time.time() - t0
+    print("Worker ID: {}\n\tTotal of {} LCIs of {} iterations"
+          "\n\tTotal time: {} minutes\n\tAverage time: {} minutes per iteration"
+          "\n\tSolver: {}, sparsity pattern analysis: {} seconds, saving {} seconds per iteration".format(
+        worker_id, len(activity_list), total_iterations, total_time / 60, (total_time / total_iterations) / 60,
+        summary['solver'], summary['analysis_time'], summary['time_saved_per_iteration']
     ))
+    memory = _get_memory_usage()
+    if memory:
+        print("\tResident memory: {:.0f} MB, of which {:.0f} MB private and {:.0f} MB shared".format(
+            memory['rss'] / 1e6, memory.get('anonymous', 0) / 1e6, memory['shared'] / 1e6))
+        if shared_samples_dir is not None:
+            shared_size = (Path(shared_samples_dir) / "samples.npy").stat().st_size
+            print("\tShared samples: {:.0f} MB mapped for all workers, saving {:.0f} MB "
+                  "of private memory in this worker".format(
+                shared_size / 1e6, min(shared_size, memory['shared']) / 1e6))
+    if summary['fallback_iterations']:
+        print("\tIterative solver fell back to direct solve for {} iterations: {}".format(
+            len(summary['fallback_iterations']), summary['fallback_iterations']))
+
+
+def _get_lci_blocks(activity_codes, activities_per_block, total_iterations, iterations_per_block):
+    """Split activities and iterations in blocks of work with stable identifiers
+
+    Returns
+    --------
+    blocks : list
+        (block_id, activity codes, iteration range) tuples. Blocks of the same
+        activities are consecutive. If iterations_per_block is None, the
+        block id of a single activity is its code.
+    """
+    blocks = []
+    for start in range(0, len(activity_codes), activities_per_block):
+        codes = activity_codes[start:start + activities_per_block]
+        group_id = codes[0] if len(codes) == 1 else "{}_{}".format(codes[0], len(codes))
+        if iterations_per_block is None:
+            blocks.append((group_id, codes, (0, total_iterations)))
+            continue
+        for first in range(0, total_iterations, iterations_per_block):
+            last = min(first + iterations_per_block, total_iterations)
+            blocks.append(("{}_i{}-{}".format(group_id, first, last), codes, (first, last)))
+    return blocks
+
+
+def claim_lci_calculations(activity_list, result_dir, worker_id, database_name, samples_batch,
+                           project_name, engine="activity", activities_per_block=None,
+                           iterations_per_block=None, lease_duration=3600, flow_indices=None,
+                           mode="auto", solver="direct", solver_options=None, shared_samples_dir=None,
+                           profile_dir=None, profile_per_iteration=False):
+    """Calculate LCI arrays for blocks of work claimed through lease files
+
+    Any number of processes, on any number of nodes sharing the result_dir,
+    can run this function for the same samples_batch at the same time: each
+    block of work (activities, or activities x iterations) is calculated by
+    the process that first creates its lease file (see ``leases``). Blocks
+    whose lease expired, because its owner died or was killed, are
+    reclaimed. Passes over the blocks are repeated until a pass claims no
+    block, so that nodes can be added or lost at any time without
+    re-slicing.
+
+    All processes of a samples_batch must use the same activity_list,
+    engine, activities_per_block and iterations_per_block, since blocks
+    are identified by their contents.
+
+    Parameters
+    --------------
+    activity_list : list
+        Codes of all activities to calculate, in the order in which blocks
+        are claimed
+    result_dir : str
+        Path to directory where results are stored
+    worker_id : int
+        Identification of the worker, used only for messages
+    database_name : str
+        Name of the LCI database
+    samples_batch : int
+        Integer id for sample batch
+    project_name : str
+        Name of the brightway2 project where the database is imported
+    engine : str, default="activity"
+        "activity" (``calculate_lci_array``) or "iteration"
+        (``calculate_lci_arrays_per_iteration``)
+    activities_per_block : int, default=None
+        Number of activities per block. Defaults to 1 with engine="activity"
+        and to 256 with engine="iteration".
+    iterations_per_block : int, default=None
+        Number of iterations per block, engine="iteration" only. If None,
+        blocks contain all iterations. Temporary LCI memmaps of activities
+        are moved to their final location once all their iteration blocks
+        are done.
+    lease_duration : float, default=3600
+        Seconds without renewal after which a lease is expired. Leases are
+        renewed every lease_duration / 10 seconds while the block is
+        calculated.
+    flow_indices, mode, solver, solver_options, shared_samples_dir
+        See ``set_up_iteration_major_lci_calculations``, engine="iteration" only
+    profile_dir, profile_per_iteration
+        See ``set_up_lci_calculations``
+
+    Returns
+    ---------
+    claimed : int
+        Number of blocks calculated by this process
+    """
+    if engine not in ("activity", "iteration"):
+        raise ValueError("LCI engine {} not valid, choose from ['activity', 'iteration']".format(engine))
+    if engine == "activity" and iterations_per_block is not None:
+        raise ValueError("iterations_per_block can only be used with engine='iteration'")
+    timer = PhaseTimer.for_worker(profile_dir, worker_id, profile_per_iteration)
+    with timer.phase("project_switch"):
+        projects.set_current(_check_project(project_name))
+    g_samples_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch, must_exist=False)
+    (g_samples_dir / "temp").mkdir(exist_ok=True, parents=True)
+    lease_dir = get_lease_dir(result_dir, samples_batch)
+
+    if engine == "activity":
+        activities_per_block = activities_per_block or 1
+        g_dimensions = len(get_ref_bio_dict_from_common_files(Path(result_dir) / "common_files"))
+        campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+        presample_paths = [p for p in campaign]
+        assert presample_paths
+        iterations = list(set([presamples.PresamplesPackage(p).ncols for p in presample_paths]))
+        assert len(iterations) == 1
+        total_iterations = iterations[0]
+    else:
+        activities_per_block = activities_per_block or 256
+        if shared_samples_dir is None:
+            campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+            matrix_builder = CampaignMatrixBuilder([p for p in campaign], Path(result_dir) / "common_files")
+        else:
+            matrix_builder = CampaignMatrixBuilder.from_shared_samples(
+                shared_samples_dir, Path(result_dir) / "common_files")
+        total_iterations = matrix_builder.ncols
+        g_dimensions = len(matrix_builder.bio_dict)
+
+    blocks = _get_lci_blocks(list(activity_list), activities_per_block, total_iterations, iterations_per_block)
+    groups = {}
+    for block_id, codes, _ in blocks:
+        groups.setdefault(tuple(codes), []).append(block_id)
+
+    def finalize_group(codes):
+        # Iteration blocks calculated by different processes: move arrays once all are done
+        final_id = "{}_final".format(groups[codes][0].rsplit("_i", 1)[0])
+        if not all(is_block_done(lease_dir, block_id) for block_id in groups[codes]):
+            return
+        lease = try_claim(lease_dir, final_id, lease_duration)
+        if lease is None:
+            return
+        try:
+            for act_code in codes:
+                lease.check()
+                if (g_samples_dir / "temp" / "{}.npy".format(act_code)).is_file():
+                    _finalize_lci_array(g_samples_dir, act_code, g_dimensions, total_iterations)
+        except LeaseLost:
+            lease.release()
+            return
+        lease.mark_done()
+
+    claimed, t0 = 0, time.time()
+    while True:
+        claimed_in_pass = 0
+        saved = get_saved_lci_codes(g_samples_dir)
+        for block_id, codes, iteration_range in blocks:
+            if all(code in saved for code in codes):
+                if not is_block_done(lease_dir, block_id):
+                    mark_block_done(lease_dir, block_id)
+                continue
+            lease = try_claim(lease_dir, block_id, lease_duration)
+            if lease is None:
+                if iterations_per_block is not None:
+                    finalize_group(tuple(codes))
+                continue
+            lease.start_heartbeat(lease_duration / 10)
+            try:
+                if engine == "activity":
+                    for act_code in codes:
+                        lease.check()
+                        if act_code in saved:
+                            continue
+                        calculate_lci_array(
+                            database_name, act_code, presample_paths, g_dimensions,
+                            total_iterations, g_samples_dir, timer=timer, lease=lease)
+                else:
+                    calculate_lci_arrays_per_iteration(
+                        database_name, codes, matrix_builder, g_dimensions, total_iterations,
+                        g_samples_dir, flow_indices=flow_indices, mode=mode,
+                        iteration_range=None if iterations_per_block is None else iteration_range,
+                        solver=solver, solver_options=solver_options,
+                        finalize=iterations_per_block is None, timer=timer, lease=lease)
+            except LeaseLost:
+                print("Worker {} lost the lease on block {}, abandoning it".format(worker_id, block_id))
+                lease.release()
+                continue
+            except Exception as err:
+                print("************Failure for block {} by worker {}: {}************".format(
+                    block_id, worker_id, err))
+                lease.release()
+                continue
+            if not lease.mark_done():
+                print("Worker {} lost the lease on block {}, not marking it done".format(worker_id, block_id))
+                continue
+            claimed_in_pass += 1
+            if iterations_per_block is not None:
+                finalize_group(tuple(codes))
+        claimed += claimed_in_pass
+        if not claimed_in_pass:
+            break
+    print("Worker ID: {}\n\tCalculated {} of {} blocks in {} minutes".format(
+        worker_id, claimed, len(blocks), (time.time() - t0) / 60))
+    return claimed
+
+
+def select_solver_backend(project_name, result_dir, samples_batch=0, iterations=3,
+                          number_of_demands=256):
+    """Time installed direct solver backends and record the fastest
+
+    Each installed backend (see ``available_direct_solvers``) factorizes the
+    sampled technosphere matrices of the first ``iterations`` iterations of
+    the samples_batch and solves for ``number_of_demands`` demand vectors,
+    as workers of the iteration-major engine do. The fastest backend is
+    recorded in ``solver_backend.json`` in the common files, along with the
+    timings and the name of the machine, and is then used by workers with
+    solver="direct". Since the fastest backend depends on the hardware,
+    this should be run on the machines (e.g. cluster nodes) that calculate
+    the LCI arrays.
+
+    Parameters
+    -----------
+    project_name : str
+        Name of the brightway2 project where the database is imported
+    result_dir : str
+        Path to directory where results are stored
+    samples_batch : int, default=0
+        Integer id for sample batch whose presamples are used for timing
+    iterations : int, default=3
+        Number of sampled iterations timed per backend
+    number_of_demands : int, default=256
+        Number of demand vectors solved per iteration
+
+    Returns
+    --------
+    backend : str
+        Name of the fastest backend
+    """
+    projects.set_current(_check_project(project_name))
+    result_dir = Path(_check_result_dir(result_dir))
+    campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+    matrix_builder = CampaignMatrixBuilder([p for p in campaign], result_dir / "common_files")
+    n_products = len(matrix_builder.product_dict)
+    number_of_demands = min(number_of_demands, n_products)
+    demand = np.zeros((n_products, number_of_demands))
+    demand[np.arange(number_of_demands), np.arange(number_of_demands)] = 1
+    timings = {}
+    for name in available_direct_solvers():
+        try:
+            solver = get_solver(name)
+            solver.analyze(matrix_builder.technosphere_matrix)
+            t0 = time.perf_counter()
+            for i in range(iterations):
+                A, _ = matrix_builder.update(i)
+                solver.factorize(A)
+                solver.solve(demand)
+            timings[name] = (time.perf_counter() - t0) / iterations
+            print("{}: {} seconds per iteration".format(name, timings[name]))
+        except Exception as err:
+            print("************Solver backend {} failed: {}************".format(name, err))
+    if not timings:
+        raise ValueError("No solver backend could solve the technosphere matrix")
+    backend = min(timings, key=timings.get)
+    with open(result_dir / "common_files" / SOLVER_BACKEND_FILENAME, "w") as f:
+        json.dump({
+            'backend': backend,
+            'seconds_per_iteration': timings,
+            'iterations': iterations,
+            'number_of_demands': number_of_demands,
+            'machine': platform.node(),
+            'processor': platform.processor(),
+        }, f, indent=4)
+    print("Fastest solver backend: {}".format(backend))
+    return backend
+
+
+def _prepare_shared_samples(result_dir, samples_batch, shared_samples_dir=None):
+    """Save the samples of the campaign once for all workers, if needed
+
+    Returns the directory of the shared samples, by default
+    ``LCI_metadata/<samples_batch>/shared_samples``. Existing shared
+    samples are reused if they were created from the same presamples packages.
+    """
+    if shared_samples_dir is None:
+        shared_samples_dir = _get_lci_metadata_dir(result_dir, samples_batch) / "shared_samples"
+    shared_samples_dir = Path(shared_samples_dir)
+    campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+    presample_paths = [str(p) for p in campaign]
+    metadata = CampaignMatrixBuilder.shared_samples_metadata(shared_samples_dir)
+    if metadata is None or metadata['presamples_paths'] != presample_paths:
+        print("Saving shared samples in {}".format(shared_samples_dir))
+        matrix_builder = CampaignMatrixBuilder(presample_paths, Path(result_dir) / "common_files")
+        matrix_builder.save_shared_samples(shared_samples_dir, presample_paths)
+    return shared_samples_dir
+
+
+def _check_flow_indices(result_dir, samples_batch, flow_indices):
+    """Record subset of elementary flows calculated for a samples_batch
+
+    All LCI arrays of a samples_batch must be calculated for the same
+    elementary flows. Raises ValueError if flow_indices differs from the
+    subset recorded in a previous run.
+    """
+    fp = _get_lci_metadata_dir(result_dir, samples_batch) / "flow_indices.json"
+    flow_indices = None if flow_indices is None else sorted(int(i) for i in flow_indices)
+    if fp.is_file():
+        with open(fp, "r") as f:
+            recorded = json.load(f)
+        if recorded != flow_indices:
+            raise ValueError(
+                "LCI arrays of samples_batch {} were calculated for a different "
+                "set of elementary flows, see {}".format(samples_batch, fp)
+            )
+    elif flow_indices is not None:
+        with open(fp, "w") as f:
+            json.dump(flow_indices, f)
+
+
+def _check_lci_format(g_samples_dir, compact, codec, codec_options):
+    """Record the format in which LCI arrays of a samples_batch are saved
+
+    The format records (``lci_compact.json`` and ``lci_codec.json``) are
+    only written if the samples_batch has none and no saved LCI arrays yet,
+    in which case arrays would be saved as .npy files. Raises ValueError if
+    the requested format differs from the one already used.
+    """
+    g_samples_dir = Path(g_samples_dir)
+    requested = (bool(compact), None if codec is None else {'codec': codec, 'options': codec_options or {}})
+    recorded = (load_lci_compact(g_samples_dir), load_lci_codec_record(g_samples_dir))
+    if requested == recorded:
+        return
+    temp_dir = g_samples_dir / "temp"
+    has_arrays = bool(get_saved_lci_codes(g_samples_dir)) or (temp_dir.is_dir() and any(temp_dir.iterdir()))
+    if recorded != (False, None) or has_arrays:
+        raise ValueError(
+            "LCI arrays of samples_batch {} are saved with a different format "
+            "(compact={}, codec={}), see {}".format(
+                g_samples_dir.name, recorded[0], recorded[1],
+                g_samples_dir.parent.parent / "LCI_metadata" / g_samples_dir.name)
+        )
+    save_lci_compact(g_samples_dir, compact)
+    save_lci_codec(g_samples_dir, codec, codec_options)
 
 
 def techno_dicts_equal(ref_techno_dict, new_techno_dict):
@@ -146,7 +1061,15 @@ def get_techno_dicts_translator(ref_techno_dict, new_techno_dict):
 
 
 def dispatch_lci_calculators(project_name, database_name, result_dir, samples_batch=0,
-                             parallel_jobs=1, slice_id=None, number_of_slices=None):
+                             parallel_jobs=1, slice_id=None, number_of_slices=None,
+                             engine="activity", lcia_methods=None, mode="auto",
+                             solver="direct", solver_options=None,
+                             shared_samples=True, shared_samples_dir=None,
+                             order="given", group_size=None, balance_slices=False,
+                             distributed=False, lease_duration=3600, iterations_per_block=None,
+                             profile=False, profile_per_iteration=False,
+                             storage="npy", store_layout="activity", activities_per_chunk=256,
+                             codec=None, codec_options=None):
     """ Dispatches LCI array calculations to distinct processes (multiprocessing)
 
     If number_of_slices/slice_id are not None, then only a subset of database activities are processed.
@@ -176,6 +1099,96 @@ def dispatch_lci_calculators(project_name, database_name, result_dir, samples_ba
         Number of slices over which the calculations are split.
         Useful when calculations are split across many computers or jobs on a computer cluster.
         If None, LCI arrays are generated for all activities in the database.
+        All slices should be calculated with the same number_of_slices.
+    balance_slices : bool, default=False
+        If True, slices have roughly equal expected calculation time according
+        to the cost model saved in the common files (see
+        ``cost_model.save_lci_cost_model``). If False, slices have equal
+        numbers of activities. All slices should be calculated with the same
+        balance_slices.
+    engine : str, default="activity"
+        LCI calculation engine. "activity" solves one ``MonteCarloLCA`` per
+        activity (``set_up_lci_calculations``). "iteration" factorizes the
+        sampled technosphere matrix once per iteration and solves for all
+        activities of a worker at once (``set_up_iteration_major_lci_calculations``).
+    lcia_methods : list, default=None
+        List of LCIA methods (brightway2 tuples). If specified, only the
+        elementary flows with characterization factors in at least one of
+        these methods are calculated, other rows of the LCI arrays are left
+        to 0. The subset of elementary flows is saved in the LCI_metadata
+        directory of the samples_batch. Only available with engine="iteration".
+    mode : str, default="auto"
+        Solving mode used with engine="iteration", one of "forward",
+        "adjoint" or "auto", see ``calculate_lci_arrays_per_iteration``.
+        With "auto", adjoint solves are used when fewer elementary flows
+        than activities are requested.
+    solver : str, default="direct"
+        Solver used with engine="iteration", see
+        ``calculate_lci_arrays_per_iteration``. With "direct", workers use
+        the solver backend recorded by ``select_solver_backend``.
+    solver_options : dict, default=None
+        Keyword arguments passed to the solver, e.g. {"rtol": 1e-10}
+    shared_samples : bool, default=True
+        With engine="iteration", the samples of the campaign are saved once
+        in a single memory-mapped array that all workers attach to
+        read-only, so that only one copy is held in memory per machine.
+        Workers report the resulting memory savings.
+    shared_samples_dir : str, default=None
+        Directory for the shared samples, e.g. on a memory-backed
+        filesystem such as /dev/shm. Defaults to
+        ``LCI_metadata/<samples_batch>/shared_samples`` in the result_dir.
+    order : str, default="given"
+        Order in which activities are calculated: "given" (order of
+        ordered_activity_codes.json), "longest_first" or "shortest_first"
+        (by expected cost, see ``cost_model.expected_lci_costs``) or
+        "random". "longest_first" minimizes the time spent waiting for the
+        last activities.
+    group_size : int, default=None
+        Number of activities in each task pulled by workers from the work
+        queue. Defaults to 1 for engine="activity". The iteration-major
+        engine has a per-task overhead (reading samples, analyzing A) and
+        defaults to a quarter of the activities per worker.
+    distributed : bool, default=False
+        If True, the parallel_jobs workers claim blocks of work through lease
+        files in the result_dir (see ``claim_lci_calculations``) instead of
+        pulling them from a local queue. Any number of jobs, on any number of
+        nodes or clusters, can then be started for the same samples_batch
+        without slices: each block is calculated once, and blocks of jobs
+        that died are reclaimed once their lease expires. group_size is then
+        the number of activities per block.
+    lease_duration : float, default=3600
+        Seconds without renewal after which a lease is expired, distributed
+        mode only
+    iterations_per_block : int, default=None
+        With distributed=True and engine="iteration", number of iterations
+        per block. If None, blocks contain all iterations.
+    profile : bool, default=False
+        If True, workers record the wall and CPU time spent in each phase of
+        the calculations in ``LCI_metadata/<samples_batch>/phase_timings``,
+        one JSON Lines file per worker. Summarize them with
+        ``bw2preagg profile``.
+    profile_per_iteration : bool, default=False
+        If True, phase timings are recorded per iteration rather than per
+        activity (engine="activity") or per task (engine="iteration")
+    storage : str, default="npy"
+        "npy" to save the LCI array of every activity in its own .npy file,
+        "compact" to save only the rows of elementary flows that are
+        non-zero in at least one iteration, with their indices, in a .npz
+        file per activity (see ``compact``), or "store" to save all LCI
+        arrays of the samples batch in a single chunked store (see
+        ``lci_store.create_lci_store``). Once a store exists for a samples
+        batch, all calculators use it.
+    store_layout : str, default="activity"
+        Layout of the store, "activity" for fast reads of single LCI
+        arrays or "flow" for fast reads of single elementary flows
+    activities_per_chunk : int, default=256
+        Number of activities per chunk file of the store
+    codec : str, default=None
+        If specified, LCI arrays are saved compressed with this codec, in
+        ``<act_code>.npc`` files (see ``compression``): "zlib", or "zstd",
+        "lz4" and "blosc" if installed. Only available with storage="npy".
+    codec_options : dict, default=None
+        Keyword arguments of the codec, e.g. {"level": 9, "shuffle": True}
     """
     print("\n\n**************Dispatching LCI CALCULATORS**************\n\n")
     # Ensure base data exist and are valid
@@ -186,6 +1199,48 @@ def dispatch_lci_calculators(project_name, database_name, result_dir, samples_ba
     if missing_files:
         raise ValueError("Missing files: ", missing_files)
     _get_campaign(samples_batch, expect_base_presamples=True)
+    engines = {
+        "activity": set_up_lci_calculations,
+        "iteration": set_up_iteration_major_lci_calculations,
+    }
+    if engine not in engines:
+        raise ValueError("LCI engine {} not valid, choose from {}".format(engine, list(engines)))
+    engine_kwargs = {}
+    if engine == "iteration":
+        engine_kwargs['mode'] = mode
+        engine_kwargs['solver'] = solver
+        engine_kwargs['solver_options'] = solver_options
+        if shared_samples:
+            engine_kwargs['shared_samples_dir'] = _prepare_shared_samples(
+                result_dir, samples_batch, shared_samples_dir)
+        if lcia_methods:
+            ref_bio_dict = get_ref_bio_dict_from_common_files(result_dir / "common_files")
+            engine_kwargs['flow_indices'] = get_flow_indices_for_methods(
+                lcia_methods, ref_bio_dict, project_name)
+    elif lcia_methods:
+        raise ValueError("lcia_methods can only be used with engine='iteration'")
+    _check_flow_indices(result_dir, samples_batch, engine_kwargs.get('flow_indices'))
+    if storage == "store":
+        campaign = _get_campaign(str(samples_batch), expect_base_presamples=True)
+        iterations = {presamples.PresamplesPackage(p).ncols for p in campaign}
+        assert len(iterations) == 1
+        create_lci_store(result_dir, samples_batch, iterations.pop(), store_layout, activities_per_chunk)
+    elif storage not in ["npy", "compact"]:
+        raise ValueError("Storage {} not valid, choose from ['npy', 'compact', 'store']".format(storage))
+    if codec is not None and storage != "npy":
+        raise ValueError("Compression is only available with storage='npy'")
+    g_samples_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch, must_exist=False)
+    _check_lci_format(g_samples_dir, storage == "compact", codec, codec_options)
+    if profile:
+        engine_kwargs['profile_dir'] = _get_lci_metadata_dir(result_dir, samples_batch) / PHASE_TIMINGS_DIRNAME
+        engine_kwargs['profile_per_iteration'] = profile_per_iteration
+    if distributed:
+        if slice_id is not None:
+            raise ValueError("Slices are not used in distributed mode")
+        _dispatch_distributed_lci_calculators(
+            result_dir, database_name, samples_batch, project_name, parallel_jobs, engine,
+            engine_kwargs, order, group_size, iterations_per_block, lease_duration)
+        return
 
     # Create directory for LCI arrays
     g_master_dir = result_dir / "probabilistic" / "LCI"
@@ -193,8 +1248,6 @@ def dispatch_lci_calculators(project_name, database_name, result_dir, samples_ba
     g_samples_dir = g_master_dir / "{}".format(samples_batch)
     g_samples_dir.mkdir(exist_ok=True)
 
-    chunks = lambda l, n: [l[i:i + n] for i in range(0, len(l), n)]
-
     # Identify subset of activities to treat
     with open(result_dir / "common_files" / "ordered_activity_codes.json", 'r') as f:
         all_activity_codes = json.load(f)
@@ -204,36 +1257,84 @@ def dispatch_lci_calculators(project_name, database_name, result_dir, samples_ba
         print("Number of activities to treat in single slice: {}".format(
             len(activity_codes)))
     else:
-        activity_codes = chunks(all_activity_codes, ceil(len(all_activity_codes) / (number_of_slices)))[slice_id]
+        activity_codes = get_slice_activity_codes(result_dir, slice_id, number_of_slices, balance_slices)
         print("Number of activities to treat in slice {} of {}: {}".format(
             slice_id, number_of_slices, len(activity_codes)))
-    activities_to_treat = []
-    for act in activity_codes:
-        lci_filename = "{}.npy".format(act)
-        # Check if this result has already been generated
-        if lci_filename in os.listdir(g_samples_dir):
-            # And make sure all columns were filled in with results
-            if not any(np.load(str(g_samples_dir / lci_filename), mmap_mode='r').sum(axis=0) == 0):
-                # If all done, then go on to the next activity
-                continue
-        else:
-            activities_to_treat.append(act)
+    # Arrays saved without ledger record, e.g. before the ledger existed, are checked once
+    verified = record_unverified_lci_arrays(g_samples_dir, activity_codes)
+    if verified:
+        print("Recorded {} LCI arrays saved without ledger record in the ledger".format(len(verified)))
+    # Done arrays, with all columns filled in and no failed iteration, according to the ledger
+    completed = get_completed_lci_codes(g_samples_dir)
+    activities_to_treat = [act for act in activity_codes if act not in completed]
     if not activities_to_treat:
         print("No lci arrays to generate, exiting")
         return
     else:
         print("Total of {} lci arrays to generate".format(len(activities_to_treat)))
 
-    activity_sublists = chunks(activities_to_treat, ceil(len(activities_to_treat) / parallel_jobs))
-    print("LCI generation dispatched in {} chunks with the following number of activities to treat: {}".format(
-        len(activity_sublists), str([len(x) for x in activity_sublists])))
-    workers = []
-    for i, s in enumerate(activity_sublists):
-        j = mp.Process(target=set_up_lci_calculations,
-                       args=(s, result_dir, i, database_name, samples_batch, project_name)
-                       )
-        workers.append(j)
+    expected_costs = None
+    if order in ("longest_first", "shortest_first"):
+        expected_costs = expected_lci_costs(result_dir, activities_to_treat)
+    activities_to_treat = order_activities(activities_to_treat, order, expected_costs)
+    if group_size is None:
+        group_size = 1 if engine == "activity" else ceil(len(activities_to_treat) / (4 * parallel_jobs))
+    print("LCI generation dispatched to {} workers, in tasks of {} activities ({} order)".format(
+        parallel_jobs, group_size, order))
+    report = run_work_queue(
+        engines[engine], activities_to_treat, parallel_jobs,
+        args=(result_dir, database_name, samples_batch, project_name),
+        kwargs=engine_kwargs, group_size=group_size
+    )
+    print_work_queue_report(report)
+    _save_lci_timings(result_dir, samples_batch, engine, report)
+
+
+def _dispatch_distributed_lci_calculators(result_dir, database_name, samples_batch, project_name,
+                                          parallel_jobs, engine, engine_kwargs, order, group_size,
+                                          iterations_per_block, lease_duration):
+    """Start parallel_jobs processes claiming blocks of work, see claim_lci_calculations"""
+    with open(result_dir / "common_files" / "ordered_activity_codes.json", 'r') as f:
+        activity_codes = json.load(f)
+    expected_costs = None
+    if order in ("longest_first", "shortest_first"):
+        expected_costs = expected_lci_costs(result_dir, activity_codes)
+    # Same order for all jobs, with a seed for "random"
+    activity_codes = order_activities(activity_codes, order, expected_costs, seed=samples_batch)
+    kwargs = dict(
+        engine_kwargs, engine=engine, activities_per_block=group_size,
+        iterations_per_block=iterations_per_block, lease_duration=lease_duration,
+    )
+    print("LCI generation of {} activities dispatched to {} workers claiming blocks from {}".format(
+        len(activity_codes), parallel_jobs, get_lease_dir(result_dir, samples_batch)))
+    workers = [
+        mp.Process(
+            target=claim_lci_calculations,
+            args=(activity_codes, result_dir, i, database_name, samples_batch, project_name),
+            kwargs=kwargs
+        )
+        for i in range(parallel_jobs)
+    ]
     for w in workers:
         w.start()
     for w in workers:
         w.join()
+
+
+def _save_lci_timings(result_dir, samples_batch, engine, report):
+    """Append measured time per activity of completed tasks to lci_timings.jsonl
+
+    Saved in the LCI_metadata directory of the samples_batch, with one line
+    per task.
+    """
+    fp = _get_lci_metadata_dir(result_dir, samples_batch) / "lci_timings.jsonl"
+    with open(fp, "a") as f:
+        for task in report['tasks'].values():
+            if task['status'] != "done":
+                continue
+            f.write(json.dumps({
+                'activities': task['activities'],
+                'seconds_per_activity': task['duration'] / len(task['activities']),
+                'engine': engine,
+                'machine': platform.node(),
+            }) + "\n")
@@ -0,0 +1,327 @@
+""" Consolidated store of the LCI arrays of a samples batch
+
+By default, every LCI array is saved in its own ``<act_code>.npy`` file, i.e.
+one file per activity and samples batch. On shared cluster filesystems,
+creating, listing and opening tens of thousands of files can take longer
+than the calculations. The LCI store instead holds the LCI arrays of all
+activities of a samples batch, a 3-D array of elementary flows x activities x
+iterations, in a few chunk files in ``<samples_batch>/lci_store``:
+
+    - ``index.json``: the sidecar index, with the activity codes in store
+      order, the shape, dtype, layout and number of activities per chunk
+    - ``written.npy``: one flag per activity, set once its LCI array is
+      written
+    - ``chunk_<i>.npy``: the LCI arrays of ``activities_per_chunk``
+      consecutive activities
+
+Within a chunk, the "activity" layout stores each LCI array contiguously
+(activities x flows x iterations), which is best to read arrays of single
+activities. The "flow" layout stores the values of each elementary flow
+for all activities of the chunk contiguously (flows x activities x
+iterations), which is best to read one elementary flow for all activities,
+e.g. to characterize a single flow.
+
+Values are written with positioned writes of the exact bytes of an
+activity, so that any number of processes, on any number of nodes, can
+write disjoint sets of activities concurrently.
+
+The store is used by the LCI calculators if it exists when arrays are
+finalized, see ``create_lci_store``, and ``load_LCI_array`` reads from it
+transparently.
+"""
+from pathlib import Path
+import json
+import os
+import pickle
+import numpy as np
+from .compression import COMPRESSED_SUFFIX, load_compressed_array
+from .compact import COMPACT_SUFFIX, CompactArray, load_compact_array
+from .catalog import ResultCatalog
+
+STORE_DIRNAME = "lci_store"
+STORE_LAYOUTS = ["activity", "flow"]
+
+
+def _link_new_file(partial_fp, fp):
+    """Link a fully written partial file to fp unless fp exists, then remove the partial file"""
+    try:
+        os.link(str(partial_fp), str(fp))
+    except FileExistsError:
+        pass
+    partial_fp.unlink()
+
+
+def create_lci_store(result_dir, samples_batch, iterations, layout="activity",
+                     activities_per_chunk=256, dtype="float32"):
+    """Create the LCI store of a samples batch, or open it if it exists
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    samples_batch : int
+        Integer id for sample batch
+    iterations : int
+        Number of iterations, i.e. columns of the LCI arrays
+    layout : str, default="activity"
+        "activity" for fast reads of the LCI arrays of single activities,
+        "flow" for fast reads of single elementary flows for all activities
+    activities_per_chunk : int, default=256
+        Number of activities per chunk file
+    dtype : str, default="float32"
+        dtype of the stored values
+
+    Returns
+    --------
+    store : LCIStore
+
+    Raises
+    -------
+    ValueError
+        If a store with a different shape, dtype or layout exists
+    """
+    if layout not in STORE_LAYOUTS:
+        raise ValueError("Layout {} not valid, choose from {}".format(layout, STORE_LAYOUTS))
+    result_dir = Path(result_dir)
+    with open(result_dir / "common_files" / "ordered_activity_codes.json", "r") as f:
+        activity_codes = json.load(f)
+    with open(result_dir / "common_files" / "bio_dict.pickle", "rb") as f:
+        number_of_flows = len(pickle.load(f))
+    from .utils import _get_lci_dir
+    store_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch, must_exist=False) / STORE_DIRNAME
+    store_dir.mkdir(exist_ok=True)
+    index = {
+        'shape': [number_of_flows, len(activity_codes), int(iterations)],
+        'dtype': str(np.dtype(dtype)),
+        'layout': layout,
+        'activities_per_chunk': int(activities_per_chunk),
+        'activity_codes': activity_codes,
+    }
+    index_fp = store_dir / "index.json"
+    if not index_fp.is_file():
+        written_fp = store_dir / "written.npy"
+        partial_fp = written_fp.with_name("written.{}.part".format(os.getpid()))
+        with open(partial_fp, "wb") as f:
+            np.save(f, np.zeros(len(activity_codes), dtype=np.uint8))
+        _link_new_file(partial_fp, written_fp)
+        partial_fp = index_fp.with_name("index.{}.part".format(os.getpid()))
+        with open(partial_fp, "w") as f:
+            json.dump(index, f)
+        _link_new_file(partial_fp, index_fp)
+    store = LCIStore(store_dir)
+    existing = {k: store.index[k] for k in ['shape', 'dtype', 'layout', 'activities_per_chunk']}
+    requested = {k: index[k] for k in existing}
+    if existing != requested or store.activity_codes != activity_codes:
+        raise ValueError("An LCI store with different properties exists at {}: {}".format(store_dir, existing))
+    return store
+
+
+class LCIStore(object):
+    """LCI arrays of all activities of a samples batch, see module docstring
+
+    Parameters
+    -----------
+    store_dir : str
+        Path to the store directory, ``<samples_batch>/lci_store``
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / "index.json", "r") as f:
+            self.index = json.load(f)
+        self.number_of_flows, self.number_of_activities, self.iterations = self.index['shape']
+        self.dtype = np.dtype(self.index['dtype'])
+        self.layout = self.index['layout']
+        self.activities_per_chunk = self.index['activities_per_chunk']
+        self.activity_codes = self.index['activity_codes']
+        self.positions = {code: i for i, code in enumerate(self.activity_codes)}
+        self._chunks = {}
+
+    @classmethod
+    def open(cls, g_samples_dir):
+        """Return the store of the LCI directory of a samples batch, or None if there is none"""
+        store_dir = Path(g_samples_dir) / STORE_DIRNAME
+        if not (store_dir / "index.json").is_file():
+            return None
+        return cls(store_dir)
+
+    def _chunk_shape(self, chunk_id):
+        n = min(self.activities_per_chunk, self.number_of_activities - chunk_id * self.activities_per_chunk)
+        if self.layout == "activity":
+            return n, self.number_of_flows, self.iterations
+        return self.number_of_flows, n, self.iterations
+
+    def _chunk_fp(self, chunk_id):
+        return self.store_dir / "chunk_{:05d}.npy".format(chunk_id)
+
+    def _get_chunk(self, chunk_id, create=False):
+        """Return the chunk as a read-only memmap, or None if it does not exist and not create"""
+        if chunk_id not in self._chunks:
+            fp = self._chunk_fp(chunk_id)
+            if not fp.is_file():
+                if not create:
+                    return None
+                partial_fp = fp.with_name("{}.{}.part".format(fp.name, os.getpid()))
+                chunk = np.lib.format.open_memmap(
+                    str(partial_fp), mode='w+', dtype=self.dtype, shape=self._chunk_shape(chunk_id))
+                del chunk
+                _link_new_file(partial_fp, fp)
+            self._chunks[chunk_id] = np.load(str(fp), mmap_mode='r')
+        return self._chunks[chunk_id]
+
+    def _locate(self, act_code):
+        if act_code not in self.positions:
+            raise ValueError("Activity {} is not in the LCI store {}".format(act_code, self.store_dir))
+        return divmod(self.positions[act_code], self.activities_per_chunk)
+
+    def write(self, act_code, lci):
+        """Write the LCI array of an activity, then flag it as written
+
+        Parameters
+        -----------
+        act_code : str
+            Code of the activity
+        lci : numpy.ndarray
+            LCI array, with rows = elementary flows and columns = iterations
+        """
+        chunk_id, position = self._locate(act_code)
+        if lci.shape != (self.number_of_flows, self.iterations):
+            raise ValueError("LCI array of shape {} does not fit in store of shape {}".format(
+                lci.shape, self.index['shape']))
+        chunk = self._get_chunk(chunk_id, create=True)
+        lci = np.ascontiguousarray(lci, dtype=self.dtype)
+        row_bytes = self.iterations * self.dtype.itemsize
+        fd = os.open(str(self._chunk_fp(chunk_id)), os.O_WRONLY)
+        try:
+            if self.layout == "activity":
+                os.pwrite(fd, lci.tobytes(), chunk.offset + position * self.number_of_flows * row_bytes)
+            else:
+                n = chunk.shape[1]
+                for flow, row in enumerate(lci):
+                    os.pwrite(fd, row.tobytes(), chunk.offset + (flow * n + position) * row_bytes)
+        finally:
+            os.close(fd)
+        self._set_written(self.positions[act_code])
+
+    def _set_written(self, position):
+        fp = self.store_dir / "written.npy"
+        offset = np.load(str(fp), mmap_mode='r').offset
+        fd = os.open(str(fp), os.O_WRONLY)
+        try:
+            os.pwrite(fd, b"\x01", offset + position)
+        finally:
+            os.close(fd)
+
+    def written_codes(self):
+        """Return the set of codes of activities whose LCI array is written"""
+        flags = np.load(str(self.store_dir / "written.npy"))
+        return {self.activity_codes[i] for i in np.flatnonzero(flags)}
+
+    def __contains__(self, act_code):
+        if act_code not in self.positions:
+            return False
+        flags = np.load(str(self.store_dir / "written.npy"), mmap_mode='r')
+        return bool(flags[self.positions[act_code]])
+
+    def read(self, act_code):
+        """Return the LCI array of an activity, flows as rows and iterations as columns"""
+        return np.array(self.view(act_code))
+
+    def view(self, act_code):
+        """Return the LCI array of an activity as a read-only view of its memory-mapped chunk, without copy"""
+        chunk_id, position = self._locate(act_code)
+        chunk = self._get_chunk(chunk_id)
+        if chunk is None:
+            return np.zeros((self.number_of_flows, self.iterations), dtype=self.dtype)
+        if self.layout == "activity":
+            return chunk[position]
+        return chunk[:, position, :]
+
+    def read_flow(self, flow_index):
+        """Return values of an elementary flow for all activities, activities as rows
+
+        Rows follow the order of ``activity_codes``. Fastest with the "flow"
+        layout.
+        """
+        values = np.zeros((self.number_of_activities, self.iterations), dtype=self.dtype)
+        for chunk_id in range(-(-self.number_of_activities // self.activities_per_chunk)):
+            chunk = self._get_chunk(chunk_id)
+            if chunk is None:
+                continue
+            first = chunk_id * self.activities_per_chunk
+            if self.layout == "activity":
+                values[first:first + chunk.shape[0]] = chunk[:, flow_index, :]
+            else:
+                values[first:first + chunk.shape[1]] = chunk[flow_index]
+        return values
+
+
+def get_saved_lci_codes(g_samples_dir):
+    """Return codes of activities with a saved LCI array, as .npy, .npc or .npz file or in the store
+
+    If the result_dir has a catalog (see ``catalog``), codes are read from
+    it. Otherwise, the directory is listed only once. Also used for the
+    directories of LCIA arrays of a samples batch.
+
+    Returns
+    --------
+    codes : set
+    """
+    g_samples_dir = Path(g_samples_dir)
+    cataloged = ResultCatalog.for_directory(g_samples_dir)
+    if cataloged is not None:
+        catalog, result_type, method, samples_batch = cataloged
+        return catalog.act_codes(result_type, samples_batch, method)
+    if not g_samples_dir.is_dir():
+        return set()
+    codes = {f[:-4] for f in os.listdir(g_samples_dir) if f.endswith((".npy", COMPRESSED_SUFFIX, COMPACT_SUFFIX))}
+    store = LCIStore.open(g_samples_dir)
+    if store is not None:
+        codes.update(store.written_codes())
+    return codes
+
+
+def load_saved_lci_array(g_samples_dir, act_code, store=None, compact=False):
+    """Return the LCI array of an activity from its .npy, compressed .npc or compact .npz file, or else the store
+
+    If compact, the array is returned as a CompactArray (see ``compact``),
+    else as a dense array. Raises ValueError if the array is not saved.
+    """
+    fp = Path(g_samples_dir) / "{}.npy".format(act_code)
+    compressed_fp = Path(g_samples_dir) / "{}{}".format(act_code, COMPRESSED_SUFFIX)
+    compact_fp = Path(g_samples_dir) / "{}{}".format(act_code, COMPACT_SUFFIX)
+    if compact_fp.is_file():
+        lci = load_compact_array(compact_fp)
+        return lci if compact else lci.to_dense()
+    if fp.is_file():
+        lci = np.load(str(fp))
+    elif compressed_fp.is_file():
+        lci = load_compressed_array(compressed_fp)
+    else:
+        if store is None:
+            store = LCIStore.open(g_samples_dir)
+        if store is None or act_code not in store:
+            raise ValueError("File {} does not exist".format(fp))
+        lci = store.read(act_code)
+    return CompactArray.from_dense(lci) if compact else lci
+
+
+def open_saved_lci_array(g_samples_dir, act_code, store=None):
+    """Return the LCI array of an activity, memory-mapped rather than loaded when possible
+
+    ``.npy`` files are memory-mapped, and arrays of the store are returned as
+    read-only views of its memory-mapped chunks, so that only the values
+    that are indexed are read. Compact and compressed arrays are loaded, see
+    ``load_saved_lci_array``. Also used for the LCIA arrays of a samples
+    batch.
+    """
+    fp = Path(g_samples_dir) / "{}.npy".format(act_code)
+    compressed_fp = Path(g_samples_dir) / "{}{}".format(act_code, COMPRESSED_SUFFIX)
+    compact_fp = Path(g_samples_dir) / "{}{}".format(act_code, COMPACT_SUFFIX)
+    if not compact_fp.is_file():
+        if fp.is_file():
+            return np.load(str(fp), mmap_mode='r')
+        if not compressed_fp.is_file():
+            store = store or LCIStore.open(g_samples_dir)
+            if store is not None and act_code in store:
+                return store.view(act_code)
+    return load_saved_lci_array(g_samples_dir, act_code, store)
@@ -7,6 +7,10 @@ import pyprind
 from .utils import get_ref_bio_dict_from_common_files, _check_result_dir, \
     _check_method, _get_lci_dir, load_LCI_array, load_det_lci, \
     _check_lci_missing, _check_project
+from .lci_store import LCIStore, get_saved_lci_codes, load_saved_lci_array
+from .compression import get_codec, save_compressed_array, COMPRESSED_SUFFIX
+from .compact import CompactArray
+from .catalog import ResultCatalog
 
 
 def get_cf_with_indices(method, ref_bio_dict, project_name):
@@ -53,6 +57,30 @@ def get_cf_with_indices(method, ref_bio_dict, project_name):
     return B_row_indices, cfs
 
 
+def get_flow_indices_for_methods(methods, ref_bio_dict, project_name):
+    """Return sorted biosphere row indices with non-null cfs in any of the methods
+
+    Parameters
+    ----------
+    methods: list
+        List of LCIA methods, using Brightway2 tuple identifiers
+    ref_bio_dict: dict
+        Dictionary mapping elementary flow keys to matrix rows
+    project_name : str
+        Name of the brightway2 project where the database is imported
+
+    Returns
+    --------
+    flow_indices: list of int
+        List of biosphere matrix row indices
+    """
+    flow_indices = set()
+    for method in methods:
+        B_row_indices, cfs = get_cf_with_indices(method, ref_bio_dict, project_name)
+        flow_indices.update(i for i, cf in zip(B_row_indices, cfs) if cf != 0)
+    return sorted(flow_indices)
+
+
 def calculate_lcia_array_from_arrays(
         LCI_array, B_row_indices, cfs,
         dtype=np.float32, return_total=True):
@@ -62,10 +90,11 @@ def calculate_lcia_array_from_arrays(
 
     Parameters
     ----------
-    LCI_array: numpy array
+    LCI_array: numpy array or CompactArray
         Life cycle inventory array, with rows equal to elementary flows
         and columns equal to separate LCI,
-        e.g. from different MonteCarlo iterations
+        e.g. from different MonteCarlo iterations. If compact (see
+        ``compact``), only the characterized rows that are stored are used.
     B_row_indices: list of int
         List of biosphere matrix row indices
     cfs: list of float
@@ -74,13 +103,21 @@ def calculate_lcia_array_from_arrays(
         dtype to which the resulting LCIA array must be converted
     return_total: bool, default=True
         If True, sum LCIA array rows, returning total scores
-        If False, returns an LCIA array with the same dimension as the LCI array
+        If False, returns an LCIA array with the same dimension as the LCI
+        array, in compact form if LCI_array is compact
 
     Returns
     --------
-    lcia_array: numpy.ndarray
+    lcia_array: numpy.ndarray or CompactArray
         Array of LCIA scores
     """
+    if isinstance(LCI_array, CompactArray):
+        present, lcia_array = _characterize_compact_array(LCI_array, B_row_indices, cfs, dtype)
+        if return_total:
+            return lcia_array.sum(axis=0)
+        rows = np.asarray(B_row_indices, dtype=np.int64)[present]
+        order = np.argsort(rows)
+        return CompactArray(rows[order], lcia_array[order], LCI_array.shape)
     filtered_LCI_array = LCI_array[B_row_indices][:]
     cf_array = np.reshape(np.array(cfs), (-1, 1))
     lcia_array = (np.array(filtered_LCI_array) * cf_array)
@@ -96,6 +133,19 @@ def calculate_lcia_array_from_arrays(
         return LCI_array_full
 
 
+def _characterize_compact_array(LCI_array, B_row_indices, cfs, dtype=np.float32):
+    """Return positions in B_row_indices of the rows stored in a CompactArray, and these rows characterized
+
+    Rows of characterized flows that are not stored (always zero) are
+    neither read nor multiplied.
+    """
+    positions = LCI_array.locate(B_row_indices)
+    present = np.flatnonzero(positions >= 0)
+    cf_array = np.reshape(np.asarray(cfs, dtype=np.float64)[present], (-1, 1))
+    lcia_array = LCI_array.values[positions[present]] * cf_array
+    return present, lcia_array.astype(dtype, copy=False)
+
+
 def calculate_lcia_array_from_activity_code(result_dir, act_code, method,
                                             samples_batch=0, dtype=np.float32,
                                             return_total=True, project_name=False):
@@ -121,19 +171,20 @@ def calculate_lcia_array_from_activity_code(result_dir, act_code, method,
         Name of the brightway2 project where the database is imported
     """
     result_dir = Path(_check_result_dir(result_dir))
-    lci_arr = load_LCI_array(result_dir, act_code, samples_batch)
+    lci_arr = load_LCI_array(result_dir, act_code, samples_batch, compact=True)
     B_row_indices, cfs = get_cf_with_indices(
         method,
         get_ref_bio_dict_from_common_files(result_dir / "common_files"),
         project_name
     )
-    return calculate_lcia_array_from_arrays(lci_arr, B_row_indices, cfs, dtype, return_total)
+    lcia_arr = calculate_lcia_array_from_arrays(lci_arr, B_row_indices, cfs, dtype, return_total)
+    return lcia_arr if return_total else lcia_arr.to_dense()
 
 
 def save_all_lcia_score_arrays(result_dir, method, result_type='probabilistic',
                                samples_batch=0, dtype=np.float32,
                                return_total=True, return_per_exchange=True,
-                               ignore_missing=True, project_name=None):
+                               ignore_missing=True, project_name=None, codec=None, codec_options=None):
     """ Calculate and save LCIA score arrays for given set of LCI arrays and method
 
     Parameters
@@ -159,12 +210,18 @@ def save_all_lcia_score_arrays(result_dir, method, result_type='probabilistic',
         will only proceed if all expected LCI arrays are found in the LCI array.
     project_name : str
         Name of the brightway2 project where the database is imported
+    codec : str, default=None
+        If specified, LCIA arrays are saved compressed with this codec, in
+        ``<act_code>.npc`` files (see ``compression``)
+    codec_options : dict, default=None
+        Keyword arguments of the codec, e.g. {"level": 9}
 
     Returns
     -------
     None
     """
     result_dir = Path(_check_result_dir(result_dir))
+    codec = None if codec is None else get_codec(codec, **(codec_options or {}))
     if project_name:
         projects.set_current(_check_project(project_name))
     method = _check_method(method)
@@ -174,7 +231,7 @@ def save_all_lcia_score_arrays(result_dir, method, result_type='probabilistic',
     except:
         raise ValueError("No {} LCI results, need to generate these first".format(result_type))
     if not ignore_missing:
-        if not _check_lci_missing(result_dir):
+        if not _check_lci_missing(result_dir, result_type, samples_batch):
             raise ValueError(
                 "The expected LCI arrays and the LCI arrays in the LCI folder differ.")
     LCIA_dir = result_dir / result_type / abbr
@@ -195,20 +252,34 @@ def save_all_lcia_score_arrays(result_dir, method, result_type='probabilistic',
     if return_per_exchange:
         per_exchange_LCIA_dir = LCIA_dir / "per_exchange" / str(samples_batch)
         per_exchange_LCIA_dir.mkdir(exist_ok=True, parents=True)
-    fps_to_treat = [fp for fp in LCI_dir.iterdir()]
-    for LCI_fp in pyprind.prog_bar(fps_to_treat):
+    # LCI arrays saved as .npy or .npc files or in the LCI store of the samples batch
+    store = LCIStore.open(LCI_dir) if result_type == 'probabilistic' else None
+    codes_to_treat = sorted(get_saved_lci_codes(LCI_dir))
+
+    # Probabilistic LCIA arrays are recorded in the catalog of the result_dir, if there is one
+    catalog = ResultCatalog.open(result_dir) if result_type == 'probabilistic' else None
+
+    def save(dirpath, act_code, arr):
+        if codec is None:
+            fp = dirpath / "{}.npy".format(act_code)
+            np.save(str(fp), arr)
+        else:
+            fp = dirpath / "{}{}".format(act_code, COMPRESSED_SUFFIX)
+            save_compressed_array(fp, arr, codec)
+        if catalog is not None:
+            catalog.record("LCIA_{}".format(dirpath.parent.name), act_code, fp, samples_batch, abbr, arr=arr)
+
+    for act_code in pyprind.prog_bar(codes_to_treat):
         try:
-            if not LCI_fp.is_file(): #Because there is sometimes a temp directory
-                continue
-            LCI_array = np.load(str(LCI_fp))
-            LCIA_array = calculate_lcia_array_from_arrays(
-                LCI_array, B_row_indices, cfs, dtype, return_total=False)
+            # Compact form: only rows of flows that are non-zero in some iteration are characterized
+            LCI_array = load_saved_lci_array(LCI_dir, act_code, store, compact=True)
+            _, LCIA_array = _characterize_compact_array(LCI_array, B_row_indices, cfs, dtype)
             if return_total:
-                np.save(str(total_LCIA_dir / LCI_fp.name), LCIA_array.sum(axis=0).reshape(1, -1))
+                save(total_LCIA_dir, act_code, LCIA_array.sum(axis=0).reshape(1, -1))
             if return_per_exchange:
-                np.save(str(per_exchange_LCIA_dir / LCI_fp.name), LCIA_array.sum(axis=0))
+                save(per_exchange_LCIA_dir, act_code, LCIA_array.sum(axis=0))
         except Exception as err:
-            print("Skipping {}: {}".format(LCI_fp.name, err))
+            print("Skipping {}: {}".format(act_code, err))
     return None
 
 
@@ -0,0 +1,224 @@
+""" Claiming of work blocks through lease files on a shared filesystem
+
+Independent processes, possibly on different nodes or clusters, share the
+work of a samples batch without a scheduler: before calculating a block of
+work, a process atomically creates ``<block_id>.lease`` in the lease
+directory of the batch. The lease is renewed (its modification time is
+updated) while the block is being calculated, and a ``<block_id>.done``
+marker is written when it is finished. Leases that have not been renewed
+for ``lease_duration`` seconds, e.g. because their owner was killed at the
+end of its allocation, are considered expired and can be reclaimed by any
+process.
+
+Creation of the lease with O_EXCL and reclaiming through a rename are
+atomic on local filesystems, Lustre and NFSv3+. lease_duration should be
+much larger than the renewal interval and than clock differences between
+nodes.
+
+A process whose lease was lost (it was not renewed in time, e.g. after a
+long pause, and was reclaimed by another process) must stop calculating the
+block: ``Lease.check`` raises ``LeaseLost``, and is called by the LCI
+calculators before writing results.
+"""
+from pathlib import Path
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+def get_lease_dir(result_dir, samples_batch):
+    """Return the directory with lease files of a samples_batch, creating it if needed"""
+    lease_dir = Path(result_dir) / "probabilistic" / "LCI_metadata" / str(samples_batch) / "leases"
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    return lease_dir
+
+
+class LeaseLost(Exception):
+    """Raised by Lease.check when the lease was reclaimed by another process"""
+
+
+class Lease(object):
+    """Lease on a block of work, held by one process
+
+    Obtained with ``try_claim``. ``start_heartbeat`` renews the lease from a
+    background thread while the block is calculated, ``mark_done`` records
+    that the block is finished and ``release`` gives it up.
+    """
+    def __init__(self, lease_dir, block_id, token):
+        self.lease_dir = Path(lease_dir)
+        self.block_id = block_id
+        self.token = token
+        self.fp = self.lease_dir / "{}.lease".format(block_id)
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def is_owned(self):
+        """Return True if the lease file still belongs to this lease"""
+        try:
+            with open(self.fp) as f:
+                return json.load(f)['token'] == self.token
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def renew(self):
+        """Update the modification time of the lease, return False if it was lost"""
+        if not self.is_owned():
+            self.lost = True
+            return False
+        os.utime(str(self.fp))
+        return True
+
+    def check(self):
+        """Raise LeaseLost if the lease was lost, e.g. reclaimed by another process after expiring"""
+        if self.lost or not self.is_owned():
+            self.lost = True
+            raise LeaseLost("Lease on {} was lost".format(self.block_id))
+
+    def start_heartbeat(self, interval):
+        """Renew the lease every interval seconds until released"""
+        def beat():
+            while not self._stop.wait(interval):
+                if not self.renew():
+                    print("Lease on {} was lost".format(self.block_id))
+                    return
+        self._heartbeat = threading.Thread(target=beat, daemon=True)
+        self._heartbeat.start()
+
+    def release(self):
+        """Stop renewing the lease and remove the lease file if still owned"""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self.is_owned():
+            self.fp.unlink()
+
+    def mark_done(self):
+        """Record that the block is finished, then release the lease
+
+        Returns False, without recording anything, if the lease was lost:
+        the block is then finished by the process that reclaimed it.
+        """
+        if self.lost or not self.is_owned():
+            self.lost = True
+            self.release()
+            return False
+        _write_atomically(self.lease_dir / "{}.done".format(self.block_id), {
+            'token': self.token, 'finished_at': time.time(),
+        })
+        self.release()
+        return True
+
+
+def _write_atomically(fp, content):
+    """Write content as json to fp, through a temporary file and a rename"""
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, uuid.uuid4().hex))
+    with open(temp_fp, "w") as f:
+        json.dump(content, f)
+    os.replace(str(temp_fp), str(fp))
+
+
+def is_block_done(lease_dir, block_id):
+    """Return True if the block was marked done"""
+    return (Path(lease_dir) / "{}.done".format(block_id)).is_file()
+
+
+def mark_block_done(lease_dir, block_id):
+    """Mark a block done without holding its lease, e.g. for existing results"""
+    _write_atomically(Path(lease_dir) / "{}.done".format(block_id), {
+        'token': None, 'finished_at': time.time(),
+    })
+
+
+def try_claim(lease_dir, block_id, lease_duration):
+    """Try to claim a block of work, return a Lease or None
+
+    Returns None if the block is done or held by another process whose
+    lease has not expired.
+
+    Parameters
+    -----------
+    lease_dir : str
+        Directory with lease files, see get_lease_dir
+    block_id : str
+        Identifier of the block of work, used in file names
+    lease_duration : float
+        Seconds after the last renewal after which a lease is expired
+
+    Returns
+    --------
+    lease : Lease or None
+    """
+    lease_dir = Path(lease_dir)
+    if is_block_done(lease_dir, block_id):
+        return None
+    token = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+    fp = lease_dir / "{}.lease".format(block_id)
+    for attempt in range(2):
+        try:
+            fd = os.open(str(fp), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt or not _reclaim_if_expired(fp, lease_duration):
+                return None
+            continue
+        with os.fdopen(fd, "w") as f:
+            json.dump({'token': token, 'claimed_at': time.time()}, f)
+        # The block may have been finished between the first check and the claim
+        if is_block_done(lease_dir, block_id):
+            fp.unlink()
+            return None
+        return Lease(lease_dir, block_id, token)
+    return None
+
+
+def _reclaim_if_expired(fp, lease_duration):
+    """Remove an expired lease file, return True if this process removed it
+
+    The lease is first renamed to a unique name: only one of several
+    processes reclaiming the same lease succeeds.
+    """
+    try:
+        if time.time() - fp.stat().st_mtime < lease_duration:
+            return False
+        expired_fp = fp.with_name("{}.expired.{}".format(fp.name, uuid.uuid4().hex))
+        os.rename(str(fp), str(expired_fp))
+    except FileNotFoundError:
+        return False
+    if time.time() - expired_fp.stat().st_mtime >= lease_duration:
+        expired_fp.unlink()
+        return True
+    # Renewed by its owner in the meantime: put it back
+    try:
+        os.link(str(expired_fp), str(fp))
+    except FileExistsError:
+        pass
+    expired_fp.unlink()
+    return False
+
+
+def lease_status(lease_dir, lease_duration):
+    """Return block ids of the lease directory, by status
+
+    Returns
+    --------
+    status : dict
+        "done", "active" (lease renewed in the last lease_duration seconds)
+        and "expired" sets of block ids
+    """
+    status = {'done': set(), 'active': set(), 'expired': set()}
+    now = time.time()
+    for entry in os.scandir(str(lease_dir)):
+        if entry.name.endswith(".done"):
+            status['done'].add(entry.name[:-len(".done")])
+        elif entry.name.endswith(".lease"):
+            try:
+                expired = now - entry.stat().st_mtime >= lease_duration
+            except FileNotFoundError:
+                continue
+            status['expired' if expired else 'active'].add(entry.name[:-len(".lease")])
+    status['active'] -= status['done']
+    status['expired'] -= status['done']
+    return status
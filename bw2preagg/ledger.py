@@ -0,0 +1,223 @@
+""" Completion ledger of LCI arrays
+
+Every time an LCI array is saved to its final location, a record with its
+shape, dtype, number of NaN and zero columns and checksum is appended to
+``lci_ledger.jsonl`` in the LCI_metadata directory of the samples batch.
+Resuming calculations, checking for missing arrays and reporting progress
+then read this single file rather than listing the LCI directory once per
+activity and loading every array.
+
+Each record is written with a single append, so that records of concurrent
+workers are never interleaved. If an array is saved again, the last record
+is the valid one. Arrays saved without record, e.g. in result directories
+generated before the ledger existed, are unverified: they are not counted
+as done until ``record_unverified_lci_arrays`` records them, which
+dispatching LCI calculations does, or ``rebuild_lci_ledger`` creates the
+ledger from all arrays on disk.
+"""
+from pathlib import Path
+import json
+import os
+import time
+import zlib
+import numpy as np
+from .lci_store import LCIStore, get_saved_lci_codes, load_saved_lci_array
+from .compression import COMPRESSED_SUFFIX
+from .compact import COMPACT_SUFFIX
+
+LEDGER_FILENAME = "lci_ledger.jsonl"
+
+
+def get_lci_ledger_fp(g_samples_dir):
+    """Return the path to the ledger of the LCI arrays in g_samples_dir
+
+    The ledger of ``<result_dir>/probabilistic/LCI/<samples_batch>`` is
+    ``<result_dir>/probabilistic/LCI_metadata/<samples_batch>/lci_ledger.jsonl``.
+    """
+    g_samples_dir = Path(g_samples_dir)
+    return g_samples_dir.parent.parent / "LCI_metadata" / g_samples_dir.name / LEDGER_FILENAME
+
+
+def summarize_lci_array(lci):
+    """Return the ledger record fields describing an LCI array
+
+    Parameters
+    -----------
+    lci : numpy.ndarray
+        LCI array, elementary flows as rows and iterations as columns
+
+    Returns
+    --------
+    summary : dict
+        "shape", "dtype", "nan_columns" (columns with at least one NaN, i.e.
+        failed iterations), "zero_columns" (columns summing to 0, i.e.
+        iterations not calculated) and "checksum" (CRC32 of the data)
+    """
+    lci = np.ascontiguousarray(lci)
+    column_sums = lci.sum(axis=0)
+    return {
+        'shape': list(lci.shape),
+        'dtype': str(lci.dtype),
+        'nan_columns': int(np.isnan(column_sums).sum()),
+        'zero_columns': int((column_sums == 0).sum()),
+        'checksum': zlib.crc32(lci.data) & 0xffffffff,
+    }
+
+
+def record_lci_array(g_samples_dir, act_code, lci, finished_at=None):
+    """Append the record of a saved LCI array to the ledger, and return it
+
+    finished_at is the time at which the array was saved, now by default.
+    """
+    fp = get_lci_ledger_fp(g_samples_dir)
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    record = dict(summarize_lci_array(lci), act_code=act_code,
+                  finished_at=time.time() if finished_at is None else finished_at)
+    line = (json.dumps(record) + "\n").encode()
+    fd = os.open(str(fp), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+    return record
+
+
+def read_lci_ledger(g_samples_dir):
+    """Return the last ledger record of every activity, by activity code
+
+    Returns an empty dict if there is no ledger. Incomplete lines, e.g. a
+    record being written, are ignored.
+    """
+    fp = get_lci_ledger_fp(g_samples_dir)
+    records = {}
+    if not fp.is_file():
+        return records
+    with open(fp) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['act_code']] = record
+    return records
+
+
+def is_lci_record_complete(record):
+    """Return True if all iterations of the recorded LCI array were calculated"""
+    return record['zero_columns'] == 0
+
+
+def is_lci_record_done(record):
+    """Return True if the recorded LCI array is complete and has no failed (NaN) iteration"""
+    return is_lci_record_complete(record) and record['nan_columns'] == 0
+
+
+def get_completed_lci_codes(g_samples_dir):
+    """Return codes of activities whose LCI array is done and need not be recalculated
+
+    An array is done if it exists, as .npy file or in the LCI store, and
+    its ledger record has no column left to 0 and no failed (NaN) column.
+    Arrays without record are unverified, and not done (see
+    ``record_unverified_lci_arrays``). The LCI directory is listed only once.
+
+    Returns
+    --------
+    codes : set
+    """
+    saved = get_saved_lci_codes(g_samples_dir)
+    if not saved:
+        return set()
+    records = read_lci_ledger(g_samples_dir)
+    return {code for code in saved if code in records and is_lci_record_done(records[code])}
+
+
+def get_unverified_lci_codes(g_samples_dir, records=None):
+    """Return codes of activities whose LCI array is saved without ledger record
+
+    records are the ledger records returned by ``read_lci_ledger``, read
+    if None.
+    """
+    if records is None:
+        records = read_lci_ledger(g_samples_dir)
+    return get_saved_lci_codes(g_samples_dir).difference(records)
+
+
+def record_unverified_lci_arrays(g_samples_dir, act_codes=None):
+    """Load the LCI arrays saved without ledger record and append their records
+
+    Only these arrays are loaded, and only those of act_codes if specified.
+    Records get the modification time of the array file, or the current
+    time for arrays in the store.
+
+    Returns
+    --------
+    records : dict
+        Ledger record of the arrays recorded, by activity code
+    """
+    g_samples_dir = Path(g_samples_dir)
+    records = {}
+    store = None
+    unverified = get_unverified_lci_codes(g_samples_dir)
+    if act_codes is not None:
+        unverified.intersection_update(act_codes)
+    for act_code in sorted(unverified):
+        if store is None:
+            store = LCIStore.open(g_samples_dir)
+        finished_at = None
+        for suffix in [".npy", COMPRESSED_SUFFIX, COMPACT_SUFFIX]:
+            fp = g_samples_dir / "{}{}".format(act_code, suffix)
+            if fp.is_file():
+                finished_at = fp.stat().st_mtime
+        lci = load_saved_lci_array(g_samples_dir, act_code, store)
+        records[act_code] = record_lci_array(g_samples_dir, act_code, lci, finished_at)
+    return records
+
+
+def rebuild_lci_ledger(result_dir, samples_batch=0):
+    """Rebuild the ledger of a samples_batch from the LCI arrays on disk
+
+    Every LCI array, as .npy or .npc file or in the LCI store, is loaded once. The
+    new ledger replaces the existing one atomically.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    samples_batch : int, default=0
+        Integer id for sample batch
+
+    Returns
+    --------
+    records : dict
+        Ledger record per activity code
+    """
+    from .utils import _check_result_dir, _get_lci_dir
+    result_dir = Path(_check_result_dir(result_dir))
+    g_samples_dir = _get_lci_dir(result_dir, 'probabilistic', samples_batch, must_exist=True)
+    fp = get_lci_ledger_fp(g_samples_dir)
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    temp_fp = fp.with_name("{}.{}.tmp".format(fp.name, os.getpid()))
+    records = {}
+    with open(temp_fp, "w") as f:
+        for filename in sorted(os.listdir(g_samples_dir)):
+            if filename.endswith(".npy"):
+                lci = np.load(str(g_samples_dir / filename), mmap_mode='r')
+            elif filename.endswith((COMPRESSED_SUFFIX, COMPACT_SUFFIX)):
+                lci = load_saved_lci_array(g_samples_dir, filename[:-4])
+            else:
+                continue
+            act_code = filename[:-4]
+            records[act_code] = dict(
+                summarize_lci_array(lci), act_code=act_code,
+                finished_at=(g_samples_dir / filename).stat().st_mtime
+            )
+            f.write(json.dumps(records[act_code]) + "\n")
+        store = LCIStore.open(g_samples_dir)
+        if store is not None:
+            written_at = (store.store_dir / "written.npy").stat().st_mtime
+            for act_code in sorted(store.written_codes().difference(records)):
+                records[act_code] = dict(
+                    summarize_lci_array(store.read(act_code)), act_code=act_code, finished_at=written_at)
+                f.write(json.dumps(records[act_code]) + "\n")
+    os.replace(str(temp_fp), str(fp))
+    return records
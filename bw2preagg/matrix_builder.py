@@ -0,0 +1,261 @@
+""" Lean assembly of sampled LCA matrices from presamples packages
+
+Used by the iteration-major LCI engine instead of ``MonteCarloLCA``: the
+presamples arrays of a campaign are read once, the position of every sampled
+exchange in the deterministic matrices is computed once, and each iteration
+only overwrites the ``data`` vector of the matrices in place.
+"""
+from pathlib import Path
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+from bw2data.utils import TYPE_DICTIONARY
+
+
+def _load_common_file(common_files_dir, filename):
+    """Load a pickled common file, raising ValueError if it is missing"""
+    fp = Path(common_files_dir) / filename
+    if not fp.is_file():
+        raise ValueError(
+            "Missing common file {}, run setup_project with "
+            "force_write_common_files=True".format(fp)
+        )
+    with open(fp, "rb") as f:
+        return pickle.load(f)
+
+
+def _positions_in_sparse(matrix, rows, cols):
+    """Return indices in ``matrix.data`` of elements (rows, cols)
+
+    ``matrix`` must be a CSC or CSR matrix with canonical format (sorted
+    indices, no duplicates). Raises ValueError if an element is not part of
+    the matrix sparsity structure.
+    """
+    if matrix.format == 'csc':
+        major, minor, n_minor = np.asarray(cols), np.asarray(rows), matrix.shape[0]
+    elif matrix.format == 'csr':
+        major, minor, n_minor = np.asarray(rows), np.asarray(cols), matrix.shape[1]
+    else:
+        raise ValueError("Matrix format {} not supported".format(matrix.format))
+    structure_keys = np.repeat(
+        np.arange(len(matrix.indptr) - 1, dtype=np.int64),
+        np.diff(matrix.indptr)
+    ) * n_minor + matrix.indices
+    keys = major.astype(np.int64) * n_minor + minor
+    positions = np.searchsorted(structure_keys, keys)
+    found = positions < len(structure_keys)
+    found[found] = structure_keys[positions[found]] == keys[found]
+    missing = ~found
+    if np.any(missing):
+        raise ValueError(
+            "{} sampled exchanges are not in the deterministic matrix".format(
+                int(missing.sum())
+            )
+        )
+    return positions
+
+
+class CampaignMatrixBuilder:
+    """Technosphere and biosphere matrices updated in place from presamples
+
+    The deterministic matrices and the row and column dictionaries are taken
+    from the common files (see ``setup_project``). Matrix data from all
+    presamples packages of a campaign is then indexed once.
+
+    As with ``presamples``, packages are applied in the order they are given:
+    if an exchange is sampled in more than one package, the value of the
+    *last* package is used (i.e. balancing presamples override base
+    presamples). Only packages with a "sequential" seed are supported, so
+    that iteration ``i`` uses column ``i`` of every package.
+
+    Parameters
+    -----------
+    presamples_paths : list
+        Ordered list of paths to presamples packages, e.g. from a campaign
+    common_files_dir : str
+        Path to the common files directory of the result_dir
+
+    Attributes
+    -----------
+    technosphere_matrix : scipy.sparse.csc_matrix
+        Technosphere matrix, with technosphere inputs negative
+    biosphere_matrix : scipy.sparse.csr_matrix
+        Biosphere matrix
+    ncols : int
+        Number of columns (iterations) in the presamples packages
+    """
+    def __init__(self, presamples_paths, common_files_dir):
+        self._load_deterministic_matrices(common_files_dir)
+        io_mapping = _load_common_file(common_files_dir, "IO_Mapping.pickle")
+        matrices = {
+            'technosphere_matrix': (self.technosphere_matrix, self.product_dict),
+            'biosphere_matrix': (self.biosphere_matrix, self.bio_dict),
+        }
+
+        resources = []
+        ncols = set()
+        for path in presamples_paths:
+            path = Path(path)
+            with open(path / "datapackage.json", "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            if metadata['seed'] != 'sequential':
+                raise ValueError(
+                    "Presamples package {} does not have a sequential seed".format(path)
+                )
+            ncols.add(metadata['ncols'])
+            for resource in metadata['resources']:
+                if resource.get('matrix') not in matrices:
+                    continue
+                matrix, row_dict = matrices[resource['matrix']]
+                indices = np.load(str(path / resource['indices']['filepath']))
+                rows = np.array([row_dict[io_mapping[i]] for i in indices['input']], dtype=np.int64)
+                cols = np.array([self.activity_dict[io_mapping[i]] for i in indices['output']], dtype=np.int64)
+                signs = np.ones(len(indices))
+                if resource['matrix'] == 'technosphere_matrix':
+                    signs[indices['type'] == TYPE_DICTIONARY["technosphere"]] = -1
+                resources.append({
+                    'matrix': resource['matrix'],
+                    'samples': np.load(str(path / resource['samples']['filepath']), mmap_mode='r'),
+                    'ncols': metadata['ncols'],
+                    'positions': _positions_in_sparse(matrix, rows, cols),
+                    'signs': signs,
+                })
+        if not resources:
+            raise ValueError("No matrix data found in presamples packages")
+        self.ncols = min(ncols)
+        self.resources = self._drop_overridden(resources)
+
+    def _load_deterministic_matrices(self, common_files_dir):
+        self.common_files_dir = Path(common_files_dir)
+        self.product_dict = _load_common_file(common_files_dir, "product_dict.pickle")
+        self.activity_dict = _load_common_file(common_files_dir, "activity_dict.pickle")
+        self.bio_dict = _load_common_file(common_files_dir, "bio_dict.pickle")
+        A = _load_common_file(common_files_dir, "A_as_coo_scipy.pickle").tocsc()
+        A.sum_duplicates()
+        B = _load_common_file(common_files_dir, "B_as_coo_scipy.pickle").tocsr()
+        B.sum_duplicates()
+        self.technosphere_matrix = A.astype(np.float64)
+        self.biosphere_matrix = B.astype(np.float64)
+
+    def save_shared_samples(self, dirpath, presamples_paths=None, rows_per_chunk=10000):
+        """Save the sampled values of all packages in one iteration-major array
+
+        The samples used by ``update`` (i.e. after removing values overridden
+        by later packages) are written to ``samples.npy`` in ``dirpath``,
+        with one row per iteration, so that every iteration reads a single
+        contiguous row. Positions in the matrices are saved in
+        ``index.npz``. Workers then attach to these files read-only with
+        ``from_shared_samples``: the operating system keeps a single copy of
+        the memory-mapped samples in memory for all workers of a machine.
+        ``dirpath`` can be on a memory-backed filesystem, e.g. /dev/shm.
+
+        The directory is first written under a temporary name and then
+        renamed, so that concurrent readers never see a partial copy.
+
+        Parameters
+        -----------
+        dirpath : str
+            Directory where the shared samples are saved
+        presamples_paths : list, default=None
+            Paths of the presamples packages, recorded to detect stale copies
+        rows_per_chunk : int, default=10000
+            Number of sampled exchanges copied at once
+        """
+        dirpath = Path(dirpath)
+        temp_dirpath = dirpath.parent / "{}.{}.tmp".format(dirpath.name, os.getpid())
+        temp_dirpath.mkdir(parents=True, exist_ok=True)
+        total = sum(len(r['sample_rows']) for r in self.resources)
+        shared = np.lib.format.open_memmap(
+            str(temp_dirpath / "samples.npy"), mode='w+', dtype=np.float64, shape=(self.ncols, total))
+        index = {}
+        offset = 0
+        for i, r in enumerate(self.resources):
+            kept = r['sample_rows']
+            for start in range(0, len(kept), rows_per_chunk):
+                rows = kept[start:start + rows_per_chunk]
+                shared[:, offset + start:offset + start + len(rows)] = \
+                    r['samples'][rows][:, np.arange(self.ncols) % r['ncols']].T
+            index['positions_{}'.format(i)] = r['positions']
+            index['signs_{}'.format(i)] = r['signs']
+            index['offsets_{}'.format(i)] = np.array([offset, offset + len(kept)])
+            offset += len(kept)
+        shared.flush()
+        del shared
+        np.savez(str(temp_dirpath / "index.npz"), **index)
+        with open(temp_dirpath / "metadata.json", "w") as f:
+            json.dump({
+                'matrices': [r['matrix'] for r in self.resources],
+                'ncols': self.ncols,
+                'presamples_paths': [str(p) for p in presamples_paths or []],
+            }, f, indent=4)
+        if dirpath.is_dir():
+            shutil.rmtree(str(dirpath))
+        os.replace(str(temp_dirpath), str(dirpath))
+
+    @classmethod
+    def from_shared_samples(cls, dirpath, common_files_dir):
+        """Builder attached read-only to samples saved by ``save_shared_samples``"""
+        dirpath = Path(dirpath)
+        builder = cls.__new__(cls)
+        builder._load_deterministic_matrices(common_files_dir)
+        with open(dirpath / "metadata.json", "r") as f:
+            metadata = json.load(f)
+        shared = np.load(str(dirpath / "samples.npy"), mmap_mode='r')
+        builder.ncols = metadata['ncols']
+        builder.resources = []
+        with np.load(str(dirpath / "index.npz")) as index:
+            for i, matrix in enumerate(metadata['matrices']):
+                first, last = index['offsets_{}'.format(i)]
+                builder.resources.append({
+                    'matrix': matrix,
+                    'samples': shared[:, first:last],
+                    'iteration_major': True,
+                    'ncols': metadata['ncols'],
+                    'positions': index['positions_{}'.format(i)],
+                    'signs': index['signs_{}'.format(i)],
+                    'sample_rows': slice(None),
+                })
+        return builder
+
+    @staticmethod
+    def shared_samples_metadata(dirpath):
+        """Return metadata of shared samples saved in dirpath, or None"""
+        fp = Path(dirpath) / "metadata.json"
+        if not fp.is_file():
+            return None
+        with open(fp, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _drop_overridden(resources):
+        """Keep, for each matrix element, only the last resource sampling it"""
+        for matrix in {r['matrix'] for r in resources}:
+            subset = [r for r in resources if r['matrix'] == matrix]
+            positions = np.concatenate([r['positions'] for r in subset])
+            owners = np.concatenate([np.full(len(r['positions']), i) for i, r in enumerate(subset)])
+            rows = np.concatenate([np.arange(len(r['positions'])) for r in subset])
+            # First occurrence in reversed arrays is the last one in the original arrays
+            _, last = np.unique(positions[::-1], return_index=True)
+            last = len(positions) - 1 - last
+            for i, r in enumerate(subset):
+                kept = np.sort(rows[last[owners[last] == i]])
+                r['sample_rows'] = kept
+                r['positions'] = r['positions'][kept]
+                r['signs'] = r['signs'][kept]
+        return [r for r in resources if len(r['sample_rows'])]
+
+    def update(self, index):
+        """Overwrite matrix values with those of iteration ``index``
+
+        Returns the updated (technosphere_matrix, biosphere_matrix)
+        """
+        for r in self.resources:
+            matrix = getattr(self, r['matrix'])
+            if r.get('iteration_major'):
+                sample = r['samples'][index % r['ncols']]
+            else:
+                sample = r['samples'][:, index % r['ncols']]
+            matrix.data[r['positions']] = sample[r['sample_rows']] * r['signs']
+        return self.technosphere_matrix, self.biosphere_matrix
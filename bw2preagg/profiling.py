@@ -0,0 +1,141 @@
+""" Per-phase timing of LCI calculations
+
+When enabled, workers record the wall and CPU time spent in each phase of
+the LCI calculations (project switch, loading presamples, rebuilding
+matrices, factorizing, solving, reducing the inventory, writing memmaps and
+saving the final arrays) to one JSON Lines file per worker. Phases can be
+nested: the phase of a record is the ";"-separated stack of phase names,
+as in folded stacks used by flame graph tools.
+
+``summarize_phase_timings`` aggregates the files of all workers, and
+``print_phase_summary`` prints the time spent in each phase as a tree.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import socket
+import time
+
+PHASE_TIMINGS_DIRNAME = "phase_timings"
+
+
+class PhaseTimer(object):
+    """Accumulate wall and CPU time per phase and write them as JSON Lines
+
+    A timer without filepath is disabled: ``phase`` then does nothing, so
+    that instrumented code costs almost nothing when not profiled.
+
+    Parameters
+    -----------
+    filepath : str, default=None
+        File to which records are appended. If None, the timer is disabled.
+    per_iteration : bool, default=False
+        If True, records are written at every iteration (see
+        ``iteration_done``), otherwise only when ``flush`` is called, e.g.
+        once per activity.
+    """
+    def __init__(self, filepath=None, per_iteration=False):
+        self.filepath = None if filepath is None else Path(filepath)
+        self.enabled = filepath is not None
+        self.per_iteration = per_iteration
+        self._stack = []
+        self._totals = {}
+
+    @classmethod
+    def for_worker(cls, profile_dir, worker_id, per_iteration=False):
+        """Return a timer writing to a file of profile_dir specific to this process, or a disabled timer"""
+        if profile_dir is None:
+            return cls()
+        Path(profile_dir).mkdir(parents=True, exist_ok=True)
+        filename = "{}_{}_{}.jsonl".format(socket.gethostname(), os.getpid(), worker_id)
+        return cls(Path(profile_dir) / filename, per_iteration)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase name, nested in the current phases"""
+        if not self.enabled:
+            yield
+            return
+        self._stack.append(name)
+        key = ";".join(self._stack)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            totals = self._totals.setdefault(key, [0., 0., 0])
+            totals[0] += time.perf_counter() - wall
+            totals[1] += time.process_time() - cpu
+            totals[2] += 1
+            self._stack.pop()
+
+    def iteration_done(self, **context):
+        """Write records of the iteration if per_iteration, with context (e.g. iteration=i)"""
+        if self.per_iteration:
+            self.flush(**context)
+
+    def flush(self, **context):
+        """Write one record per phase timed since the last flush, with context"""
+        if not self.enabled or not self._totals:
+            return
+        with open(self.filepath, "a") as f:
+            for key, (wall, cpu, count) in self._totals.items():
+                f.write(json.dumps(dict(context, phase=key, wall=wall, cpu=cpu, count=count)) + "\n")
+        self._totals = {}
+
+
+def summarize_phase_timings(profile_dir):
+    """Aggregate the phase timings of all workers
+
+    Parameters
+    -----------
+    profile_dir : str
+        Directory with the JSON Lines files written by PhaseTimer
+
+    Returns
+    --------
+    summary : dict
+        Per phase (";"-separated stack), total "wall" and "cpu" time in
+        seconds, "count" and "self_wall", the wall time not spent in
+        nested phases
+    """
+    summary = {}
+    for fp in sorted(Path(profile_dir).glob("*.jsonl")):
+        with open(fp) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                totals = summary.setdefault(record['phase'], {'wall': 0., 'cpu': 0., 'count': 0})
+                totals['wall'] += record['wall']
+                totals['cpu'] += record['cpu']
+                totals['count'] += record['count']
+    for key, totals in summary.items():
+        children = [
+            other for other in summary
+            if other.startswith(key + ";") and other.count(";") == key.count(";") + 1
+        ]
+        totals['self_wall'] = max(0., totals['wall'] - sum(summary[c]['wall'] for c in children))
+    return summary
+
+
+def print_phase_summary(summary):
+    """Print the time per phase as an indented tree, with share of total wall time"""
+    total = sum(v['wall'] for k, v in summary.items() if ";" not in k)
+    if not total:
+        print("No phase timings")
+        return
+    print("{:<50}{:>12}{:>8}{:>12}{:>10}".format("Phase", "Wall (s)", "%", "CPU (s)", "Count"))
+    for key in sorted(summary):
+        totals = summary[key]
+        name = "  " * key.count(";") + key.split(";")[-1]
+        print("{:<50}{:>12.2f}{:>8.1f}{:>12.2f}{:>10}".format(
+            name, totals['wall'], 100 * totals['wall'] / total, totals['cpu'], totals['count']))
+
+
+def write_folded_stacks(summary, filepath):
+    """Write self wall times as folded stacks (microseconds), for flame graph tools"""
+    with open(filepath, "w") as f:
+        for key in sorted(summary):
+            f.write("{} {}\n".format(key, int(round(summary[key]['self_wall'] * 1e6))))
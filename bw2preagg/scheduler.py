@@ -0,0 +1,208 @@
+""" Dynamic scheduling of LCI calculations over long-lived worker processes
+
+Rather than giving each worker a fixed chunk of activities, activities are
+put in a shared queue, grouped in small tasks, and each worker pulls the
+next task as soon as it is done with the previous one. A worker crashing
+(e.g. killed for exceeding its memory) only loses the task it was working
+on, which is put back in the queue, and a replacement worker is started.
+"""
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import random
+import time
+import traceback
+
+ORDERS = ["given", "longest_first", "shortest_first", "random"]
+
+
+def order_activities(activity_codes, order="given", expected_costs=None, seed=None):
+    """Return activity codes sorted according to a scheduling policy
+
+    Parameters
+    -----------
+    activity_codes : list
+        Codes of the activities
+    order : str, default="given"
+        One of "given" (unchanged), "longest_first" and "shortest_first"
+        (by expected cost) or "random"
+    expected_costs : dict, default=None
+        Expected cost per activity code, required for "longest_first"
+        and "shortest_first"
+    seed : int, default=None
+        Seed used with "random"
+
+    Returns
+    --------
+    activity_codes : list
+    """
+    if order not in ORDERS:
+        raise ValueError("Order {} not valid, choose from {}".format(order, ORDERS))
+    activity_codes = list(activity_codes)
+    if order == "random":
+        random.Random(seed).shuffle(activity_codes)
+    elif order in ("longest_first", "shortest_first"):
+        if expected_costs is None:
+            raise ValueError("Order {} requires expected_costs".format(order))
+        activity_codes.sort(key=lambda code: expected_costs[code], reverse=order == "longest_first")
+    return activity_codes
+
+
+def _queue_worker(worker_id, target, task_queue, connection, args, kwargs):
+    """Calculate tasks from task_queue until a None task is received
+
+    ``target`` is called as target(activity_codes, args[0], worker_id,
+    *args[1:], **kwargs), i.e. with the signature of set_up_lci_calculations.
+    Messages are sent through a pipe, which, unlike a multiprocessing Queue,
+    writes them before returning: the dispatcher knows which task a worker
+    was calculating even if the worker is killed right after.
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, activity_codes = task
+        connection.send(("started", task_id))
+        t0 = time.time()
+        try:
+            target(activity_codes, args[0], worker_id, *args[1:], **kwargs)
+            connection.send(("done", task_id, time.time() - t0))
+        except Exception:
+            print("************Failure of task {} by worker {}: {}************".format(
+                task_id, worker_id, traceback.format_exc()))
+            connection.send(("failed", task_id, time.time() - t0))
+
+
+def run_work_queue(target, activity_codes, parallel_jobs, args, kwargs=None, group_size=1,
+                   max_retries=1):
+    """Calculate LCI for activity_codes with parallel_jobs workers pulling tasks from a queue
+
+    Activities are grouped in tasks of ``group_size`` activities, in the
+    order given. If a worker process dies while calculating a task, the task
+    is put back in the queue (at most ``max_retries`` times) and a new worker
+    is started.
+
+    Parameters
+    -----------
+    target : function
+        Function calculating LCI arrays for a list of activities, e.g.
+        set_up_lci_calculations
+    activity_codes : list
+        Codes of the activities, in the order in which they should be treated
+    parallel_jobs : int
+        Number of worker processes
+    args : tuple
+        Arguments passed to target after the list of activities, with the
+        worker id inserted after the first one (result_dir)
+    kwargs : dict, default=None
+        Keyword arguments passed to target
+    group_size : int, default=1
+        Number of activities per task
+    max_retries : int, default=1
+        Number of times a task is put back in the queue after a worker crash
+
+    Returns
+    --------
+    report : dict
+        "workers": per worker id, number of tasks and activities treated,
+        busy time in seconds and throughput in activities per hour;
+        "tasks": per task id, activities, worker id, duration and status
+        ("done", "failed" or "lost" after too many crashes)
+    """
+    kwargs = kwargs or {}
+    tasks = {
+        task_id: activity_codes[i:i + group_size]
+        for task_id, i in enumerate(range(0, len(activity_codes), group_size))
+    }
+    task_queue = mp.Queue()
+    for task in tasks.items():
+        task_queue.put(task)
+
+    workers, connections, current_tasks = {}, {}, {}
+    worker_stats, task_report, retries = {}, {}, {}
+
+    def start_worker():
+        worker_id = len(worker_stats)
+        worker_stats[worker_id] = {'tasks': 0, 'activities': 0, 'busy_time': 0., 'crashed': False}
+        receiver, sender = mp.Pipe(duplex=False)
+        workers[worker_id] = mp.Process(
+            target=_queue_worker,
+            args=(worker_id, target, task_queue, sender, args, kwargs)
+        )
+        workers[worker_id].start()
+        sender.close()
+        connections[worker_id] = receiver
+
+    def read_messages(worker_id):
+        receiver = connections[worker_id]
+        while receiver.poll():
+            try:
+                message = receiver.recv()
+            except EOFError:
+                return
+            if message[0] == "started":
+                current_tasks[worker_id] = message[1]
+                continue
+            status, task_id, duration = message
+            current_tasks.pop(worker_id, None)
+            stats = worker_stats[worker_id]
+            stats['tasks'] += 1
+            stats['activities'] += len(tasks[task_id])
+            stats['busy_time'] += duration
+            task_report[task_id] = {
+                'activities': tasks[task_id], 'worker': worker_id,
+                'duration': duration, 'status': status,
+            }
+
+    for _ in range(min(parallel_jobs, len(tasks))):
+        start_worker()
+
+    while len(task_report) < len(tasks):
+        ready = wait(list(connections.values()) + [w.sentinel for w in workers.values()])
+        for worker_id in list(workers):
+            if connections[worker_id] in ready:
+                read_messages(worker_id)
+            worker = workers[worker_id]
+            if worker.sentinel not in ready or worker.exitcode is None:
+                continue
+            read_messages(worker_id)
+            connections.pop(worker_id).close()
+            del workers[worker_id]
+            task_id = current_tasks.pop(worker_id, None)
+            worker_stats[worker_id]['crashed'] = True
+            print("************Worker {} crashed (exit code {}) during task {}************".format(
+                worker_id, worker.exitcode, task_id))
+            if task_id is not None:
+                retries[task_id] = retries.get(task_id, 0) + 1
+                if retries[task_id] > max_retries:
+                    task_report[task_id] = {
+                        'activities': tasks[task_id], 'worker': worker_id,
+                        'duration': None, 'status': "lost",
+                    }
+                else:
+                    task_queue.put((task_id, tasks[task_id]))
+            if len(task_report) < len(tasks):
+                start_worker()
+
+    for _ in workers:
+        task_queue.put(None)
+    for worker_id, worker in workers.items():
+        worker.join()
+        connections[worker_id].close()
+
+    for stats in worker_stats.values():
+        stats['throughput'] = 3600 * stats['activities'] / stats['busy_time'] if stats['busy_time'] else 0.
+    return {'workers': worker_stats, 'tasks': task_report}
+
+
+def print_work_queue_report(report):
+    """Print per-worker throughput from the report of run_work_queue"""
+    print("\n**************LCI work queue report**************")
+    for worker_id, stats in sorted(report['workers'].items()):
+        print("Worker {}: {} tasks, {} activities in {:.1f} minutes, {:.1f} activities per hour{}".format(
+            worker_id, stats['tasks'], stats['activities'], stats['busy_time'] / 60,
+            stats['throughput'], " (crashed)" if stats['crashed'] else ""
+        ))
+    not_done = [t for t in report['tasks'].values() if t['status'] != "done"]
+    if not_done:
+        print("Tasks not completed: {}".format(
+            [(t['activities'], t['status']) for t in not_done]))
@@ -10,6 +10,7 @@ import numpy as np
 import pandas as pd
 from brightway2 import *
 from .utils import missing_useful_files, _check_result_dir
+from .solvers import get_block_triangular_ordering, BLOCK_ORDERING_FILENAME
 
 
 def setup_project(project_name, database_name, result_dir,
@@ -259,6 +260,40 @@ def _generate_common_files(result_dir, database_name, sacrificial_lca):
     with open(common_files_dir/'IO_Mapping.pickle', "wb") as f:
         pickle.dump({v: k for k, v in mapping.items()}, f)
 
+    # Block-triangular structure of the technosphere matrix
+    save_technosphere_block_ordering(result_dir)
+
+
+def save_technosphere_block_ordering(result_dir):
+    """Save the block-triangular ordering of the technosphere matrix
+
+    The strongly connected components of the technosphere matrix (read from
+    the ``A_as_coo_scipy.pickle`` common file) are identified and sorted in
+    topological order (see ``get_block_triangular_ordering``). The ordering
+    is saved in the common files and used by the "block" solver of the
+    iteration-major LCI engine. Can be run on an existing result_dir.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to the directory where data used or generated by bw2preagg is saved.
+
+    Returns
+    -------
+    None
+    """
+    common_files_dir = Path(result_dir) / 'common_files'
+    with open(common_files_dir / "A_as_coo_scipy.pickle", "rb") as f:
+        A = pickle.load(f)
+    ordering = get_block_triangular_ordering(A)
+    np.savez(str(common_files_dir / BLOCK_ORDERING_FILENAME), **ordering)
+    block_sizes = np.diff(ordering['block_ptr'])
+    print("Technosphere matrix: {} topological levels, {} cyclic blocks "
+          "(largest: {} activities), {} activities in acyclic parts".format(
+        len(ordering['level_ptr']) - 1, int((block_sizes > 1).sum()),
+        int(block_sizes.max()), int((block_sizes == 1).sum())
+    ))
+
 
 def _save_det_lci(result_dir, activity_codes, database_name, sacrificial_lca):
     """Deterministic LCI results"""
@@ -0,0 +1,691 @@
+""" Sparse solvers used by the iteration-major LCI engine
+
+The sparsity pattern of the technosphere matrix is the same for all
+iterations of a samples batch, only its values change. Solvers therefore
+separate a one-time ``analyze`` step, done on any matrix with the right
+sparsity pattern, from the per-iteration ``factorize`` step.
+
+Three direct solver backends are available: SciPy's SuperLU (always
+installed), UMFPACK (requires scikit-umfpack) and PARDISO (requires
+pypardiso and MKL).
+"""
+from pathlib import Path
+import json
+import time
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components, maximum_bipartite_matching
+from scipy.sparse.linalg import splu, gmres, bicgstab, LinearOperator
+from .matrix_builder import _positions_in_sparse
+
+try:
+    import scikits.umfpack as umfpack
+except ImportError:
+    umfpack = None
+try:
+    from pypardiso import PyPardisoSolver
+except (ImportError, OSError):
+    PyPardisoSolver = None
+
+BLOCK_ORDERING_FILENAME = "technosphere_block_ordering.npz"
+SOLVER_BACKEND_FILENAME = "solver_backend.json"
+
+
+class SuperLUSolver:
+    """SuperLU (SciPy) solver reusing the fill-reducing column ordering
+
+    ``analyze`` computes the COLAMD column ordering once. The columns of
+    every subsequent matrix are permuted accordingly (a simple reindexing of
+    its data vector) and factorized with the natural ordering, so that only
+    the numeric factorization is done at every iteration.
+    """
+    name = "superlu"
+    available = True
+
+    def __init__(self):
+        self.analysis_time = None
+        self.time_saved_per_factorization = None
+
+    def analyze(self, A):
+        """Compute the column ordering for the sparsity pattern of A (CSC)"""
+        t0 = time.perf_counter()
+        lu = splu(A, permc_spec='COLAMD')
+        full_time = time.perf_counter() - t0
+        self.perm_c = lu.perm_c
+        self.inverse_perm_c = np.argsort(self.perm_c)
+        # Position in A.data of every element of A[:, inverse_perm_c].data
+        index_matrix = A.copy()
+        index_matrix.data = np.arange(A.nnz, dtype=np.int64)
+        index_matrix = index_matrix[:, self.inverse_perm_c].tocsc()
+        self._data_order = index_matrix.data
+        self._permuted = index_matrix.astype(np.float64)
+        self.analysis_time = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.factorize(A)
+        self.time_saved_per_factorization = full_time - (time.perf_counter() - t0)
+
+    def factorize(self, A):
+        """Numeric factorization of A, which must have the analyzed sparsity pattern"""
+        self._permuted.data[:] = A.data[self._data_order]
+        self._lu = splu(self._permuted, permc_spec='NATURAL')
+
+    def solve(self, rhs, trans='N'):
+        """Solve A.x = rhs (trans='N') or A^T.x = rhs (trans='T')
+
+        rhs can be a vector or a 2-D array with one right-hand side per column.
+        """
+        if trans == 'N':
+            return self._lu.solve(rhs)[self.perm_c]
+        return self._lu.solve(rhs[self.inverse_perm_c], trans='T')
+
+
+class UmfpackSolver:
+    """UMFPACK solver (scikit-umfpack) reusing the symbolic factorization
+
+    ``analyze`` does the symbolic factorization (column ordering and
+    analysis of the elimination tree) once, and every iteration only
+    requires the numeric factorization.
+    """
+    name = "umfpack"
+    available = umfpack is not None
+
+    def __init__(self):
+        if not self.available:
+            raise ValueError("UMFPACK solver requires scikit-umfpack")
+        self.analysis_time = None
+        self.time_saved_per_factorization = None
+
+    def analyze(self, A):
+        """Symbolic factorization of A (CSC)"""
+        t0 = time.perf_counter()
+        family = "di" if A.indices.dtype == np.int32 else "dl"
+        self._context = umfpack.UmfpackContext(family)
+        self._context.symbolic(A)
+        self.analysis_time = time.perf_counter() - t0
+        self.time_saved_per_factorization = self.analysis_time
+        self.factorize(A)
+
+    def factorize(self, A):
+        """Numeric factorization of A, which must have the analyzed sparsity pattern"""
+        self._A = A
+        self._context.numeric(A)
+
+    def solve(self, rhs, trans='N'):
+        """Solve A.x = rhs (trans='N') or A^T.x = rhs (trans='T')
+
+        rhs can be a vector or a 2-D array with one right-hand side per column.
+        """
+        system = umfpack.UMFPACK_A if trans == 'N' else umfpack.UMFPACK_At
+        rhs = np.asarray(rhs, dtype=np.float64)
+        if rhs.ndim == 1:
+            return self._context.solve(system, self._A, rhs, autoTranspose=False)
+        return np.column_stack([
+            self._context.solve(system, self._A, np.ascontiguousarray(rhs[:, j]), autoTranspose=False)
+            for j in range(rhs.shape[1])
+        ])
+
+
+class PardisoSolver:
+    """PARDISO solver (pypardiso, Intel MKL) reusing the symbolic factorization
+
+    ``analyze`` runs the PARDISO analysis phase (11) once, every iteration
+    then only runs the numeric factorization phase (22).
+
+    The public API of pypardiso always runs both phases together, so this
+    relies on private methods of ``PyPardisoSolver`` (pypardiso 0.4). The
+    solver is only available if they exist in the installed version.
+    """
+    name = "pardiso"
+    available = PyPardisoSolver is not None and all(
+        hasattr(PyPardisoSolver, attr) for attr in ["_check_A", "_call_pardiso", "set_phase", "set_iparm"])
+
+    def __init__(self):
+        if not self.available:
+            raise ValueError("PARDISO solver requires pypardiso>=0.4,<0.5")
+        self.analysis_time = None
+        self.time_saved_per_factorization = None
+
+    def analyze(self, A):
+        """Analysis phase of PARDISO for A (CSC)"""
+        t0 = time.perf_counter()
+        self._solver = PyPardisoSolver()
+        A.sort_indices()
+        # A CSC matrix is passed as the CSR representation of A^T
+        self._solver._check_A(A)
+        self._solver.set_phase(11)
+        self._solver._call_pardiso(A, np.zeros(A.shape[0]))
+        self.analysis_time = time.perf_counter() - t0
+        self.time_saved_per_factorization = self.analysis_time
+        self.factorize(A)
+
+    def factorize(self, A):
+        """Numeric factorization of A, which must have the analyzed sparsity pattern"""
+        self._A = A
+        self._solver.set_phase(22)
+        self._solver._call_pardiso(A, np.zeros(A.shape[0]))
+
+    def solve(self, rhs, trans='N'):
+        """Solve A.x = rhs (trans='N') or A^T.x = rhs (trans='T')
+
+        rhs can be a vector or a 2-D array with one right-hand side per column.
+        """
+        # PARDISO holds the factorization of A^T: solve transposed to get A.x = rhs
+        self._solver.set_iparm(12, 2 if trans == 'N' else 0)
+        self._solver.set_phase(33)
+        return self._solver._call_pardiso(self._A, np.asfortranarray(rhs, dtype=np.float64))
+
+
+class PreconditionedKrylovSolver:
+    """Krylov solver preconditioned by the LU factorization of the deterministic A
+
+    Sampled technosphere matrices are small perturbations of the
+    deterministic one. ``analyze`` must therefore be called with the
+    deterministic technosphere matrix: its LU factorization is then used as
+    a preconditioner for GMRES or BiCGSTAB on every sampled matrix, and
+    ``factorize`` costs nothing.
+
+    Each right-hand side is warm-started either from the deterministic
+    solution or from the solution obtained at the previous iteration for the
+    same right-hand side. If the Krylov solver does not reach the relative
+    residual tolerance, the sampled matrix is factorized with ``SuperLUSolver``
+    and solved directly. The ``fell_back`` attribute indicates whether this
+    happened since the last call to ``factorize``.
+
+    Parameters
+    ----------
+    method : str, default="gmres"
+        Krylov method, "gmres" or "bicgstab"
+    rtol : float, default=1e-8
+        Relative residual tolerance, ||rhs - A.x|| / ||rhs||
+    maxiter : int, default=50
+        Maximum number of Krylov iterations per right-hand side
+    warm_start : str, default="deterministic"
+        "deterministic" or "previous". Using "previous" requires keeping the
+        solutions of all right-hand sides of one iteration in memory.
+    """
+    name = "krylov"
+    available = True
+
+    def __init__(self, method="gmres", rtol=1e-8, maxiter=50, warm_start="deterministic"):
+        if method not in ("gmres", "bicgstab"):
+            raise ValueError("Krylov method {} not valid".format(method))
+        if warm_start not in ("deterministic", "previous"):
+            raise ValueError("Warm start {} not valid".format(warm_start))
+        self.method = gmres if method == "gmres" else bicgstab
+        self.rtol, self.maxiter, self.warm_start = rtol, maxiter, warm_start
+        self.fell_back = False
+        self.analysis_time = None
+        self.time_saved_per_factorization = None
+        self._fallback = SuperLUSolver()
+        self._previous = {}
+
+    def analyze(self, A):
+        """Factorize the deterministic technosphere matrix A (CSC)"""
+        t0 = time.perf_counter()
+        self._deterministic_lu = splu(A)
+        self._fallback.analyze(A)
+        self.analysis_time = time.perf_counter() - t0
+        self.time_saved_per_factorization = self._fallback.time_saved_per_factorization
+
+    def factorize(self, A):
+        """Store the sampled matrix A. No factorization is needed."""
+        self._A = A
+        self._calls = 0
+        self._fallback_factorized = False
+        self.fell_back = False
+
+    def _solve_direct(self, rhs, trans):
+        if not self._fallback_factorized:
+            self._fallback.factorize(self._A)
+            self._fallback_factorized = True
+        self.fell_back = True
+        return self._fallback.solve(rhs, trans)
+
+    def solve(self, rhs, trans='N'):
+        """Solve A.x = rhs (trans='N') or A^T.x = rhs (trans='T')
+
+        rhs can be a vector or a 2-D array with one right-hand side per column.
+        """
+        rhs = np.asarray(rhs, dtype=np.float64)
+        is_vector = rhs.ndim == 1
+        rhs = rhs.reshape(rhs.shape[0], -1)
+        A = self._A if trans == 'N' else self._A.T.tocsr()
+        preconditioner = LinearOperator(
+            A.shape, matvec=lambda v: self._deterministic_lu.solve(v, trans=trans)
+        )
+        key = (self._calls, trans, rhs.shape)
+        self._calls += 1
+        if self.warm_start == "previous" and key in self._previous:
+            guesses = self._previous[key]
+        else:
+            guesses = self._deterministic_lu.solve(rhs, trans=trans)
+        solution = np.empty_like(rhs)
+        not_converged = []
+        for j in range(rhs.shape[1]):
+            norm = np.linalg.norm(rhs[:, j])
+            if norm == 0:
+                solution[:, j] = 0
+                continue
+            x, info = self.method(
+                A, rhs[:, j], x0=guesses[:, j], rtol=self.rtol, atol=0.,
+                maxiter=self.maxiter, M=preconditioner
+            )
+            if info != 0 or np.linalg.norm(rhs[:, j] - A @ x) > self.rtol * norm:
+                not_converged.append(j)
+            solution[:, j] = x
+        if not_converged:
+            solution[:, not_converged] = self._solve_direct(rhs[:, not_converged], trans)
+        if self.warm_start == "previous":
+            self._previous[key] = solution.copy()
+        return solution.ravel() if is_vector else solution
+
+
+def _match_rows_to_columns(A):
+    """Row matched to each column of A so that matched elements are nonzero
+
+    For a technosphere matrix, matched elements are normally the production
+    exchanges, which are on the diagonal when products and activities are
+    indexed in the same order: the diagonal is then used if it is zero-free.
+    Otherwise, matched elements can be any nonzero elements, which is enough
+    for the block structure (the strongly connected components do not
+    depend on the matching) but not to identify production exchanges.
+    Raises ValueError if A is structurally singular.
+    """
+    pattern = sp.csr_matrix(A, copy=True)
+    if pattern.shape[0] != pattern.shape[1]:
+        raise ValueError("Technosphere matrix must be square")
+    pattern.eliminate_zeros()
+    pattern.data[:] = 1
+    if np.all(pattern.diagonal()):
+        return np.arange(pattern.shape[0], dtype=np.int64), pattern
+    row_for_col = maximum_bipartite_matching(pattern, perm_type='row')
+    if np.any(row_for_col < 0):
+        raise ValueError("Technosphere matrix is structurally singular")
+    return row_for_col.astype(np.int64), pattern
+
+
+def get_block_triangular_ordering(A):
+    """Block-triangular ordering of the technosphere matrix A
+
+    Rows of A are first matched to columns so that the matched elements
+    (normally the production exchanges) form a zero-free diagonal. The
+    strongly connected components (SCC) of the resulting graph, where
+    activity j points to the activities using its product, are then
+    sorted in topological levels: the product of an SCC is only used by
+    SCCs of earlier levels or by the SCC itself, i.e. levels go from final
+    products to upstream suppliers. Reordering A accordingly makes it block
+    lower triangular, with one diagonal block per SCC.
+
+    Parameters
+    -----------
+    A : scipy.sparse matrix
+        Square technosphere matrix (products x activities)
+
+    Returns
+    --------
+    ordering : dict
+        "row_for_col": row matched to each column,
+        "order": columns (activities) sorted by level and SCC,
+        "level_ptr": offsets in "order" of the levels,
+        "block_ptr": offsets in "order" of the SCCs
+    """
+    row_for_col, pattern = _match_rows_to_columns(A)
+    M = pattern[row_for_col].tocsr()
+    n_blocks, labels = connected_components(M, directed=True, connection='strong')
+
+    # Condensed graph: block of row j depends on blocks of columns k
+    M = M.tocoo()
+    between = labels[M.row] != labels[M.col]
+    depends = sp.csr_matrix(
+        (np.ones(between.sum()), (labels[M.row][between], labels[M.col][between])),
+        shape=(n_blocks, n_blocks)
+    )
+    depends.data[:] = 1  # Duplicates were summed
+    remaining = np.diff(depends.indptr)
+    dependents = depends.T.tocsr()
+    levels = np.full(n_blocks, -1)
+    frontier = np.flatnonzero(remaining == 0)
+    level = 0
+    while len(frontier):
+        levels[frontier] = level
+        counts = np.asarray(dependents[frontier].sum(axis=0)).ravel().astype(int)
+        remaining = remaining - counts
+        remaining[frontier] = -1
+        frontier = np.flatnonzero(remaining == 0)
+        level += 1
+
+    order = np.lexsort((np.arange(len(labels)), labels, levels[labels]))
+    sorted_levels = levels[labels][order]
+    sorted_labels = labels[order]
+    level_ptr = np.concatenate(([0], np.flatnonzero(np.diff(sorted_levels)) + 1, [len(order)]))
+    block_ptr = np.concatenate(([0], np.flatnonzero(np.diff(sorted_labels)) + 1, [len(order)]))
+    return {
+        "row_for_col": row_for_col,
+        "order": order.astype(np.int64),
+        "level_ptr": level_ptr.astype(np.int64),
+        "block_ptr": block_ptr.astype(np.int64),
+    }
+
+
+def load_block_ordering(common_files_dir):
+    """Load the block-triangular ordering saved in the common files, or None"""
+    fp = Path(common_files_dir) / BLOCK_ORDERING_FILENAME
+    if not fp.is_file():
+        return None
+    with np.load(str(fp)) as data:
+        return {k: data[k] for k in data.files}
+
+
+class BlockTriangularSolver:
+    """Solver factorizing only the cyclic blocks of the technosphere matrix
+
+    A is reordered to block lower triangular form (see
+    ``get_block_triangular_ordering``). At every iteration, only the diagonal
+    blocks of strongly connected components with more than one activity are
+    factorized. Solving is done by substitution, one topological level at a
+    time: the supply of activities of a level only depends on the (already
+    known) supply of the downstream levels using their products, so that
+    acyclic parts only require a division by their diagonal element.
+    A^T.x = b is solved in the same way, going through levels in reverse
+    order.
+
+    Results are identical to those of a full sparse LU up to floating
+    point rounding (relative differences well below 1e-6).
+
+    Parameters
+    ----------
+    ordering : dict, default=None
+        Ordering returned by ``get_block_triangular_ordering``, e.g. loaded
+        from the common files. If None, it is computed by ``analyze``.
+    """
+    name = "block"
+    available = True
+
+    def __init__(self, ordering=None):
+        self.ordering = ordering
+        self.analysis_time = None
+        self.time_saved_per_factorization = None
+
+    def analyze(self, A):
+        """Compute the block structure of A (CSC)"""
+        t0 = time.perf_counter()
+        if self.ordering is None:
+            self.ordering = get_block_triangular_ordering(A)
+        row_for_col, order = self.ordering['row_for_col'], self.ordering['order']
+        self._forward_rows = row_for_col[order]
+        # Position in A.data of every element of the reordered matrix
+        index_matrix = A.copy()
+        index_matrix.data = np.arange(A.nnz, dtype=np.int64)
+        index_matrix = index_matrix[self._forward_rows][:, order].tocsr()
+        index_matrix.sort_indices()
+        transposed = index_matrix.T.tocsr()
+        transposed.sort_indices()
+        self._data_order = index_matrix.data.copy()
+        self._data_order_T = transposed.data.copy()
+        self._M = index_matrix.astype(np.float64)
+        self._MT = transposed.astype(np.float64)
+        n = A.shape[0]
+        self._diagonal_positions = _positions_in_sparse(self._M, np.arange(n), np.arange(n))
+
+        block_ptr = self.ordering['block_ptr']
+        cyclic = [(a, b) for a, b in zip(block_ptr[:-1], block_ptr[1:]) if b - a > 1]
+        self._cyclic_blocks = cyclic
+        self._levels, self._levels_T = [], []
+        level_ptr = self.ordering['level_ptr']
+        for a, b in zip(level_ptr[:-1], level_ptr[1:]):
+            blocks = [i for i, (c, d) in enumerate(cyclic) if a <= c < b]
+            singletons = np.ones(b - a, dtype=bool)
+            for i in blocks:
+                singletons[cyclic[i][0] - a:cyclic[i][1] - a] = False
+            self._levels.append((a, b, self._row_view(self._M, a, b), np.flatnonzero(singletons), blocks))
+            self._levels_T.append((a, b, self._row_view(self._MT, a, b), np.flatnonzero(singletons), blocks))
+        self._levels_T.reverse()
+        self.analysis_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        splu(A)
+        full_time = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.factorize(A)
+        self.time_saved_per_factorization = full_time - (time.perf_counter() - t0)
+
+    @staticmethod
+    def _row_view(matrix, first, last):
+        """Rows first:last of a CSR matrix, and the slice of its data vector they use"""
+        start, stop = matrix.indptr[first], matrix.indptr[last]
+        rows = sp.csr_matrix(
+            (matrix.data[start:stop].copy(), matrix.indices[start:stop].copy(),
+             matrix.indptr[first:last + 1] - start),
+            shape=(last - first, matrix.shape[1])
+        )
+        return rows, slice(start, stop)
+
+    def factorize(self, A):
+        """Factorize the cyclic blocks of A, which must have the analyzed sparsity pattern"""
+        self._M.data[:] = A.data[self._data_order]
+        self._MT.data[:] = A.data[self._data_order_T]
+        for levels, matrix in [(self._levels, self._M), (self._levels_T, self._MT)]:
+            for _, _, (rows, data_slice), _, _ in levels:
+                rows.data[:] = matrix.data[data_slice]
+        self._diagonal = self._M.data[self._diagonal_positions]
+        self._lus = [splu(self._M[a:b, a:b].tocsc()) for a, b in self._cyclic_blocks]
+
+    def solve(self, rhs, trans='N'):
+        """Solve A.x = rhs (trans='N') or A^T.x = rhs (trans='T')
+
+        rhs can be a vector or a 2-D array with one right-hand side per column.
+        """
+        rhs = np.asarray(rhs, dtype=np.float64)
+        is_vector = rhs.ndim == 1
+        rhs = rhs.reshape(rhs.shape[0], -1)
+        order = self.ordering['order']
+        if trans == 'N':
+            b, levels = rhs[self._forward_rows], self._levels
+        else:
+            b, levels = rhs[order], self._levels_T
+        x = np.zeros_like(b)
+        for first, last, (rows, _), singletons, blocks in levels:
+            # Unknowns of this level are still 0: only upstream terms are subtracted
+            r = b[first:last] - rows @ x
+            x[first + singletons] = r[singletons] / self._diagonal[first + singletons].reshape(-1, 1)
+            for i in blocks:
+                a, c = self._cyclic_blocks[i]
+                x[a:c] = self._lus[i].solve(r[a - first:c - first], trans=trans)
+        solution = np.empty_like(x)
+        if trans == 'N':
+            solution[order] = x
+        else:
+            solution[self._forward_rows] = x
+        return solution.ravel() if is_vector else solution
+
+
+class PowerSeriesSolver:
+    """Approximate solver summing the power series of the technosphere matrix
+
+    The supply vector s = A^-1.f is approximated by the truncated power series
+    s = sum_k (I - A)^k.f, i.e. the sum over supply chain tiers of the
+    requirements of upstream activities. Terms are computed with sparse
+    matrix products, after scaling rows of A by their production exchange,
+    so that production amounts need not be 1 (Jacobi iteration). Terms are
+    added until the relative residual ||f - A.s|| / ||f|| or the relative
+    contribution of the last term ||term|| / ||s|| falls below ``tol``.
+
+    If ``cutoff`` is given, elements of each term that are smaller than
+    ``cutoff`` times the largest element of the first term (the demand) are
+    dropped, i.e. supply chain paths with small contributions are not
+    followed further upstream. ``cutoff`` can be a list, in which case
+    ``cutoff[k]`` applies to tier k (the last value applying to all further
+    tiers), e.g. to cut more aggressively far upstream.
+
+    Production exchanges must be on the diagonal of A, i.e. products and
+    activities indexed in the same order, as checked by ``setup_project``.
+
+    Right-hand sides that do not converge within ``max_terms`` terms, or
+    whose series diverges (e.g. if the spectral radius of the scaled I - A
+    is not below 1), are solved exactly with ``SuperLUSolver``, and
+    ``fell_back`` is set. A series is deemed divergent once its residual is
+    not finite or has grown ``max_growth`` times over the smallest residual
+    so far (residuals can grow along acyclic supply chains with large
+    exchange amounts before dropping to 0, hence the margin). The
+    relative residual achieved for each right-hand side of the last call to
+    ``solve`` is available in ``residuals``. Only solves with A (not A^T)
+    are supported.
+
+    Parameters
+    ----------
+    tol : float, default=1e-6
+        Threshold on the relative residual or on the relative contribution of
+        the last term
+    max_terms : int, default=100
+        Maximum number of terms before switching to the exact solver
+    cutoff : float or list, default=None
+        Relative contribution below which supply chain paths are dropped
+    max_growth : float, default=1e6
+        Growth of the residual over its smallest value at which the series
+        is deemed divergent
+    """
+    name = "series"
+    available = True
+    forward_only = True
+
+    def __init__(self, tol=1e-6, max_terms=100, cutoff=None, max_growth=1e6):
+        self.tol, self.max_terms, self.max_growth = tol, max_terms, max_growth
+        self.cutoff = None if cutoff is None else np.atleast_1d(cutoff)
+        self.residuals = None
+        self.fell_back = False
+        self.analysis_time = None
+        self.time_saved_per_factorization = None
+        self._fallback = SuperLUSolver()
+
+    def analyze(self, A):
+        """Locate production exchanges of A (CSC) and prepare the exact fallback"""
+        t0 = time.perf_counter()
+        if A.shape[0] != A.shape[1]:
+            raise ValueError("Technosphere matrix must be square")
+        missing = np.flatnonzero(A.diagonal() == 0)
+        if len(missing):
+            raise ValueError("Power series requires production exchanges on the diagonal, "
+                             "columns {} have none".format(missing[:10].tolist()))
+        self.row_for_col = np.arange(A.shape[0], dtype=np.int64)
+        # Position in A.data of every element of A[row_for_col] (CSR)
+        index_matrix = A.copy()
+        index_matrix.data = np.arange(A.nnz, dtype=np.int64)
+        index_matrix = index_matrix[self.row_for_col].tocsr()
+        index_matrix.sort_indices()
+        self._data_order = index_matrix.data.copy()
+        self._M = index_matrix.astype(np.float64)
+        n = A.shape[0]
+        self._diagonal_positions = _positions_in_sparse(self._M, np.arange(n), np.arange(n))
+        self._fallback.analyze(A)
+        self.analysis_time = time.perf_counter() - t0
+        self.time_saved_per_factorization = self._fallback.time_saved_per_factorization
+
+    def factorize(self, A):
+        """Store the values of A. Only the exact fallback requires a factorization."""
+        self._A = A
+        self._M.data[:] = A.data[self._data_order]
+        self._diagonal = self._M.data[self._diagonal_positions].reshape(-1, 1)
+        self._fallback_factorized = False
+        self.fell_back = False
+
+    def solve(self, rhs, trans='N'):
+        """Approximate solution of A.x = rhs
+
+        rhs can be a vector or a 2-D array with one right-hand side per column.
+        """
+        if trans != 'N':
+            raise ValueError("Power series approximation only available for A.x = rhs")
+        rhs = np.asarray(rhs, dtype=np.float64)
+        is_vector = rhs.ndim == 1
+        rhs = rhs.reshape(rhs.shape[0], -1)
+        f = rhs[self.row_for_col]
+        norms = np.linalg.norm(f, axis=0)
+        solution = np.zeros_like(f)
+        remainder = f.copy()
+        self.residuals = np.zeros(f.shape[1])
+        reference = np.abs(f / self._diagonal).max(axis=0)
+        active = np.flatnonzero(norms)
+        best_residuals = np.ones(f.shape[1])  # Relative residual of s = 0
+        diverged = []
+        for k in range(self.max_terms):
+            if not len(active):
+                break
+            term = remainder[:, active] / self._diagonal
+            if self.cutoff is not None:
+                threshold = self.cutoff[min(k, len(self.cutoff) - 1)] * reference[active]
+                term[np.abs(term) < threshold] = 0
+            solution[:, active] += term
+            remainder[:, active] -= self._M @ term
+            residuals = np.linalg.norm(remainder[:, active], axis=0) / norms[active]
+            solution_norms = np.linalg.norm(solution[:, active], axis=0)
+            contributions = np.linalg.norm(term, axis=0) / np.maximum(solution_norms, np.finfo(float).tiny)
+            self.residuals[active] = residuals
+            # Comparisons with NaN are False: NaN residuals are diverging, not converged
+            diverging = ~np.isfinite(residuals) | ~np.isfinite(solution_norms) \
+                | ~(residuals <= self.max_growth * best_residuals[active])
+            best_residuals[active] = np.fmin(best_residuals[active], residuals)
+            converged = ~diverging & ((residuals <= self.tol) | (contributions <= self.tol))
+            diverged.extend(active[diverging])
+            active = active[~diverging & ~converged]
+        active = np.sort(np.concatenate([active, np.array(diverged, dtype=active.dtype)]))
+        if len(active):
+            if not self._fallback_factorized:
+                self._fallback.factorize(self._A)
+                self._fallback_factorized = True
+            self.fell_back = True
+            solution[:, active] = self._fallback.solve(rhs[:, active])
+            self.residuals[active] = np.linalg.norm(
+                f[:, active] - self._M @ solution[:, active], axis=0) / norms[active]
+        return solution.ravel() if is_vector else solution
+
+
+DIRECT_SOLVERS = {
+    "superlu": SuperLUSolver,
+    "umfpack": UmfpackSolver,
+    "pardiso": PardisoSolver,
+}
+
+SOLVERS = dict(DIRECT_SOLVERS, **{
+    "krylov": PreconditionedKrylovSolver,
+    "block": BlockTriangularSolver,
+    "series": PowerSeriesSolver,
+})
+
+
+def available_direct_solvers():
+    """Return names of the direct solver backends installed"""
+    return [name for name, solver in DIRECT_SOLVERS.items() if solver.available]
+
+
+def load_solver_backend(common_files_dir):
+    """Return the direct solver backend recorded in the common files, or None"""
+    fp = Path(common_files_dir) / SOLVER_BACKEND_FILENAME
+    if not fp.is_file():
+        return None
+    with open(fp, "r") as f:
+        return json.load(f)['backend']
+
+
+def get_solver(name="direct", common_files_dir=None, **options):
+    """Return an instance of solver ``name`` created with ``options``
+
+    ``name`` is one of SOLVERS, or "direct". "direct" designates the fastest
+    direct solver backend recorded in ``common_files_dir`` (see
+    ``select_solver_backend``), or SuperLU if none was recorded or if the
+    recorded backend is not installed on this machine.
+
+    If ``common_files_dir`` is given, the "block" solver uses the
+    block-triangular ordering saved there by ``setup_project``, if any.
+    """
+    if name == "direct":
+        name = "superlu"
+        recorded = None if common_files_dir is None else load_solver_backend(common_files_dir)
+        if recorded in available_direct_solvers():
+            name = recorded
+        elif recorded is not None:
+            print("Recorded solver backend {} not available, using superlu".format(recorded))
+    if name not in SOLVERS:
+        raise ValueError("Solver {} not valid, choose from {}".format(name, ["direct"] + list(SOLVERS)))
+    if name == "block" and common_files_dir is not None and 'ordering' not in options:
+        options['ordering'] = load_block_ordering(common_files_dir)
+    return SOLVERS[name](**options)
@@ -0,0 +1,128 @@
+""" Progress of LCI generation, per samples batch and per slice
+
+Status is obtained from the completion ledgers (see ``ledger``), the
+progress records of the activities being calculated and a single listing
+of the saved LCI arrays, without loading arrays.
+"""
+from pathlib import Path
+import json
+import os
+import warnings
+from .cost_model import get_slices, load_lci_cost_model
+from .ledger import read_lci_ledger, is_lci_record_complete, get_unverified_lci_codes
+
+STATUSES = ["done", "partial", "failed", "unverified", "remaining"]
+
+
+def _list_samples_batches(result_dir):
+    """Return ids of samples batches with LCI arrays or LCI metadata"""
+    batches = set()
+    for dirname in ["LCI", "LCI_metadata"]:
+        dirpath = Path(result_dir) / "probabilistic" / dirname
+        if dirpath.is_dir():
+            batches.update(int(d) for d in os.listdir(dirpath) if d.isdigit())
+    return sorted(batches)
+
+
+def _in_progress_codes(g_samples_dir):
+    """Return codes of activities with a progress record in the temp directory
+
+    Only activities being calculated, or interrupted, have one.
+    """
+    temp_dir = Path(g_samples_dir) / "temp"
+    if not temp_dir.is_dir():
+        return set()
+    suffix = ".progress.json"
+    return {f[:-len(suffix)] for f in os.listdir(temp_dir) if f.endswith(suffix)}
+
+
+def _count(codes, statuses):
+    counts = {status: 0 for status in STATUSES}
+    for code in codes:
+        counts[statuses.get(code, "remaining")] += 1
+    counts['total'] = len(codes)
+    return counts
+
+
+def get_lci_status(result_dir, samples_batches=None, number_of_slices=None, balance_slices=False):
+    """Return counts of LCI arrays done, partial, failed, unverified and remaining
+
+    An activity is "done" if its LCI array is recorded in the ledger with
+    all iterations calculated, "failed" if some iterations failed (NaN
+    columns), "partial" if some iterations were not calculated yet (columns
+    left to 0, or a progress record of an interrupted calculation),
+    "unverified" if its array is saved without ledger record (see
+    ``ledger.record_unverified_lci_arrays``) and "remaining" otherwise.
+    Failed and partial arrays are recalculated by ``dispatch_lci_calculators``.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    samples_batches : list, default=None
+        Ids of samples batches. If None, all batches found in the result_dir.
+    number_of_slices : int, default=None
+        If not None, counts are also given per slice
+    balance_slices : bool, default=False
+        Whether slices were balanced by expected calculation time, see
+        ``dispatch_lci_calculators``. Balanced slices are only obtained from
+        the saved cost model: if there is none, a warning is issued and
+        counts are given for slices of equal number of activities.
+
+    Returns
+    --------
+    status : dict
+        Per samples batch, counts per status and "total", "throughput"
+        (activities per hour, from the times at which arrays were saved, or
+        None), "hours_to_completion" (None if unknown) and, if
+        number_of_slices is not None, "slices" (counts per slice)
+    """
+    result_dir = Path(result_dir)
+    with open(result_dir / "common_files" / "ordered_activity_codes.json", 'r') as f:
+        activity_codes = json.load(f)
+    slices = None
+    if number_of_slices:
+        if balance_slices and load_lci_cost_model(result_dir) is None:
+            # Building the cost model takes far longer than reading the status
+            warnings.warn("No saved LCI cost model in {}, slice counts are given for slices of equal "
+                          "number of activities".format(result_dir / "common_files"))
+            balance_slices = False
+        slices = get_slices(result_dir, number_of_slices, balance_slices)
+    if samples_batches is None:
+        samples_batches = _list_samples_batches(result_dir)
+    status = {}
+    for samples_batch in samples_batches:
+        g_samples_dir = result_dir / "probabilistic" / "LCI" / str(samples_batch)
+        records = read_lci_ledger(g_samples_dir)
+        statuses = {code: "unverified" for code in get_unverified_lci_codes(g_samples_dir, records)}
+        statuses.update((code, "partial") for code in _in_progress_codes(g_samples_dir))
+        for code, record in records.items():
+            if record['nan_columns']:
+                statuses[code] = "failed"
+            elif not is_lci_record_complete(record):
+                statuses[code] = "partial"
+            else:
+                statuses[code] = "done"
+        batch_status = _count(activity_codes, statuses)
+        finished_at = sorted(record['finished_at'] for record in records.values())
+        throughput, hours = None, None
+        if len(finished_at) > 1 and finished_at[-1] > finished_at[0]:
+            throughput = 3600 * (len(finished_at) - 1) / (finished_at[-1] - finished_at[0])
+            hours = (batch_status['remaining'] + batch_status['partial'] + batch_status['failed']) / throughput
+        batch_status.update(throughput=throughput, hours_to_completion=hours)
+        if slices is not None:
+            batch_status['slices'] = [_count(codes, statuses) for codes in slices]
+        status[samples_batch] = batch_status
+    return status
+
+
+def print_lci_status(status):
+    """Print the status returned by get_lci_status"""
+    line = "{done}/{total} done, {partial} partial, {failed} failed, {unverified} unverified, {remaining} remaining"
+    for samples_batch, batch_status in status.items():
+        print("Samples batch {}: {}".format(samples_batch, line.format(**batch_status)))
+        if batch_status['throughput'] is not None:
+            print("\tThroughput: {:.1f} activities per hour, estimated time to completion: {:.1f} hours".format(
+                batch_status['throughput'], batch_status['hours_to_completion']))
+        for slice_id, slice_status in enumerate(batch_status.get('slices', [])):
+            print("\tSlice {}: {}".format(slice_id, line.format(**slice_status)))
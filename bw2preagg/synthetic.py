@@ -0,0 +1,219 @@
+""" Synthetic LCI databases for load testing
+
+Writes a seeded, random Brightway2 database with the fields of an imported
+ecoinvent database (filename, reference product, classifications, ...), a
+matching biosphere database and an LCIA method, so that all steps from
+``setup_project`` to ``save_all_lcia_score_arrays`` can be run, benchmarked
+and profiled at scale without an ecoinvent license.
+
+Activities are ordered in a supply chain: most technosphere inputs of an
+activity are supplied by activities further upstream (higher index), and a
+share of inputs (``cycle_share``) by activities further downstream, which
+creates the feedback loops found in ecoinvent. The inputs of an activity
+sum to less than half of its production, so that the technosphere matrix is
+always invertible, also when sampled.
+"""
+import uuid
+import numpy as np
+# brightway2 is imported when writing databases, so that the command line
+# interface can offer UNCERTAINTY_TYPES without importing it
+
+SYNTHETIC_METHOD = ("bw2preagg synthetic", "synthetic impact", "synthetic score")
+UNCERTAINTY_TYPES = {"lognormal": 2, "normal": 3, "uniform": 4, "triangular": 5}
+
+_UNITS = ["kilogram", "kilowatt hour", "megajoule", "cubic meter", "unit", "ton kilometer"]
+_LOCATIONS = ["GLO", "RER", "RoW", "CA-QC", "CH", "CN", "US", "BR", "IN", "ZA"]
+_COMPARTMENTS = [
+    (("air",), "emission"), (("air", "urban air close to ground"), "emission"),
+    (("water",), "emission"), (("water", "surface water"), "emission"), (("soil",), "emission"),
+    (("natural resource", "in ground"), "natural resource"), (("natural resource", "land"), "natural resource"),
+]
+
+
+def _uuid(rng):
+    """Return a random UUID drawn from rng, so that it is reproducible"""
+    return str(uuid.UUID(bytes=rng.bytes(16), version=4))
+
+
+def _uncertainty(rng, amount, uncertain_share, types, weights, scale):
+    """Return uncertainty fields of an exchange of given (positive) amount"""
+    if rng.random_sample() >= uncertain_share:
+        return {'uncertainty type': 0, 'loc': amount}
+    uncertainty_type = types[rng.choice(len(types), p=weights)]
+    if uncertainty_type == "lognormal":
+        return {'uncertainty type': 2, 'loc': np.log(amount), 'scale': scale}
+    elif uncertainty_type == "normal":
+        return {'uncertainty type': 3, 'loc': amount, 'scale': scale * amount}
+    bounds = {'minimum': amount * (1 - scale), 'maximum': amount * (1 + scale)}
+    if uncertainty_type == "uniform":
+        return dict(bounds, **{'uncertainty type': 4, 'loc': amount})
+    return dict(bounds, **{'uncertainty type': 5, 'loc': amount})
+
+
+def _write_synthetic_biosphere(biosphere_name, number_of_flows, rng):
+    """Write a biosphere database with number_of_flows flows, return their keys"""
+    from brightway2 import Database
+    data = {}
+    for i in range(number_of_flows):
+        code = _uuid(rng)
+        categories, flow_type = _COMPARTMENTS[rng.randint(len(_COMPARTMENTS))]
+        data[(biosphere_name, code)] = {
+            'name': 'Synthetic flow {}'.format(i),
+            'unit': 'kilogram' if flow_type == "emission" else _UNITS[rng.randint(len(_UNITS))],
+            'categories': categories,
+            'type': flow_type,
+            'code': code,
+            'database': biosphere_name,
+            'exchanges': [],
+        }
+    Database(biosphere_name).write(data)
+    return sorted(data)
+
+
+def write_synthetic_database(project_name, database_name="synthetic", number_of_activities=1000,
+                             number_of_flows=500, technosphere_inputs=5, biosphere_outputs=10,
+                             cycle_share=0.05, cycle_length=None, uncertain_share=1., uncertainty_types=None,
+                             scale=0.2, method=SYNTHETIC_METHOD, characterized_share=0.5,
+                             biosphere_name="biosphere3", seed=0, overwrite=False):
+    """Write a random, reproducible LCI database, its biosphere and an LCIA method
+
+    Parameters
+    -----------
+    project_name : str
+        Name of the brightway2 project. Created if it does not exist.
+    database_name : str, default="synthetic"
+        Name of the LCI database
+    number_of_activities : int, default=1000
+        Number of activities. ecoinvent 3.x has between 12000 and 20000.
+    number_of_flows : int, default=500
+        Number of elementary flows. Only used if the biosphere database does
+        not exist yet, otherwise its flows are used.
+    technosphere_inputs : float, default=5
+        Average number of technosphere inputs per activity (Poisson
+        distributed), i.e. density of the technosphere matrix
+    biosphere_outputs : float, default=10
+        Average number of elementary flows per activity (Poisson distributed)
+    cycle_share : float, default=0.05
+        Share of technosphere inputs supplied by downstream activities, which
+        creates cycles. With 0, the technosphere matrix is triangular.
+    cycle_length : int, default=None
+        Maximum distance, in the supply chain order, between an activity and
+        a downstream supplier. Small values give many small cycles, None one
+        large strongly connected block, as in ecoinvent.
+    uncertain_share : float, default=1.
+        Share of technosphere and biosphere exchanges with uncertainty
+    uncertainty_types : dict, default=None
+        Relative frequency of the uncertainty types of uncertain exchanges,
+        with keys in UNCERTAINTY_TYPES. If None, all are lognormal.
+    scale : float, default=0.2
+        Spread of uncertain exchanges: standard deviation of the underlying
+        normal distribution (lognormal), relative standard deviation
+        (normal) or relative half-width (uniform, triangular)
+    method : tuple, default=SYNTHETIC_METHOD
+        Name of the LCIA method, written with random characterization factors
+    characterized_share : float, default=0.5
+        Share of elementary flows with a characterization factor
+    biosphere_name : str, default="biosphere3"
+        Name of the biosphere database. The common files generated by
+        ``setup_project`` require "biosphere3".
+    seed : int, default=0
+        Seed of the random number generator. The same seed and parameters
+        always give the same database.
+    overwrite : bool, default=False
+        If True, an existing database_name is replaced
+
+    Returns
+    --------
+    summary : dict
+        Number of "activities", "technosphere_exchanges",
+        "biosphere_exchanges", "uncertain_exchanges" and "cyclic_inputs"
+    """
+    from brightway2 import projects, databases, methods, Database, Method
+    if uncertainty_types is None:
+        uncertainty_types = {"lognormal": 1.}
+    unknown = set(uncertainty_types).difference(UNCERTAINTY_TYPES)
+    if unknown:
+        raise ValueError("Unknown uncertainty types {}, use {}".format(sorted(unknown), sorted(UNCERTAINTY_TYPES)))
+    if not 0 <= cycle_share <= 1 or not 0 <= uncertain_share <= 1:
+        raise ValueError("cycle_share and uncertain_share must be between 0 and 1")
+    if number_of_activities < 2:
+        raise ValueError("At least two activities are needed")
+    types = sorted(uncertainty_types)
+    weights = np.array([uncertainty_types[t] for t in types], dtype=float)
+    weights /= weights.sum()
+
+    projects.set_current(project_name)
+    if database_name in databases:
+        if not overwrite:
+            raise ValueError("Database {} already exists, use overwrite=True to replace it".format(database_name))
+        del databases[database_name]
+
+    # Separate streams, so that the LCI database does not depend on whether the biosphere existed
+    if biosphere_name in databases:
+        flows = sorted(Database(biosphere_name).load())
+    else:
+        flows = _write_synthetic_biosphere(biosphere_name, number_of_flows, np.random.RandomState([seed, 0]))
+    rng = np.random.RandomState([seed, 1])
+
+    codes = [uuid.UUID(bytes=rng.bytes(16)).hex for _ in range(number_of_activities)]
+    summary = {'activities': number_of_activities, 'technosphere_exchanges': 0,
+               'biosphere_exchanges': 0, 'uncertain_exchanges': 0, 'cyclic_inputs': 0}
+    data = {}
+    for i, code in enumerate(codes):
+        unit = _UNITS[rng.randint(len(_UNITS))]
+        exchanges = [{
+            'input': (database_name, code), 'amount': 1., 'type': 'production', 'unit': unit,
+            'uncertainty type': 0, 'loc': 1.,
+        }]
+        # Suppliers: upstream activities, or downstream ones for a share of inputs (cycles)
+        n_inputs = min(rng.poisson(technosphere_inputs), number_of_activities - 1)
+        suppliers = set()
+        for _ in range(n_inputs):
+            if i == number_of_activities - 1 or (i > 0 and rng.random_sample() < cycle_share):
+                suppliers.add(rng.randint(0 if cycle_length is None else max(0, i - cycle_length), i))
+            else:
+                suppliers.add(rng.randint(i + 1, number_of_activities))
+        suppliers = sorted(suppliers)
+        amounts = rng.uniform(0.01, 1, size=len(suppliers))
+        amounts *= rng.uniform(0.1, 0.5) / max(amounts.sum(), 1)
+        for j, amount in zip(suppliers, amounts):
+            exchange = {'input': (database_name, codes[j]), 'amount': float(amount), 'type': 'technosphere'}
+            exchange.update(_uncertainty(rng, float(amount), uncertain_share, types, weights, scale))
+            exchanges.append(exchange)
+        n_outputs = min(rng.poisson(biosphere_outputs), len(flows))
+        for j in rng.choice(len(flows), size=n_outputs, replace=False):
+            amount = float(rng.lognormal(0, 2))
+            exchange = {'input': flows[j], 'amount': amount, 'type': 'biosphere'}
+            exchange.update(_uncertainty(rng, amount, uncertain_share, types, weights, scale))
+            exchanges.append(exchange)
+        summary['technosphere_exchanges'] += len(suppliers)
+        summary['cyclic_inputs'] += sum(j < i for j in suppliers)
+        summary['biosphere_exchanges'] += n_outputs
+        summary['uncertain_exchanges'] += sum(exc['uncertainty type'] != 0 for exc in exchanges)
+        data[(database_name, code)] = {
+            'name': 'synthetic activity {}'.format(i),
+            'reference product': 'synthetic product {}'.format(i),
+            'location': _LOCATIONS[rng.randint(len(_LOCATIONS))],
+            'unit': unit,
+            'production amount': 1.,
+            'filename': "{}_{}.spold".format(_uuid(rng), _uuid(rng)),
+            'classifications': [
+                ('ISIC rev.4 ecoinvent', '{:04d}:Synthetic class'.format(i % 100)),
+                ('CPC', '{:05d}: synthetic product'.format(i % 1000)),
+            ],
+            'type': 'process',
+            'code': code,
+            'database': database_name,
+            'exchanges': exchanges,
+        }
+    Database(database_name).write(data)
+
+    characterized = rng.choice(len(flows), size=int(round(characterized_share * len(flows))), replace=False)
+    if method not in methods:
+        Method(method).register()
+    Method(method).write([(flows[j], float(cf)) for j, cf in zip(sorted(characterized),
+                                                                rng.lognormal(0, 1, size=len(characterized)))])
+    print("Wrote {activities} activities with {technosphere_exchanges} technosphere inputs "
+          "({cyclic_inputs} from downstream activities), {biosphere_exchanges} elementary flows "
+          "and {uncertain_exchanges} uncertain exchanges".format(**summary))
+    return summary
@@ -121,12 +121,23 @@ def _get_lci_dir(result_dir, result_type='probabilistic', samples_batch=None, mu
     return LCI_dir
 
 
-def _get_lcia_dir(result_dir, samples_batch, method, must_exist=True):
-    """Return LCI directory path if it exists else raise ValueError"""
+def _get_lci_metadata_dir(result_dir, samples_batch):
+    """Return directory with metadata on the LCI arrays of a samples_batch
+
+    Created if it does not exist.
+    """
+    result_dir = Path(_check_result_dir(result_dir))
+    metadata_dir = result_dir / "probabilistic" / "LCI_metadata" / str(samples_batch)
+    metadata_dir.mkdir(parents=True, exist_ok=True)
+    return metadata_dir
+
+
+def _get_lcia_dir(result_dir, samples_batch, method, must_exist=True, totals_or_per_exchange="totals"):
+    """Return LCIA directory path if it exists else raise ValueError"""
     result_dir = Path(_check_result_dir(result_dir))
     method = _check_method(method)
     abbr = Method(method).get_abbreviation()
-    LCIA_dir = result_dir / "LCIA" / abbr / str(samples_batch)
+    LCIA_dir = result_dir / "probabilistic" / abbr / totals_or_per_exchange / str(samples_batch)
     if not LCIA_dir.is_dir():
         if must_exist:
             raise ValueError("No directory at {}".format(LCIA_dir))
@@ -159,7 +170,7 @@ def _get_det_lcia_dict(result_dir, method):
     return det_lcia_dict
 
 
-def load_LCI_array(result_dir, act_code, samples_batch=0):
+def load_LCI_array(result_dir, act_code, samples_batch=0, compact=False):
     """Return existing LCI array
 
     Parameters
@@ -168,23 +179,63 @@ def load_LCI_array(result_dir, act_code, samples_batch=0):
         Path to directory where results are stored
     act_code : str
         Code of the activity
-    samples_batch : int, default=0
+    samples_batch : int or list, default=0
         Integer id for sample batch. Used for campaigns names and for
         generating a seed for the RNG. The maximum value is 14.
+        If a list of ids, the arrays of these samples batches are returned
+        as a single ConcatenatedArray (see ``concat_batches``), without
+        copying them.
+    compact : bool, default=False
+        If True, the LCI array is returned in compact form, without the
+        rows that are zero in all iterations (see ``compact``)
 
     Returns
     --------
-    LCI samples : numpy.ndarray
-        LCI samples, with rows = elementary flows and columns = iterations
+    LCI samples : numpy.ndarray, CompactArray or ConcatenatedArray
+        LCI samples, with rows = elementary flows and columns = iterations.
+        Read from the compact (.npz) or compressed (.npc) file, or from the
+        LCI store of the samples batch if there is no ``<act_code>.npy``
+        file (see ``lci_store``).
     """
-    LCI_dir = Path(_get_lci_dir(result_dir, samples_batch))
-    arr_fp = LCI_dir / "{}.npy".format(act_code)
+    from .lci_store import load_saved_lci_array
+    from .concat_batches import ConcatenatedArray
+    if isinstance(samples_batch, (list, tuple)):
+        if compact:
+            raise ValueError("Arrays of several samples batches can not be loaded in compact form")
+        return ConcatenatedArray.from_directories(
+            [_get_lci_dir(result_dir, 'probabilistic', sb) for sb in samples_batch], act_code)
+    LCI_dir = Path(_get_lci_dir(result_dir, 'probabilistic', samples_batch))
+    return load_saved_lci_array(LCI_dir, act_code, compact=compact)
+
+
+def load_LCI_residuals(result_dir, act_code, samples_batch=0):
+    """Return residuals of approximate LCI calculations of an activity
+
+    Only available for LCI arrays calculated with the "series" solver of the
+    iteration-major engine.
+
+    Parameters
+    -----------
+    result_dir : str
+        Path to directory where results are stored
+    act_code : str
+        Code of the activity
+    samples_batch : int, default=0
+        Integer id for sample batch.
+
+    Returns
+    --------
+    residuals : numpy.ndarray
+        Relative residual ||f - A.s|| / ||f|| of each iteration
+    """
+    LCI_dir = Path(_get_lci_dir(result_dir, 'probabilistic', samples_batch))
+    arr_fp = LCI_dir / "residuals" / "{}.npy".format(act_code)
     if not arr_fp.is_file():
         raise ValueError("File {} does not exist".format(arr_fp))
     return np.load(str(arr_fp))
 
 
-def load_LCIA_array(result_dir, act_code, method, samples_batch=0):
+def load_LCIA_array(result_dir, act_code, method, samples_batch=0, totals_or_per_exchange="totals"):
     """Return existing LCIA array
 
     Parameters
@@ -195,23 +246,40 @@ def load_LCIA_array(result_dir, act_code, method, samples_batch=0):
         Code of the activity
     method : tuple
         LCIA method identification in brightway2 (tuple)
-    samples_batch : int, default=0
+    samples_batch : int or list, default=0
         Integer id for sample batch. Used for campaigns names and for
         generating a seed for the RNG. The maximum value is 14.
+        If a list of ids, the arrays of these samples batches are returned
+        as a single ConcatenatedArray (see ``concat_batches``), without
+        copying them.
+    totals_or_per_exchange : str, default="totals"
+        "totals" for total scores, "per_exchange" for scores per elementary
+        flow, see ``save_all_lcia_score_arrays``
 
     Returns
     --------
-    LCIA samples : numpy.ndarray
+    LCIA samples : numpy.ndarray or ConcatenatedArray
         LCIA samples, with columns = iterations.
         Normally only consisting of one row representing the total score.
         Can also consist of one row per elementary flow for which there is a
-        non-null characterization factor.
+        non-null characterization factor. Arrays saved compressed (.npc) are
+        decompressed.
     """
-    LCIA_dir = Path(_get_lcia_dir(result_dir, samples_batch, method))
+    from .compression import COMPRESSED_SUFFIX, load_compressed_array
+    from .concat_batches import ConcatenatedArray
+    if isinstance(samples_batch, (list, tuple)):
+        return ConcatenatedArray.from_directories(
+            [_get_lcia_dir(result_dir, sb, method, totals_or_per_exchange=totals_or_per_exchange)
+             for sb in samples_batch], act_code)
+    LCIA_dir = Path(_get_lcia_dir(result_dir, samples_batch, method,
+                                  totals_or_per_exchange=totals_or_per_exchange))
     arr_fp = LCIA_dir / "{}.npy".format(act_code)
-    if not arr_fp.is_file():
-        raise ValueError("No file at {}".format(str(arr_fp)))
-    return np.load(str(arr_fp))
+    compressed_fp = LCIA_dir / "{}{}".format(act_code, COMPRESSED_SUFFIX)
+    if arr_fp.is_file():
+        return np.load(str(arr_fp))
+    if compressed_fp.is_file():
+        return load_compressed_array(compressed_fp)
+    raise ValueError("No file at {}".format(str(arr_fp)))
 
 
 def load_det_lci(result_dir, act_code):
@@ -242,6 +310,29 @@ def load_det_lcia(result_dir, method, act_code, det_lcia_dict=None):
     return det_lcia_dict[act_code]
 
 
+def _get_memory_usage():
+    """Return resident memory of the current process, in bytes
+
+    Returns a dict with total ("rss"), private ("anonymous") and
+    file-backed or shared ("shared") resident memory, read from
+    /proc/self/status. Returns None where this is not available (non-Linux).
+    """
+    fields = {'VmRSS': 'rss', 'RssAnon': 'anonymous', 'RssFile': 'file', 'RssShmem': 'shmem'}
+    usage = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    usage[fields[key]] = int(value.split()[0]) * 1024
+    except OSError:
+        return None
+    if 'rss' not in usage:
+        return None
+    usage['shared'] = usage.pop('file', 0) + usage.pop('shmem', 0)
+    return usage
+
+
 def generate_seed_from_pi(i):
     if i>14:
         raise ValueError("Cannot generate seeds this way for i>14")
@@ -256,9 +347,18 @@ def get_ref_bio_dict_from_common_files(common_files_dirpath):
     return ref_bio_dict
 
 
-def _check_lci_missing(result_dir, result_type='probabilistic'):
-    """Check if any LCI arrays are missing"""
-    with open(result_dir / "common_files" / "ordered_activity_codes.json", "r") as f:
+def _check_lci_missing(result_dir, result_type='probabilistic', samples_batch=0):
+    """Return True if LCI arrays of all activities are available
+
+    For probabilistic results, only complete arrays according to the
+    completion ledger of the samples_batch are counted.
+    """
+    from .ledger import get_completed_lci_codes
+    with open(Path(result_dir) / "common_files" / "ordered_activity_codes.json", "r") as f:
         expected_activity_codes = json.load(f)
-    available = sorted([f[0:-4] for f in os.listdir(result_dir / result_type / 'LCI')])
-    return sorted(expected_activity_codes) == available
+    LCI_dir = _get_lci_dir(result_dir, result_type, samples_batch)
+    if result_type == 'probabilistic':
+        available = get_completed_lci_codes(LCI_dir)
+    else:
+        available = {f[0:-4] for f in os.listdir(LCI_dir) if f.endswith(".npy")}
+    return set(expected_activity_codes) <= available
@@ -20,12 +20,21 @@ setup(
     install_requires=[
         'brightway2',
         'numpy',
+        'scipy',
         'pyprind',
         'presamples',
         'click',
         'bw2waterbalancer',
         'bw2landbalancer'
     ],
+    entry_points={
+        'console_scripts': ['bw2preagg=bw2preagg.cli:cli'],
+    },
+    extras_require={
+        'umfpack': ['scikit-umfpack'],
+        'pardiso': ['pypardiso>=0.4,<0.5'],
+        'compression': ['zstandard', 'lz4', 'blosc'],
+    },
     url="https://github.com/PascalLesage/bw2-database-preaggregator",
     long_description=readme,
     long_description_content_type="text/markdown",
@@ -3,6 +3,7 @@ from bw2data.tests import bw2test
 from brightway2 import *
 from shutil import rmtree
 import numpy as np
+from bw2preagg.setup_project import save_technosphere_block_ordering
 
 @pytest.fixture(scope="session")
 def result_dir(tmpdir_factory):
@@ -473,3 +474,28 @@ def db():
     yield {'project': projects.current}
 
     rmtree(projects.dir, ignore_errors=True)
+
+
+@pytest.fixture
+def lci_result_dir(db, tmp_path):
+    """result_dir with the common files used for LCI calculations"""
+    import pickle
+    import json
+    lca = LCA({act: act.get('production amount', 1) for act in Database("db")})
+    lca.lci()
+    common_files_dir = tmp_path / "common_files"
+    common_files_dir.mkdir()
+    with open(common_files_dir / 'ordered_activity_codes.json', "w") as f:
+        json.dump(sorted(act.key[1] for act in Database("db")), f)
+    for name, obj in [
+        ('product_dict', lca.product_dict),
+        ('bio_dict', lca.biosphere_dict),
+        ('activity_dict', lca.activity_dict),
+        ('A_as_coo_scipy', lca.technosphere_matrix.tocoo()),
+        ('B_as_coo_scipy', lca.biosphere_matrix.tocoo()),
+        ('IO_Mapping', {v: k for k, v in mapping.items()}),
+    ]:
+        with open(common_files_dir / "{}.pickle".format(name), "wb") as f:
+            pickle.dump(obj, f)
+    save_technosphere_block_ordering(tmp_path)
+    yield tmp_path
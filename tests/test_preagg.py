@@ -5,9 +5,45 @@ from bw2preagg.setup_project import setup_project, _generate_common_files, \
     missing_useful_files
 from bw2preagg import utils
 from bw2preagg.base_presamples import generate_base_presamples
+from bw2preagg.matrix_builder import CampaignMatrixBuilder
+from bw2preagg.lci import calculate_lci_array, calculate_lci_arrays_per_iteration, select_solver_backend, \
+    _write_lci_columns, _write_lci_progress, _read_lci_progress, claim_lci_calculations, \
+    _finalize_lci_array, set_up_iteration_major_lci_calculations, _save_lci_timings, _check_lci_format
+from bw2preagg.ledger import read_lci_ledger, get_completed_lci_codes, rebuild_lci_ledger, \
+    get_unverified_lci_codes, record_unverified_lci_arrays
+from bw2preagg.lci_store import create_lci_store, get_saved_lci_codes
+from bw2preagg.compression import available_codecs, get_codec, save_compressed_array, \
+    load_compressed_array, save_lci_codec, load_lci_codec_record
+from bw2preagg.compact import CompactArray, save_lci_compact, load_lci_compact
+from bw2preagg.catalog import ResultCatalog, create_catalog, rebuild_catalog
+from bw2preagg.lcia import save_all_lcia_score_arrays
+from bw2preagg.concat_batches import ConcatenatedArray
+from bw2preagg.audit import audit_columns, audit_arrays, repair_arrays, load_repair_plan, _audit_directory, \
+    _patch_saved_array
+from bw2preagg.cli import cli
+from bw2preagg.synthetic import write_synthetic_database
+from bw2data.tests import bw2test
+from bw2preagg.status import get_lci_status
+from bw2preagg.profiling import PhaseTimer, summarize_phase_timings
+from click.testing import CliRunner
+from bw2preagg.leases import try_claim, lease_status, get_lease_dir, LeaseLost
+from bw2preagg.solvers import SuperLUSolver, PreconditionedKrylovSolver, \
+    BlockTriangularSolver, get_block_triangular_ordering, get_solver, available_direct_solvers, \
+    PowerSeriesSolver, PardisoSolver
+from bw2preagg.scheduler import run_work_queue, order_activities
+from bw2preagg.cost_model import supply_chain_sizes, cost_balanced_slices, save_lci_cost_model, \
+    load_lci_cost_model, get_slice_activity_codes
+from scipy.sparse.linalg import spsolve
+import scipy.sparse as sp
 import os
+import multiprocessing as mp
+import subprocess
+import sys
 from pathlib import Path
 import numpy as np
+import json
+import time
+from math import ceil
 
 def test_write_matrices(db):
     """ pytest resources written as expected"""
@@ -113,3 +149,1021 @@ def test_generate_base_presamples(db, result_dir):
 
 
 
+
+def test_matrix_builder_matches_bw2calc(lci_result_dir):
+    iterations = 5
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    presamples_paths = [p for p in utils._get_campaign(0)]
+    builder = CampaignMatrixBuilder(presamples_paths, lci_result_dir / "common_files")
+    assert builder.ncols == iterations
+
+    lca = LCA({act: 1 for act in Database("db")})
+    lca.lci()
+    # Reference matrices rebuilt by bw2calc from the presamples arrays
+    datapackage = json.load(open(Path(presamples_paths[0]) / "datapackage.json"))
+    package_data = {}
+    for resource in datapackage['resources']:
+        indices = np.load(Path(presamples_paths[0]) / resource['indices']['filepath'])
+        samples = np.load(Path(presamples_paths[0]) / resource['samples']['filepath'])
+        for index, sample in zip(indices, samples):
+            package_data[(resource['matrix'], index['input'], index['output'])] = \
+                (index['type'] if 'type' in indices.dtype.names else None, sample)
+
+    def vector(matrix, params, i):
+        values = []
+        for param in params:
+            exc_type, sample = package_data[(matrix, param['input'], param['output'])]
+            # Collapsed exchanges (e.g. losses) are stored on the production exchange
+            values.append(sample[i] if exc_type in (None, param['type']) else 0)
+        return np.array(values)
+
+    for i in range(iterations):
+        A, B = builder.update(i)
+        lca.rebuild_technosphere_matrix(vector('technosphere_matrix', lca.tech_params, i))
+        lca.rebuild_biosphere_matrix(vector('biosphere_matrix', lca.bio_params, i))
+        assert np.allclose(A.toarray(), lca.technosphere_matrix.toarray())
+        assert np.allclose(B.toarray(), lca.biosphere_matrix.toarray())
+
+
+@pytest.mark.parametrize("mode, flow_indices, solver", [
+    ("forward", None, "direct"),
+    ("adjoint", None, "direct"),
+    ("auto", [0, 3], "direct"),
+    ("forward", None, "krylov"),
+    ("adjoint", [0, 3], "krylov"),
+    ("forward", None, "block"),
+    ("adjoint", None, "block"),
+    ("forward", [0, 3], "series"),
+])
+def test_iteration_major_lci_engine(lci_result_dir, mode, flow_indices, solver):
+    iterations = 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    builder = CampaignMatrixBuilder(
+        [p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    codes = sorted(act.key[1] for act in Database("db"))
+    calculate_lci_arrays_per_iteration(
+        'db', codes, builder, 5, iterations, g_samples_dir,
+        flow_indices=flow_indices, mode=mode, rhs_block_size=3, iterations_per_flush=3,
+        solver=solver
+    )
+    rows = list(range(5)) if flow_indices is None else flow_indices
+    for i in range(iterations):
+        A, B = builder.update(i)
+        for code in codes:
+            demand = np.zeros(A.shape[0])
+            demand[builder.product_dict[('db', code)]] = get_activity(('db', code))['production amount']
+            expected = B @ spsolve(A, demand)
+            lci = np.load(str(g_samples_dir / "{}.npy".format(code)))
+            assert lci.shape == (5, iterations)
+            assert np.allclose(lci[rows, i], expected[rows], rtol=1e-5)
+            assert not np.any(np.delete(lci[:, i], rows))
+    assert not list((g_samples_dir / "temp").iterdir())
+
+
+def test_superlu_solver_reuses_ordering():
+    rng = np.random.RandomState(0)
+    n = 50
+    A = (sp.random(n, n, density=0.1, random_state=rng) * -0.3 + sp.identity(n) * 2).tocsc()
+    A.sum_duplicates()
+    solver = SuperLUSolver()
+    solver.analyze(A)
+    for _ in range(3):
+        A.data[:] = A.data * (1 + 0.1 * rng.randn(A.nnz))
+        solver.factorize(A)
+        b = rng.randn(n, 3)
+        assert np.allclose(solver.solve(b), spsolve(A, b))
+        assert np.allclose(solver.solve(b, trans='T'), spsolve(A.T.tocsc(), b))
+
+
+@pytest.mark.skipif(not PardisoSolver.available, reason="pypardiso 0.4 not installed")
+def test_pardiso_solver_reuses_analysis():
+    rng = np.random.RandomState(0)
+    n = 50
+    A = (sp.random(n, n, density=0.1, random_state=rng) * -0.3 + sp.identity(n) * 2).tocsc()
+    A.sum_duplicates()
+    solver = PardisoSolver()
+    solver.analyze(A)
+    for _ in range(3):
+        A.data[:] = A.data * (1 + 0.1 * rng.randn(A.nnz))
+        solver.factorize(A)
+        b = rng.randn(n, 3)
+        assert np.allclose(solver.solve(b), spsolve(A, b))
+        assert np.allclose(solver.solve(b, trans='T'), spsolve(A.T.tocsc(), b))
+        assert np.allclose(solver.solve(b[:, 0]), spsolve(A, b[:, 0]))
+
+
+@pytest.mark.parametrize("method, warm_start", [
+    ("gmres", "deterministic"),
+    ("bicgstab", "previous"),
+])
+def test_krylov_solver_and_fallback(method, warm_start):
+    rng = np.random.RandomState(0)
+    n = 50
+    A = (sp.random(n, n, density=0.1, random_state=rng) * -0.3 + sp.identity(n) * 2).tocsc()
+    A.sum_duplicates()
+    deterministic = A.data.copy()
+    solver = PreconditionedKrylovSolver(method=method, rtol=1e-10, warm_start=warm_start)
+    solver.analyze(A)
+    for _ in range(3):
+        A.data[:] = deterministic * (1 + 0.1 * rng.randn(A.nnz))
+        solver.factorize(A)
+        b = rng.randn(n, 3)
+        assert np.allclose(solver.solve(b), spsolve(A, b))
+        assert np.allclose(solver.solve(b, trans='T'), spsolve(A.T.tocsc(), b))
+        assert not solver.fell_back
+    # Matrix too far from the deterministic one to converge in one iteration
+    solver.maxiter = 1
+    A.data[:] = deterministic * (1 + 2 * rng.randn(A.nnz))
+    solver.factorize(A)
+    b = rng.randn(n)
+    assert np.allclose(solver.solve(b), spsolve(A, b))
+    assert solver.fell_back
+
+
+def test_block_triangular_solver():
+    rng = np.random.RandomState(1)
+    n = 100
+    lower = sp.tril(sp.random(n, n, density=0.05, random_state=rng), k=-1) * -0.5
+    cycles = sp.random(n, n, density=0.005, random_state=rng) * -0.3
+    # Rows shuffled so that the production exchanges are not on the diagonal
+    A = (sp.identity(n) * 2 + lower + cycles).tocsr()[rng.permutation(n)].tocsc()
+    A.sum_duplicates()
+    ordering = get_block_triangular_ordering(A)
+    assert np.diff(ordering['block_ptr']).max() > 1
+    assert len(ordering['level_ptr']) > 2
+    deterministic = A.data.copy()
+    solver = BlockTriangularSolver(ordering)
+    solver.analyze(A)
+    for _ in range(3):
+        A.data[:] = deterministic * (1 + 0.1 * rng.randn(A.nnz))
+        solver.factorize(A)
+        b = rng.randn(n, 3)
+        assert np.allclose(solver.solve(b), spsolve(A, b), rtol=1e-10)
+        assert np.allclose(solver.solve(b[:, 0], trans='T'), spsolve(A.T.tocsc(), b[:, 0]), rtol=1e-10)
+
+
+def test_select_solver_backend(lci_result_dir):
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=4, samples_batch=0
+    )
+    backend = select_solver_backend('default', lci_result_dir, iterations=2)
+    assert backend in available_direct_solvers()
+    with open(lci_result_dir / "common_files" / "solver_backend.json") as f:
+        recorded = json.load(f)
+    assert recorded['backend'] == backend
+    assert set(recorded['seconds_per_iteration']) == set(available_direct_solvers())
+    assert get_solver("direct", lci_result_dir / "common_files").name == backend
+
+
+def test_power_series_solver():
+    rng = np.random.RandomState(1)
+    n = 100
+    A = (sp.identity(n) * 2 - sp.random(n, n, density=0.05, random_state=rng) * 0.3).tocsc()
+    A.sum_duplicates()
+    b = rng.randn(n, 3)
+    expected = spsolve(A, b)
+    solver = PowerSeriesSolver(tol=1e-10)
+    solver.analyze(A)
+    solver.factorize(A)
+    assert np.allclose(solver.solve(b), expected, rtol=1e-8)
+    assert np.all(solver.residuals <= 1e-10)
+    assert not solver.fell_back
+    # Dropping paths increases the residual, which is reported
+    solver.cutoff = np.array([1e-3])
+    approximation = solver.solve(b)
+    assert np.all(solver.residuals > 1e-10)
+    assert np.allclose(
+        np.linalg.norm(b - A @ approximation, axis=0) / np.linalg.norm(b, axis=0), solver.residuals)
+    # Not converging within max_terms: exact solution
+    solver.cutoff, solver.max_terms = None, 2
+    assert np.allclose(solver.solve(b), expected)
+    assert solver.fell_back
+    with pytest.raises(ValueError):
+        solver.solve(b, trans='T')
+
+
+def test_power_series_solver_divergence():
+    # Spectral radius of I - A is sqrt(2): the series diverges
+    A = sp.csc_matrix(np.array([[1., -2.], [-1., 1.]]))
+    b = np.array([[1., 0.5], [0., 1.]])
+    solver = PowerSeriesSolver(max_terms=2000)
+    solver.analyze(A)
+    solver.factorize(A)
+    assert np.allclose(solver.solve(b), spsolve(A, b))
+    assert solver.fell_back
+    assert np.all(np.isfinite(solver.residuals)) and np.all(solver.residuals <= 1e-10)
+    # Overflowing to NaN also falls back
+    solver.max_growth = np.inf
+    with np.errstate(all='ignore'):
+        assert np.allclose(solver.solve(b[:, 0]), spsolve(A, b[:, 0]))
+    assert solver.fell_back
+    # Residuals growing along an acyclic supply chain are not divergence
+    A = sp.csc_matrix(np.array([[1., 0., 0.], [-100., 1., 0.], [0., -100., 1.]]))
+    solver = PowerSeriesSolver()
+    solver.analyze(A)
+    solver.factorize(A)
+    assert np.allclose(solver.solve(np.array([1., 0., 0.])), [1., 100., 1e4])
+    assert not solver.fell_back
+    # Production exchanges must be on the diagonal
+    with pytest.raises(ValueError, match="diagonal"):
+        PowerSeriesSolver().analyze(sp.csc_matrix(np.array([[0., 1.], [1., -0.5]])))
+
+
+def test_power_series_residuals_saved(lci_result_dir):
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=3, samples_batch=0
+    )
+    builder = CampaignMatrixBuilder(
+        [p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    codes = sorted(act.key[1] for act in Database("db"))
+    calculate_lci_arrays_per_iteration(
+        'db', codes, builder, 5, 3, g_samples_dir, solver="series", iterations_per_flush=2,
+        solver_options={'tol': 1e-8}
+    )
+    for code in codes:
+        residuals = utils.load_LCI_residuals(lci_result_dir, code, 0)
+        assert residuals.shape == (3,)
+        assert np.all(residuals <= 1e-6)
+    with pytest.raises(ValueError):
+        calculate_lci_arrays_per_iteration(
+            'db', codes, builder, 5, 3, g_samples_dir, mode="adjoint", solver="series")
+
+
+def test_shared_samples_builder(lci_result_dir):
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=4, samples_batch=0
+    )
+    paths = [str(p) for p in utils._get_campaign(0)]
+    builder = CampaignMatrixBuilder(paths, lci_result_dir / "common_files")
+    shared_dir = lci_result_dir / "shared_samples"
+    builder.save_shared_samples(shared_dir, paths)
+    assert CampaignMatrixBuilder.shared_samples_metadata(shared_dir)['presamples_paths'] == paths
+    shared = CampaignMatrixBuilder.from_shared_samples(shared_dir, lci_result_dir / "common_files")
+    assert shared.ncols == builder.ncols
+    assert all(isinstance(r['samples'], np.memmap) for r in shared.resources)
+    for i in range(4):
+        A, B = builder.update(i)
+        shared_A, shared_B = shared.update(i)
+        assert np.array_equal(A.toarray(), shared_A.toarray())
+        assert np.array_equal(B.toarray(), shared_B.toarray())
+    assert utils._get_memory_usage()['rss'] > 0
+
+
+def test_lci_resume_from_checkpoint(lci_result_dir):
+    iterations = 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    paths = [p for p in utils._get_campaign(0)]
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    codes = sorted(act.key[1] for act in Database("db"))
+
+    def run():
+        builder = CampaignMatrixBuilder(paths, lci_result_dir / "common_files")
+        calculate_lci_arrays_per_iteration(
+            'db', codes, builder, 5, iterations, g_samples_dir, iterations_per_flush=1)
+
+    run()
+    reference = {code: np.load(str(g_samples_dir / "{}.npy".format(code))) for code in codes}
+    # Interrupted run: first 2 iterations done (sentinel values), next ones not
+    for code in codes:
+        (g_samples_dir / "{}.npy".format(code)).unlink()
+        _write_lci_columns(g_samples_dir, code, np.full((5, 2), 7.), 0, 5, iterations)
+        _write_lci_progress(g_samples_dir, code, 2, 5, iterations)
+    run()
+    for code in codes:
+        lci = np.load(str(g_samples_dir / "{}.npy".format(code)))
+        assert np.all(lci[:, :2] == 7)
+        assert np.allclose(lci[:, 2:], reference[code][:, 2:])
+    assert not list((g_samples_dir / "temp").iterdir())
+    # Progress records not matching the array dimensions are ignored
+    _write_lci_columns(g_samples_dir, codes[0], np.ones((5, 1)), 0, 5, iterations)
+    _write_lci_progress(g_samples_dir, codes[0], 2, 5, iterations + 1)
+    assert _read_lci_progress(g_samples_dir, codes[0], 5, iterations) == 0
+
+
+def _write_codes(codes, result_dir, worker_id, crash_on=None):
+    for code in codes:
+        marker = Path(result_dir) / "crashed"
+        if code == crash_on and not marker.exists():
+            marker.touch()
+            os._exit(1)
+        (Path(result_dir) / code).write_text(str(worker_id))
+
+
+def test_calculate_lci_array_resume_from_checkpoint(lci_result_dir):
+    iterations, interrupted_at = 6, 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    act_code = sorted(act.key[1] for act in Database("db"))[0]
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    paths = [p for p in utils._get_campaign(0)]
+    calculate_lci_array('db', act_code, paths, 5, iterations, g_samples_dir)
+    final_fp = g_samples_dir / "{}.npy".format(act_code)
+    uninterrupted = np.load(str(final_fp))
+    assert not np.isnan(uninterrupted).any()
+    # Samples differ between iterations, so that resuming with wrong presamples indices is detected
+    assert not np.allclose(uninterrupted[:, interrupted_at], uninterrupted[:, 0])
+    os.remove(str(final_fp))
+
+    # Interrupted run: iterations before interrupted_at in the temporary memmap, with their progress record
+    _write_lci_columns(g_samples_dir, act_code, uninterrupted[:, :interrupted_at], 0, 5, iterations)
+    _write_lci_progress(g_samples_dir, act_code, interrupted_at, 5, iterations)
+    calculate_lci_array('db', act_code, paths, 5, iterations, g_samples_dir)
+    resumed = np.load(str(final_fp))
+    assert np.array_equal(resumed[:, interrupted_at:], uninterrupted[:, interrupted_at:])
+    assert np.array_equal(resumed, uninterrupted)
+
+
+def test_work_queue_survives_worker_crash(tmp_path):
+    codes = ["act_{}".format(i) for i in range(10)]
+    report = run_work_queue(
+        _write_codes, codes, 3, args=(str(tmp_path),),
+        kwargs={'crash_on': "act_4"}, group_size=2
+    )
+    assert all((tmp_path / code).exists() for code in codes)
+    assert all(task['status'] == "done" for task in report['tasks'].values())
+    assert sum(w['crashed'] for w in report['workers'].values()) == 1
+    assert len(report['workers']) == 4
+    assert sum(w['activities'] for w in report['workers'].values()) >= len(codes)
+
+
+def test_failed_tasks_not_timed(lci_result_dir):
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=2, samples_batch=0
+    )
+    with pytest.raises(Exception):
+        set_up_iteration_major_lci_calculations(["missing"], lci_result_dir, 0, 'db', 0, 'default')
+    report = {'tasks': {
+        0: {'activities': ["a"], 'worker': 0, 'duration': 2., 'status': "failed"},
+        1: {'activities': ["b", "c"], 'worker': 0, 'duration': 2., 'status': "done"},
+    }}
+    _save_lci_timings(lci_result_dir, 0, "iteration", report)
+    with open(utils._get_lci_metadata_dir(lci_result_dir, 0) / "lci_timings.jsonl") as f:
+        timings = [json.loads(line) for line in f]
+    assert [t['activities'] for t in timings] == [["b", "c"]]
+
+
+def test_order_activities_and_supply_chain_sizes():
+    # 0 <- 1 <- 2, 2 <-> 3 (cycle), 4 alone
+    A = sp.csc_matrix(np.array([
+        [1, -1, 0, 0, 0],
+        [0, 1, -1, 0, 0],
+        [0, 0, 1, -.5, 0],
+        [0, 0, -.5, 1, 0],
+        [0, 0, 0, 0, 1],
+    ]))
+    sizes = supply_chain_sizes(A)
+    assert list(sizes) == [1, 2, 4, 4, 1]
+    costs = dict(zip("abcde", sizes))
+    assert order_activities("abcde", "longest_first", costs)[:2] == ["c", "d"]
+    assert order_activities("abcde", "shortest_first", costs)[-2:] == ["c", "d"]
+    assert order_activities("abcde", "random", seed=1) == order_activities("abcde", "random", seed=1)
+    with pytest.raises(ValueError):
+        order_activities("abcde", "longest_first")
+
+
+def test_cost_balanced_slices(lci_result_dir):
+    costs = {"a": 10., "b": 1., "c": 4., "d": 5., "e": 1.}
+    slices = cost_balanced_slices(list("abcde"), costs, 2)
+    assert slices == [["a", "e"], ["b", "c", "d"]]
+    assert cost_balanced_slices(list("abcde"), costs, 2) == slices
+
+    codes = sorted(act.key[1] for act in Database("db"))
+    # Contiguous slices by default, without cost model
+    assert get_slice_activity_codes(lci_result_dir, 0, 2) == codes[:ceil(len(codes) / 2)]
+    assert load_lci_cost_model(lci_result_dir) is None
+    slices = [get_slice_activity_codes(lci_result_dir, i, 2, balance_slices=True) for i in range(2)]
+    assert sorted(slices[0] + slices[1]) == codes
+    model = load_lci_cost_model(lci_result_dir)
+    assert model['units'] == "relative"
+    # Activities missing from the model get its mean cost
+    del model['costs'][codes[0]]
+    with open(lci_result_dir / "common_files" / "lci_cost_model.json", "w") as f:
+        json.dump(model, f)
+    slices = [get_slice_activity_codes(lci_result_dir, i, 2, balance_slices=True) for i in range(2)]
+    assert sorted(slices[0] + slices[1]) == codes
+    model = save_lci_cost_model(lci_result_dir, use_timings=False)
+    # Refined with measured timings of a previous batch
+    metadata_dir = lci_result_dir / "probabilistic" / "LCI_metadata" / "0"
+    metadata_dir.mkdir(parents=True)
+    with open(metadata_dir / "lci_timings.jsonl", "w") as f:
+        for code in codes:
+            f.write(json.dumps({'activities': [code], 'seconds_per_activity': 2 * model['costs'][code],
+                                'engine': "activity", 'machine': "test"}) + "\n")
+        f.write('{"activities": ["trunc')
+    model = save_lci_cost_model(lci_result_dir)
+    assert model['units'] == "seconds"
+    assert model['number_of_timings'] == len(codes)
+    assert np.isclose(model['slope'], 2) and np.isclose(model['intercept'], 0, atol=1e-8)
+    assert get_slice_activity_codes(lci_result_dir, 0, 2, balance_slices=False) == codes[:ceil(len(codes) / 2)]
+
+
+def test_lease_claiming(tmp_path):
+    lease = try_claim(tmp_path, "block", lease_duration=60)
+    assert lease is not None and lease.is_owned()
+    assert try_claim(tmp_path, "block", lease_duration=60) is None
+    # Expired lease of a dead process is reclaimed, and its owner knows it lost it
+    old = time.time() - 120
+    os.utime(str(lease.fp), (old, old))
+    assert lease_status(tmp_path, 60)['expired'] == {"block"}
+    new_lease = try_claim(tmp_path, "block", lease_duration=60)
+    assert new_lease is not None
+    assert not lease.renew()
+    new_lease.mark_done()
+    assert try_claim(tmp_path, "block", lease_duration=60) is None
+    assert lease_status(tmp_path, 60) == {'done': {"block"}, 'active': set(), 'expired': set()}
+
+
+def _reclaim_lease(lease_dir, block_id):
+    # Another process reclaims the lease, considered expired with lease_duration=0
+    assert try_claim(lease_dir, block_id, lease_duration=0) is not None
+
+
+def test_lease_lost_mid_block(lci_result_dir):
+    iterations = 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    lease_dir = get_lease_dir(lci_result_dir, 0)
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    lease = try_claim(lease_dir, "block", lease_duration=60)
+    # The first two iterations are written while the lease is held
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir,
+                                       iteration_range=(0, 2), finalize=False, lease=lease)
+    temp_fp = g_samples_dir / "temp" / "{}.npy".format(codes[0])
+    written = np.load(str(temp_fp)).copy()
+    process = mp.get_context("spawn").Process(target=_reclaim_lease, args=(lease_dir, "block"))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    with pytest.raises(LeaseLost):
+        calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir,
+                                           iteration_range=(2, 4), lease=lease)
+    # Nothing more was written nor finalized, and the block is not marked done
+    assert np.array_equal(np.load(str(temp_fp)), written)
+    assert not (g_samples_dir / "{}.npy".format(codes[0])).is_file()
+    assert lease.lost and not lease.mark_done()
+    assert lease_status(lease_dir, 60) == {'done': set(), 'active': {"block"}, 'expired': set()}
+
+
+def test_claim_lci_calculations(lci_result_dir):
+    iterations = 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    reference = {code: np.load(str(g_samples_dir / "{}.npy".format(code))) for code in codes}
+    for code in codes:
+        (g_samples_dir / "{}.npy".format(code)).unlink()
+
+    kwargs = dict(engine="iteration", activities_per_block=3, iterations_per_block=2, lease_duration=60)
+    lease_dir = get_lease_dir(lci_result_dir, 0)
+    # Blocks held by another live process are skipped, expired ones are reclaimed
+    held = try_claim(lease_dir, "{}_3_i2-4".format(codes[0]), 60)
+    dead = try_claim(lease_dir, "{}_3_i0-2".format(codes[3]), 60)
+    old = time.time() - 120
+    os.utime(str(dead.fp), (old, old))
+    claimed = claim_lci_calculations(codes, lci_result_dir, 0, 'db', 0, 'default', **kwargs)
+    assert claimed == 5
+    assert not any((g_samples_dir / "{}.npy".format(code)).is_file() for code in codes[:3])
+    held.release()
+    assert claim_lci_calculations(codes, lci_result_dir, 1, 'db', 0, 'default', **kwargs) == 1
+    for code in codes:
+        assert np.allclose(np.load(str(g_samples_dir / "{}.npy".format(code))), reference[code])
+    assert not list((g_samples_dir / "temp").iterdir())
+    assert claim_lci_calculations(codes, lci_result_dir, 2, 'db', 0, 'default', **kwargs) == 0
+
+
+def test_lci_ledger(lci_result_dir):
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    complete, partial, failed = np.ones((5, 3)), np.ones((5, 3)), np.ones((5, 3))
+    partial[:, 1] = 0
+    partial[0, 2] = np.nan
+    failed[1, 0] = np.nan
+    for code, values in [("complete", complete), ("partial", partial), ("failed", failed)]:
+        _write_lci_columns(g_samples_dir, code, values, 0, 5, 3)
+        _finalize_lci_array(g_samples_dir, code, 5, 3)
+    np.save(str(g_samples_dir / "legacy.npy"), complete.astype("float32"))
+    np.save(str(g_samples_dir / "legacy_partial.npy"), partial.astype("float32"))
+    records = read_lci_ledger(g_samples_dir)
+    assert records["partial"]['zero_columns'] == 1 and records["partial"]['nan_columns'] == 1
+    assert records["complete"]['shape'] == [5, 3] and records["complete"]['dtype'] == "float32"
+    # Arrays with failed iterations are recalculated, arrays without record are unverified
+    assert get_completed_lci_codes(g_samples_dir) == {"complete"}
+    assert get_unverified_lci_codes(g_samples_dir) == {"legacy", "legacy_partial"}
+    with open(lci_result_dir / "common_files" / "ordered_activity_codes.json", "w") as f:
+        json.dump(["complete", "legacy"], f)
+    assert not utils._check_lci_missing(lci_result_dir, samples_batch=0)
+    assert set(record_unverified_lci_arrays(g_samples_dir, ["legacy"])) == {"legacy"}
+    assert get_completed_lci_codes(g_samples_dir) == {"complete", "legacy"}
+    assert utils._check_lci_missing(lci_result_dir, samples_batch=0)
+    assert set(record_unverified_lci_arrays(g_samples_dir)) == {"legacy_partial"}
+    assert get_unverified_lci_codes(g_samples_dir) == set()
+    assert get_completed_lci_codes(g_samples_dir) == {"complete", "legacy"}
+
+    result = CliRunner().invoke(cli, ["rebuild-ledger", "--result_dir", str(lci_result_dir)])
+    assert result.exit_code == 0, result.output
+    assert "5 LCI arrays: 2 incomplete, 3 with failed iterations" in result.output
+    assert read_lci_ledger(g_samples_dir)["complete"]['checksum'] == records["complete"]['checksum']
+    assert get_completed_lci_codes(g_samples_dir) == {"complete", "legacy"}
+    os.remove(str(g_samples_dir / "legacy.npy"))
+    assert not utils._check_lci_missing(lci_result_dir, samples_batch=0)
+
+
+def test_result_catalog(lci_result_dir):
+    iterations = 3
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    catalog = create_catalog(lci_result_dir)
+    assert [r['act_code'] for r in catalog.query(result_type="presamples")] == ["base_0"]
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    records = catalog.query(result_type="LCI", samples_batch=0)
+    assert [r['act_code'] for r in records] == codes
+    assert records[0]['shape'] == [5, iterations] and records[0]['format'] == "npy"
+    assert records[0]['path'] == g_samples_dir / "{}.npy".format(codes[0])
+    assert records[0]['nbytes'] == (g_samples_dir / "{}.npy".format(codes[0])).stat().st_size
+
+    # Saved arrays are listed from the catalog, files written by other means only after a rebuild
+    np.save(str(g_samples_dir / "stray.npy"), np.ones((5, iterations), dtype=np.float32))
+    assert get_saved_lci_codes(g_samples_dir) == set(codes)
+    method = ("test", "method")
+    Method(method).register()
+    Method(method).write([(("biosphere", "emission"), 2.)])
+    save_all_lcia_score_arrays(lci_result_dir, method, samples_batch=0, return_per_exchange=False)
+    abbr = Method(method).get_abbreviation()
+    assert len(catalog.query(result_type="LCIA_totals", method=abbr, samples_batch=[0, 1])) == len(codes)
+    rebuild_catalog(lci_result_dir)
+    assert get_saved_lci_codes(g_samples_dir) == set(codes + ["stray"])
+    assert catalog.query(act_code="stray")[0]['zero_columns'] == 0
+    assert len(catalog.query(result_type="LCIA_totals")) == len(codes)
+    # Records are kept if the scan fails
+    (g_samples_dir / "broken.npy").write_bytes(b"not an array")
+    with pytest.raises(ValueError):
+        rebuild_catalog(lci_result_dir)
+    assert len(catalog.query()) == 2 * len(codes) + 2
+    os.remove(str(g_samples_dir / "broken.npy"))
+    result = CliRunner().invoke(cli, ["catalog", "--result_dir", str(lci_result_dir)])
+    assert result.exit_code == 0, result.output
+    assert "LCI  batch 0: {} artifacts".format(len(codes) + 1) in result.output
+
+
+def test_lci_temp_file_renamed(lci_result_dir):
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    temp_dir = g_samples_dir / "temp"
+    temp_dir.mkdir()
+    values = np.arange(15, dtype=np.float32).reshape(5, 3)
+    # Interrupted calculation: the temporary file is a valid .npy file and is resumed
+    _write_lci_columns(g_samples_dir, "code", values[:, :2], 0, 5, 3)
+    _write_lci_progress(g_samples_dir, "code", 2, 5, 3)
+    assert np.array_equal(np.load(str(temp_dir / "code.npy"))[:, :2], values[:, :2])
+    assert _read_lci_progress(g_samples_dir, "code", 5, 3) == 2
+    assert _read_lci_progress(g_samples_dir, "code", 5, 4) == 0
+    _write_lci_columns(g_samples_dir, "code", values[:, 2:], 2, 5, 3)
+    inode = os.stat(str(temp_dir / "code.npy")).st_ino
+    _finalize_lci_array(g_samples_dir, "code", 5, 3)
+    assert os.stat(str(g_samples_dir / "code.npy")).st_ino == inode
+    assert np.array_equal(np.load(str(g_samples_dir / "code.npy")), values)
+    assert not list(temp_dir.iterdir())
+    assert read_lci_ledger(g_samples_dir)["code"]['zero_columns'] == 0
+
+
+def test_cli_does_not_import_brightway2():
+    # The status command must start in a fraction of a second
+    code = "import sys, bw2preagg.cli; print(sorted(m for m in ['brightway2', 'bw2data', 'bw2calc', 'presamples'] " \
+           "if m in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=str(Path(__file__).parent.parent),
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    assert output.strip() == "[]"
+
+
+def test_lci_status(lci_result_dir):
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    failed = np.ones((5, 3))
+    failed[0, 1] = np.nan
+    for code, values in [(codes[0], np.ones((5, 3))), (codes[1], np.ones((5, 3))), (codes[2], failed)]:
+        _write_lci_columns(g_samples_dir, code, values, 0, 5, 3)
+        _finalize_lci_array(g_samples_dir, code, 5, 3)
+    _write_lci_columns(g_samples_dir, codes[3], np.ones((5, 1)), 0, 5, 3)
+    _write_lci_progress(g_samples_dir, codes[3], 1, 5, 3)
+    np.save(str(g_samples_dir / "{}.npy".format(codes[4])), np.ones((5, 3), dtype=np.float32))
+
+    status = get_lci_status(lci_result_dir, number_of_slices=2, balance_slices=False)
+    assert list(status) == [0]
+    counts = {k: status[0][k] for k in ["done", "partial", "failed", "unverified", "remaining", "total"]}
+    assert counts == {"done": 2, "partial": 1, "failed": 1, "unverified": 1, "remaining": len(codes) - 5,
+                      "total": len(codes)}
+    assert status[0]['slices'][0]['done'] == 2
+    assert sum(s['total'] for s in status[0]['slices']) == len(codes)
+    result = CliRunner().invoke(cli, ["status", "--result_dir", str(lci_result_dir), "--number_of_slices", "2"])
+    assert result.exit_code == 0, result.output
+    assert "Samples batch 0: 2/{} done, 1 partial, 1 failed".format(len(codes)) in result.output
+    assert "Slice 1:" in result.output
+    assert not (lci_result_dir / "common_files" / "lci_cost_model.json").exists()
+    # Without a saved cost model, balanced slices fall back to equal slices
+    with pytest.warns(UserWarning, match="No saved LCI cost model"):
+        status = get_lci_status(lci_result_dir, number_of_slices=2, balance_slices=True)
+    assert status[0]['slices'][0]['done'] == 2
+    assert not (lci_result_dir / "common_files" / "lci_cost_model.json").exists()
+    model = save_lci_cost_model(lci_result_dir, use_timings=False)
+    status = get_lci_status(lci_result_dir, number_of_slices=2, balance_slices=True)
+    with open(lci_result_dir / "common_files" / "ordered_activity_codes.json") as f:
+        slices = cost_balanced_slices(json.load(f), model['costs'], 2)
+    assert [s['total'] for s in status[0]['slices']] == [len(s) for s in slices]
+
+
+def test_phase_timings(lci_result_dir):
+    iterations = 3
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    profile_dir = lci_result_dir / "probabilistic" / "LCI_metadata" / "0" / "phase_timings"
+    timer = PhaseTimer.for_worker(profile_dir, 0, per_iteration=True)
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir, timer=timer)
+    with open(timer.filepath) as f:
+        records = [json.loads(line) for line in f]
+    assert {r['iteration'] for r in records if 'iteration' in r} == set(range(iterations))
+    summary = summarize_phase_timings(profile_dir)
+    assert {"analysis", "matrix_rebuild", "factorize", "solve", "inventory",
+            "memmap_write", "final_save"} <= set(summary)
+    assert summary["factorize"]['count'] == iterations
+    result = CliRunner().invoke(cli, ["profile", "--result_dir", str(lci_result_dir),
+                                      "--folded", str(lci_result_dir / "folded.txt")])
+    assert result.exit_code == 0, result.output
+    assert "factorize" in result.output
+    assert len((lci_result_dir / "folded.txt").read_text().splitlines()) == len(summary)
+    # Disabled timers write nothing
+    with PhaseTimer().phase("solve"):
+        pass
+
+
+def test_timed_calculate_lci_array_matches_untimed(lci_result_dir):
+    iterations = 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    act_code = sorted(act.key[1] for act in Database("db"))[0]
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    paths = [p for p in utils._get_campaign(0)]
+    final_fp = g_samples_dir / "{}.npy".format(act_code)
+    calculate_lci_array('db', act_code, paths, 5, iterations, g_samples_dir)
+    untimed = np.load(str(final_fp))
+    os.remove(str(final_fp))
+    timer = PhaseTimer(lci_result_dir / "timings.jsonl")
+    calculate_lci_array('db', act_code, paths, 5, iterations, g_samples_dir, timer=timer)
+    assert np.array_equal(np.load(str(final_fp)), untimed)
+    assert not np.isnan(untimed).any()
+    summary = summarize_phase_timings(lci_result_dir)
+    assert {"matrix_rebuild", "factorize_and_solve", "inventory"} <= set(summary)
+
+
+@bw2test
+def test_synthetic_database(tmp_path):
+    summary = write_synthetic_database(
+        "synthetic", number_of_activities=60, number_of_flows=20, cycle_share=0.2, cycle_length=3,
+        uncertainty_types={"lognormal": 1, "normal": 1, "uniform": 1, "triangular": 1}, seed=3)
+    assert len(Database("synthetic")) == 60
+    assert len(Database("biosphere3")) == 20
+    assert summary['cyclic_inputs'] > 0
+    assert summary['uncertain_exchanges'] == summary['technosphere_exchanges'] + summary['biosphere_exchanges']
+    with pytest.raises(ValueError, match="already exists"):
+        write_synthetic_database("synthetic", number_of_activities=60, seed=3)
+    # Same seed and parameters give the same database, whatever its name
+    write_synthetic_database(
+        "synthetic", database_name="copy", number_of_activities=60, cycle_share=0.2, cycle_length=3,
+        uncertainty_types={"lognormal": 1, "normal": 1, "uniform": 1, "triangular": 1}, seed=3)
+    exchanges = lambda name: sorted(
+        (act['code'], [(exc['amount'], exc['uncertainty type']) for exc in act['exchanges']])
+        for act in Database(name).load().values())
+    assert exchanges("synthetic") == exchanges("copy")
+    setup_project("synthetic", "synthetic", tmp_path, default_bw2setup=False)
+    assert not missing_useful_files(tmp_path)
+    with open(tmp_path / "common_files" / "ordered_activity_codes.json") as f:
+        codes = json.load(f)
+    assert len(codes) == 60
+    assert all((tmp_path / "deterministic" / "LCI" / "{}.npy".format(code)).is_file() for code in codes)
+
+
+def test_lci_store(lci_result_dir):
+    iterations = 3
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    expected = {code: utils.load_LCI_array(lci_result_dir, code, 0) for code in codes}
+    for code in codes:
+        os.remove(g_samples_dir / "{}.npy".format(code))
+    store = create_lci_store(lci_result_dir, 0, iterations, layout="flow", activities_per_chunk=3)
+    with pytest.raises(ValueError, match="different properties"):
+        create_lci_store(lci_result_dir, 0, iterations, layout="activity", activities_per_chunk=3)
+    assert get_completed_lci_codes(g_samples_dir) == set()
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    assert not [f for f in os.listdir(g_samples_dir) if f.endswith(".npy")]
+    assert len(list((g_samples_dir / "lci_store").glob("chunk_*.npy"))) == ceil(len(codes) / 3)
+    assert get_completed_lci_codes(g_samples_dir) == set(codes)
+    assert utils._check_lci_missing(lci_result_dir, 'probabilistic', 0)
+    for code in codes:
+        assert np.allclose(utils.load_LCI_array(lci_result_dir, code, 0), expected[code])
+    flow = store.read_flow(1)
+    assert np.allclose(flow, np.array([expected[code][1] for code in store.activity_codes]))
+    assert set(rebuild_lci_ledger(lci_result_dir, 0)) == set(codes)
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_compressed_array_roundtrip(tmp_path, codec):
+    arr = np.zeros((600, 7), dtype=np.float32)
+    arr[[3, 300, 599]] = np.random.RandomState(0).rand(3, 7)
+    fp = tmp_path / "code.npc"
+    save_compressed_array(fp, arr, get_codec(codec), rows_per_chunk=256)
+    assert fp.stat().st_size < arr.nbytes / 10
+    assert np.array_equal(load_compressed_array(fp), arr)
+    assert np.array_equal(load_compressed_array(fp, rows=[599, 3]), arr[[599, 3]])
+    assert np.array_equal(load_compressed_array(fp, rows=[-1, 300, 3, 300]), arr[[-1, 300, 3, 300]])
+    assert np.array_equal(load_compressed_array(fp, rows=300), arr[300])
+    with pytest.raises(IndexError):
+        load_compressed_array(fp, rows=[600])
+    vector = np.arange(10, dtype=np.float64)
+    save_compressed_array(fp, vector, get_codec(codec, shuffle=False))
+    assert np.array_equal(load_compressed_array(fp), vector)
+
+
+def test_lci_format_recorded_once(tmp_path):
+    g_samples_dir = tmp_path / "probabilistic" / "LCI" / "0"
+    (g_samples_dir / "temp").mkdir(parents=True)
+    _check_lci_format(g_samples_dir, False, "zlib", {"level": 9})
+    assert load_lci_codec_record(g_samples_dir) == {"codec": "zlib", "options": {"level": 9}}
+    _check_lci_format(g_samples_dir, False, "zlib", {"level": 9})
+    for compact, codec, options in [(False, None, None), (True, None, None), (False, "zlib", {"level": 1})]:
+        with pytest.raises(ValueError, match="different format"):
+            _check_lci_format(g_samples_dir, compact, codec, options)
+    assert load_lci_codec_record(g_samples_dir) == {"codec": "zlib", "options": {"level": 9}}
+    # Arrays saved without record are .npy files
+    g_samples_dir = tmp_path / "probabilistic" / "LCI" / "1"
+    g_samples_dir.mkdir()
+    np.save(str(g_samples_dir / "code.npy"), np.zeros((2, 3)))
+    _check_lci_format(g_samples_dir, False, None, None)
+    with pytest.raises(ValueError, match="different format"):
+        _check_lci_format(g_samples_dir, True, None, None)
+    assert not load_lci_compact(g_samples_dir)
+
+
+def test_compressed_lci_and_lcia_arrays(lci_result_dir):
+    iterations = 3
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    save_lci_codec(g_samples_dir, "zlib", {"level": 9})
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    assert sorted(os.listdir(g_samples_dir)) == sorted(["temp"] + ["{}.npc".format(code) for code in codes])
+    assert get_completed_lci_codes(g_samples_dir) == set(codes)
+    lci = utils.load_LCI_array(lci_result_dir, codes[0], 0)
+    assert lci.shape == (5, iterations) and lci.any()
+
+    method = ("test", "method")
+    Method(method).register()
+    Method(method).write([(("biosphere", "emission"), 2.), (("biosphere", "water in"), 1.)])
+    save_all_lcia_score_arrays(lci_result_dir, method, samples_batch=0, codec="zlib")
+    bio_dict = utils.get_ref_bio_dict_from_common_files(lci_result_dir / "common_files")
+    expected = 2 * lci[bio_dict[("biosphere", "emission")]] + lci[bio_dict[("biosphere", "water in")]]
+    assert np.allclose(utils.load_LCIA_array(lci_result_dir, codes[0], method, 0), expected)
+    with pytest.raises(ValueError, match="not valid"):
+        save_all_lcia_score_arrays(lci_result_dir, method, samples_batch=0, codec="boom")
+
+
+def test_compact_lci_arrays(lci_result_dir):
+    arr = np.zeros((6, 3), dtype=np.float32)
+    arr[[1, 4]] = [[1, 2, 3], [0, np.nan, 0]]
+    compact = CompactArray.from_dense(arr)
+    assert compact.rows.tolist() == [1, 4]
+    assert np.array_equal(compact.to_dense(), arr, equal_nan=True)
+    assert np.array_equal(compact.take([5, 1]), arr[[5, 1]])
+
+    iterations = 3
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    save_lci_compact(g_samples_dir)
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    assert sorted(os.listdir(g_samples_dir)) == sorted(["temp"] + ["{}.npz".format(code) for code in codes])
+    assert get_completed_lci_codes(g_samples_dir) == set(codes)
+    lci = utils.load_LCI_array(lci_result_dir, codes[0], 0)
+    compact = utils.load_LCI_array(lci_result_dir, codes[0], 0, compact=True)
+    assert lci.shape == compact.shape == (5, iterations)
+    assert compact.rows.tolist() == np.flatnonzero(lci.any(axis=1)).tolist()
+    assert np.array_equal(compact.to_dense(), lci)
+
+    method = ("test", "method")
+    Method(method).register()
+    Method(method).write([(("biosphere", "emission"), 2.), (("biosphere", "water in"), 1.)])
+    save_all_lcia_score_arrays(lci_result_dir, method, samples_batch=0)
+    bio_dict = utils.get_ref_bio_dict_from_common_files(lci_result_dir / "common_files")
+    rows = [bio_dict[("biosphere", "emission")], bio_dict[("biosphere", "water in")]]
+    expected = lci[rows] * np.array([[2.], [1.]])
+    per_exchange = utils.load_LCIA_array(lci_result_dir, codes[0], method, 0, "per_exchange")
+    assert per_exchange.shape == (iterations,)
+    assert np.allclose(per_exchange, expected.sum(axis=0))
+    assert np.allclose(utils.load_LCIA_array(lci_result_dir, codes[0], method, 0), expected.sum(axis=0))
+
+
+def test_audit_and_patch_legacy_1d_arrays(tmp_path):
+    # Per exchange LCIA arrays were saved as 1-D arrays, one value per iteration
+    legacy = np.array([1, np.nan, 0, 2], dtype=np.float32)
+    assert audit_columns(legacy) == {'nan': [1], 'infinite': [], 'zero': [2]}
+    np.save(str(tmp_path / "a.npy"), legacy)
+    save_compressed_array(tmp_path / "b.npc", legacy, get_codec("zlib"))
+    flagged = _audit_directory(tmp_path, ["a", "b"], partial_zero_only=True)
+    assert flagged == {code: {'nan': [1], 'infinite': [], 'zero': [2]} for code in ["a", "b"]}
+    expected = np.array([1, 3, 4, 2], dtype=np.float32)
+    _patch_saved_array(tmp_path, "a", {1: 3., 2: np.array([4.])})
+    _patch_saved_array(tmp_path, "b", {1: 3., 2: np.array([4.])})
+    assert np.array_equal(np.load(str(tmp_path / "a.npy")), expected)
+    assert np.array_equal(load_compressed_array(tmp_path / "b.npc"), expected)
+    assert _audit_directory(tmp_path, ["a", "b"]) == {}
+
+
+def test_audit_and_repair_arrays(lci_result_dir):
+    arr = np.ones((4, 4), dtype=np.float32)
+    arr[:, 1] = 0
+    arr[2, 2] = np.nan
+    arr[3, 3] = np.inf
+    assert audit_columns(arr, rows_per_block=3) == {'nan': [2], 'infinite': [3], 'zero': [1]}
+
+    iterations = 4
+    generate_base_presamples(
+        project_name='default', database_name='db', result_dir=lci_result_dir,
+        iterations=iterations, samples_batch=0
+    )
+    create_catalog(lci_result_dir)
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    builder = CampaignMatrixBuilder([p for p in utils._get_campaign(0)], lci_result_dir / "common_files")
+    calculate_lci_arrays_per_iteration('db', codes, builder, 5, iterations, g_samples_dir)
+    method = ("test", "method")
+    Method(method).register()
+    Method(method).write([(("biosphere", "emission"), 2.), (("biosphere", "water in"), 1.)])
+    save_all_lcia_score_arrays(lci_result_dir, method, samples_batch=0)
+    abbr = Method(method).get_abbreviation()
+    expected_lci = {code: utils.load_LCI_array(lci_result_dir, code, 0) for code in codes}
+    expected_lcia = utils.load_LCIA_array(lci_result_dir, codes[2], method, 0)
+    expected_per_exchange = utils.load_LCIA_array(lci_result_dir, codes[0], method, 0, "per_exchange")
+    assert audit_arrays(lci_result_dir, 0)['lci_repairs'] == []
+
+    # Failed iterations of LCI arrays, saved in different formats, and a column lost in an LCIA array
+    lci = expected_lci[codes[0]].copy()
+    lci[:, 1] = np.nan
+    np.save(str(g_samples_dir / "{}.npy".format(codes[0])), lci)
+    per_exchange_fp = lci_result_dir / "probabilistic" / abbr / "per_exchange" / "0" / "{}.npy".format(codes[0])
+    per_exchange = expected_per_exchange.copy()
+    per_exchange[1] = np.nan
+    np.save(str(per_exchange_fp), per_exchange)
+    lci = expected_lci[codes[1]].copy()
+    lci[:, [0, 3]] = 0
+    os.remove(str(g_samples_dir / "{}.npy".format(codes[1])))
+    save_compressed_array(g_samples_dir / "{}.npc".format(codes[1]), lci, get_codec("zlib"))
+    lcia = expected_lcia.copy()
+    lcia[0, 2] = np.inf
+    lcia_fp = lci_result_dir / "probabilistic" / abbr / "totals" / "0" / "{}.npy".format(codes[2])
+    np.save(str(lcia_fp), lcia)
+    plan = audit_arrays(lci_result_dir, 0, parallel_jobs=2, activities_per_task=1)
+    assert plan['LCI'][codes[0]] == {'nan': [1], 'infinite': [], 'zero': []}
+    assert plan['lci_repairs'] == sorted([[codes[0], 1], [codes[1], 0], [codes[1], 3]])
+    assert plan['lcia_repairs'] == [[abbr, "totals", codes[2], 2]]
+    assert plan['LCIA'][abbr]['per_exchange'][codes[0]]['nan'] == [1]
+    assert load_repair_plan(lci_result_dir, 0) == plan
+
+    plan = repair_arrays('default', 'db', lci_result_dir, 0)
+    assert plan['lci_repairs'] == plan['lcia_repairs'] == []
+    for code in codes:
+        assert np.allclose(utils.load_LCI_array(lci_result_dir, code, 0), expected_lci[code])
+    assert (g_samples_dir / "{}.npc".format(codes[1])).is_file()
+    assert read_lci_ledger(g_samples_dir)[codes[1]]['zero_columns'] == 0
+    assert np.allclose(utils.load_LCIA_array(lci_result_dir, codes[2], method, 0), expected_lcia)
+    assert np.allclose(utils.load_LCIA_array(lci_result_dir, codes[0], method, 0, "per_exchange"),
+                       expected_per_exchange)
+    assert ResultCatalog(lci_result_dir).query("LCI", act_code=codes[0])[0]['nan_columns'] == 0
+    result = CliRunner().invoke(cli, ["audit", "--result_dir", str(lci_result_dir), "--repair"])
+    assert result.exit_code != 0 and "--project_name" in result.output
+
+
+def test_audit_lci_arrays_of_flow_subset(lci_result_dir):
+    codes = sorted(act.key[1] for act in Database("db"))
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0, must_exist=False)
+    (g_samples_dir / "temp").mkdir()
+    partial = np.ones((5, 3))
+    partial[:, 1] = 0
+    for code, values in [(codes[0], np.zeros((5, 3))), (codes[1], partial)]:
+        _write_lci_columns(g_samples_dir, code, values, 0, 5, 3)
+        _finalize_lci_array(g_samples_dir, code, 5, 3)
+    plan = audit_arrays(lci_result_dir, 0, include_lcia=False, act_codes=codes[:2])
+    assert plan['LCI'][codes[0]]['zero'] == [0, 1, 2]
+    # Activities may emit none of a subset of elementary flows
+    with open(utils._get_lci_metadata_dir(lci_result_dir, 0) / "flow_indices.json", "w") as f:
+        json.dump([0, 2], f)
+    plan = audit_arrays(lci_result_dir, 0, include_lcia=False, act_codes=codes[:2])
+    assert list(plan['LCI']) == [codes[1]]
+    assert plan['lci_repairs'] == [[codes[1], 1]]
+
+
+def test_concatenated_array(lci_result_dir):
+    arrs = [np.random.random((5, n)).astype(np.float32) for n in [3, 4, 2]]
+    full = np.concatenate(arrs, axis=1)
+    arr = ConcatenatedArray(arrs)
+    assert arr.shape == (5, 9) and arr.dtype == np.float32
+    for key in [(slice(None), slice(None)), (2, slice(1, 8)), (slice(1, 4), 5), (-1, -1), 4,
+                (slice(None), slice(None, None, -2)), (slice(None), [2, 3, 8]), (slice(None), slice(5, 5))]:
+        assert np.array_equal(arr[key], full[key])
+    assert np.array_equal(arr[[1, 4], [8, 0]], full[np.ix_([1, 4], [8, 0])])
+    assert np.array_equal(np.asarray(arr), full)
+    with pytest.raises(ValueError, match="same number of rows"):
+        ConcatenatedArray([arrs[0], arrs[1][:4]])
+
+    # Arrays of samples batches saved as .npy files and in an LCI store
+    codes = sorted(act.key[1] for act in Database("db"))
+    for samples_batch in [0, 1]:
+        utils._get_lci_dir(lci_result_dir, 'probabilistic', samples_batch, must_exist=False)
+    g_samples_dir = utils._get_lci_dir(lci_result_dir, 'probabilistic', 0)
+    np.save(str(g_samples_dir / "{}.npy".format(codes[0])), arrs[0])
+    create_lci_store(lci_result_dir, 1, 4).write(codes[0], arrs[1])
+    lci = utils.load_LCI_array(lci_result_dir, codes[0], [0, 1])
+    assert isinstance(lci.parts[0], np.memmap) and isinstance(lci.parts[1].base, np.memmap)
+    assert np.array_equal(lci[:, 2:5], full[:, 2:5])
+    with pytest.raises(ValueError, match="compact"):
+        utils.load_LCI_array(lci_result_dir, codes[0], [0, 1], compact=True)
+
+    method = ("test", "method")
+    Method(method).register()
+    for samples_batch, lcia in enumerate(arrs[:2]):
+        lcia_dir = utils._get_lcia_dir(lci_result_dir, samples_batch, method, must_exist=False)
+        np.save(str(lcia_dir / "{}.npy".format(codes[0])), lcia[:1])
+    lcia = utils.load_LCIA_array(lci_result_dir, codes[0], method, [0, 1])
+    assert np.array_equal(lcia[0], full[0, :7])
+    # Per exchange LCIA arrays are 1-D, and are concatenated as one row
+    for samples_batch, lcia in enumerate(arrs[:2]):
+        lcia_dir = utils._get_lcia_dir(lci_result_dir, samples_batch, method, must_exist=False,
+                                       totals_or_per_exchange="per_exchange")
+        np.save(str(lcia_dir / "{}.npy".format(codes[0])), lcia[1])
+    lcia = utils.load_LCIA_array(lci_result_dir, codes[0], method, [0, 1], "per_exchange")
+    assert lcia.shape == (1, 7) and isinstance(lcia.parts[0], np.memmap)
+    assert np.array_equal(lcia[0, 2:5], full[1, 2:5])
+    with pytest.raises(ValueError, match="same number of rows"):
+        ConcatenatedArray([full[1], full[2:4]])